@@ -1,10 +1,21 @@
 # Generated by CodiumAI
 
+import os
+import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import cv2
 import numpy as np
 import re
+import tracemalloc
+import yaml
+from PIL import Image
 
 import wizard
 from wizard import DataCube
+from wizard._core.wavelengths import WavelengthIndex
+from wizard._processing import registration
+from wizard._processing.spectral import spec_baseline_als
 
 import pytest
 
@@ -295,6 +306,41 @@ class TestDataCube:
         dc.resize(50, 50, interpolation='linear')
         assert dc.cube.shape == (10, 50, 50)
 
+    # Resizing follows the compute dtype policy
+    @pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int32, np.float32, np.float64])
+    def test_resize_keeps_dtype(self, dtype):
+        cube = (np.random.rand(7, 20, 20) * 100).astype(dtype)
+        expected = np.stack([cv2.resize(layer.astype(np.float64), (12, 10)) for layer in cube])
+        for layout in ['bsq', 'bip']:
+            dc = DataCube(cube=cube.copy())
+            dc.set_layout(layout)
+            dc.resize(10, 12)
+            assert dc.cube.dtype == dtype
+            np.testing.assert_allclose(dc.cube, expected, atol=1)
+
+    @pytest.mark.parametrize('interpolation', ['linear', 'nearest', 'area', 'cubic', 'lanczos'])
+    def test_resize_batches_match_per_band(self, interpolation):
+        cube = np.random.rand(150, 30, 24).astype(np.float32)
+        modes = {'linear': cv2.INTER_LINEAR, 'nearest': cv2.INTER_NEAREST, 'area': cv2.INTER_AREA,
+                 'cubic': cv2.INTER_CUBIC, 'lanczos': cv2.INTER_LANCZOS4}
+        expected = np.stack([cv2.resize(layer, (10, 13), interpolation=modes[interpolation]) for layer in cube])
+        for layout in ['bsq', 'bip']:
+            for batch_size, n_jobs in [(None, 1), (None, 3), (7, 2), (500, 1)]:
+                dc = DataCube(cube=cube.copy())
+                dc.set_layout(layout)
+                dc.resize(13, 10, interpolation=interpolation, batch_size=batch_size, n_jobs=n_jobs)
+                np.testing.assert_allclose(dc.cube, expected, atol=1e-5)
+
+    def test_resize_pyramid(self):
+        cube = np.random.rand(5, 64, 64).astype(np.float32)
+        dc = DataCube(cube=cube.copy())
+        dc.resize(8, 8, interpolation='area', pyramid=True)
+        # halving with area interpolation three times is the mean of 8x8 blocks
+        np.testing.assert_allclose(dc.cube, cube.reshape(5, 8, 8, 8, 8).mean(axis=(2, 4)), atol=1e-5)
+        dc = DataCube(cube=cube.copy())
+        dc.resize(50, 50, pyramid=True)
+        assert dc.cube.shape == (5, 50, 50)
+
     # Resizing a cube with valid x_new and y_new values and nearest interpolation
     def test_valid_resize_nearest_interpolation(self):
         cube = np.random.rand(10, 100, 100)
@@ -522,6 +568,39 @@ class TestDataCube:
         dc.start_recording()
         assert dc.record == True
 
+    def test_only_dynamic_methods_are_tracked(self):
+        assert DataCube.__getitem__.__qualname__ == 'DataCube.__getitem__'
+        assert DataCube.__iter__.__qualname__ == 'DataCube.__iter__'
+        assert hasattr(DataCube.inverse, '__wrapped__')
+
+    def test_recording_logs_instead_of_printing(self, capsys, caplog):
+        dc = create_test_cube()
+        with caplog.at_level('DEBUG', logger='wizard._utils.tracker'):
+            dc.start_recording()
+            dc.inverse()
+            dc.stop_recording()
+        assert 'Tracking' not in capsys.readouterr().out
+        record, = [r for r in caplog.records if r.name == 'wizard._utils.tracker']
+        assert record.method == 'inverse'
+
+    def test_save_template_maps_positional_args(self, tmp_path):
+        dc = create_test_cube(shape=(3, 8, 8))
+        dc.start_recording()
+        dc.resize(4, 5)
+        dc.stop_recording()
+        path = str(tmp_path / 'template.yml')
+        dc.save_template(path)
+        with open(path) as template_file:
+            assert yaml.safe_load(template_file) == [{'method': 'resize', 'kwargs': {'x_new': 4, 'y_new': 5}}]
+
+    def test_only_dynamic_methods_are_wrapped(self):
+        # indexing and other plain methods run without the tracking wrapper
+        for name in ('__getitem__', '__len__', '__iter__', 'view', 'set_cube'):
+            assert not hasattr(vars(DataCube)[name], '__wrapped__'), name
+        assert hasattr(DataCube.inverse, '__wrapped__')
+        dc = create_test_cube(shape=(5, 4, 4))
+        assert type(dc[3]) is np.ndarray
+
 
 class TestDataCubeOps:
 
@@ -566,6 +645,19 @@ class TestDataCubeOps:
         np.testing.assert_array_equal(dc1.shape, (6,4,4))
         assert isinstance(dc1, DataCube)
 
+    def test_merge_cubes_registered(self):
+        base = self.shifted_squares(shape=(1, 160, 140))[0]
+        dc1 = DataCube(np.stack([base, base]), wavelengths=[0, 1], registered=True)
+        dc2 = DataCube(np.stack([np.roll(base, shift=(3, 4), axis=(0, 1))] * 3), wavelengths=[2, 3, 4],
+                       registered=True)
+        dc1.merge_cubes(dc2, register=True)
+        assert dc1.cube.shape == (5, 160, 140)
+        for layer in dc1.cube[2:]:
+            np.testing.assert_allclose(layer[30:-30, 30:-30], base[30:-30, 30:-30], atol=0.1)
+        homographies = dc1.transforms.homographies
+        np.testing.assert_allclose(homographies[:2], np.eye(3)[None].repeat(2, axis=0))
+        np.testing.assert_allclose(homographies[2:, :2, 2], [[-4, -3]] * 3, atol=0.5)
+
     def test_remove_background_dark(self):
         dc = create_test_cube(shape=(3, 24, 24))
 
@@ -704,6 +796,24 @@ class TestDataCubeOps:
         # After polynomial vignetting removal, dtype should be float32
         assert dc.cube.dtype == np.float32
 
+    @pytest.mark.parametrize('axis', [1, 2])
+    def test_remove_vignetting_poly_matches_per_band(self, axis):
+        from scipy.signal import savgol_filter
+        dc = create_test_cube(shape=(4, 80, 90))
+        cube = dc.cube.copy()
+        dc.remove_vignetting_poly(axis=axis, slice_params={'start': 10, 'end': 60, 'step': 2})
+        expected = cube.astype(np.float32)
+        for i in range(4):
+            if axis == 1:
+                profile = savgol_filter(cube[i, :, 10:60:2].mean(axis=1), window_length=71, polyorder=1)
+                for j in range(90):
+                    expected[i, :, j] -= profile
+            else:
+                profile = savgol_filter(cube[i, 10:60:2, :].mean(axis=0), window_length=71, polyorder=1)
+                for j in range(80):
+                    expected[i, j, :] -= profile
+        np.testing.assert_allclose(dc.cube, expected, rtol=1e-5, atol=1e-6)
+
     def test_normalize(self):
         import numpy as np
         dc = create_test_cube(shape=(2, 4, 4))
@@ -743,6 +853,93 @@ class TestDataCubeOps:
         assert dc.cube.shape == (10, 251, 201)
         assert getattr(dc, 'registered', False) is True
 
+    def test_register_layers_best_detects_features_once(self, monkeypatch):
+        from wizard._utils import helper
+        dc = create_test_cube(shape=(10, 251, 201))
+        tmp_cube = dc.cube.copy() * 0.1
+        x_start, x_end = int(dc.shape[1] * 0.45), int(dc.shape[1] * 0.65)
+        y_start, y_end = int(dc.shape[2] * 0.45), int(dc.shape[2] * 0.65)
+        for idx in range(dc.shape[0]):
+            tmp_cube[idx, x_start + idx:x_end + idx, y_start + idx:y_end + idx] = 0.9
+        dc.set_cube(tmp_cube)
+
+        calls = []
+        detect = helper.detect_features
+
+        def counting_detect(img, max_features=5000, orb=None):
+            calls.append(hash(np.ascontiguousarray(img).tobytes()))
+            return detect(img, max_features, orb)
+
+        monkeypatch.setattr(helper, 'detect_features', counting_detect)
+        dc.register_layers_best(ref_layer=2, scale_thresh=2.2, rot_thresh=20., n_jobs=1)
+        # no image is featurized twice, although later layers are matched against several references
+        assert len(calls) == len(set(calls))
+
+    @staticmethod
+    def shifted_squares(shape=(8, 160, 140)):
+        cube = np.random.default_rng(0).random(shape) * 0.1
+        for idx in range(shape[0]):
+            cube[idx, 50 + idx:100 + idx, 40 + idx:90 + idx] = 0.9
+        return cube
+
+    def test_register_layers_simple_parallel_matches_serial(self):
+        cube = self.shifted_squares()
+        expected = DataCube(cube.copy()).register_layers_simple(max_features=1000, n_jobs=1).cube
+        result = DataCube(cube.copy()).register_layers_simple(max_features=1000, n_jobs=3).cube
+        np.testing.assert_array_equal(result, expected)
+
+    def test_register_layers_best_waves(self):
+        cube = self.shifted_squares()
+        kwargs = dict(ref_layer=0, scale_thresh=2.2, rot_thresh=20.)
+        expected = DataCube(cube.copy()).register_layers_best(wave_size=1, n_jobs=1, **kwargs).cube
+        # the result depends on the wave size only, not on the threads
+        result = DataCube(cube.copy()).register_layers_best(wave_size=1, n_jobs=3, **kwargs).cube
+        np.testing.assert_array_equal(result, expected)
+        waves = DataCube(cube.copy()).register_layers_best(wave_size=4, n_jobs=2, **kwargs)
+        assert waves.registered is True
+        np.testing.assert_array_equal(waves.cube[0], cube[0])
+
+    def test_register_layers_best_default_waves_ignore_n_jobs(self):
+        cube = self.shifted_squares()
+        kwargs = dict(ref_layer=0, scale_thresh=2.2, rot_thresh=20.)
+        serial = DataCube(cube.copy()).register_layers_best(n_jobs=1, **kwargs)
+        parallel = DataCube(cube.copy()).register_layers_best(n_jobs=4, **kwargs)
+        np.testing.assert_array_equal(parallel.cube, serial.cube)
+        np.testing.assert_array_equal(parallel.transforms.homographies, serial.transforms.homographies)
+
+    @pytest.mark.parametrize('op', ['register_layers_simple', 'register_layers_best'])
+    def test_register_layers_transforms(self, op, tmp_path):
+        cube = self.shifted_squares()
+        registered = getattr(DataCube(cube.copy()), op)(max_features=1000, n_jobs=1)
+        transforms = registered.transforms
+        assert isinstance(transforms, registration.TransformSet)
+        assert transforms.homographies.shape == (8, 3, 3)
+        np.testing.assert_array_equal(transforms.homographies[0], np.eye(3))
+
+        # the saved transforms register a new acquisition of the same rig
+        transforms.save(str(tmp_path / 'rig'))
+        dc = DataCube(cube.copy()).apply_transforms(str(tmp_path / 'rig.npz'))
+        assert dc.registered is True
+        np.testing.assert_allclose(dc.cube, registered.cube, atol=1e-6)
+
+    def test_apply_transforms_errors(self):
+        dc = create_test_cube(shape=(3, 16, 16))
+        with pytest.raises(ValueError):
+            dc.apply_transforms()
+        with pytest.raises(ValueError):
+            dc.apply_transforms(registration.TransformSet.identity(4, (16, 16)))
+
+    @pytest.mark.parametrize('op', ['register_layers_simple', 'register_layers_best'])
+    def test_register_layers_phase(self, op):
+        base = self.shifted_squares(shape=(1, 160, 140))[0]
+        cube = np.stack([np.roll(base, shift=(i, -2 * i), axis=(0, 1)) for i in range(5)])
+        dc = getattr(DataCube(cube), op)(method='phase', n_jobs=2)
+        assert dc.registered is True
+        for layer in dc.cube:
+            np.testing.assert_allclose(layer[20:-20, 20:-20], cube[0, 20:-20, 20:-20], atol=0.1)
+        with pytest.raises(ValueError):
+            getattr(DataCube(cube), op)(method='optical_flow')
+
     def test_remove_vignetting(self):
         import numpy as np
         dc = create_test_cube(shape=(3, 4, 4))
@@ -807,3 +1004,782 @@ class TestDataCubeOps:
         dc.remove_vignette(vignette_map=vignette_map, flip=True)
         assert np.all(dc.cube == 10.0)
 
+
+
+class TestLazyExecution:
+
+    def _pipeline(self, dc, vignette_map):
+        return dc.inverse().normalize().remove_vignette(vignette_map=vignette_map, flip=True).uniform_filter_dc(size=3)
+
+    @pytest.mark.parametrize('dtype', [np.float64, np.uint8])
+    def test_fused_matches_eager(self, dtype):
+        data = (np.random.rand(12, 9, 7) * 200).astype(dtype)
+        vignette_map = np.random.rand(9, 7) * 0.1
+
+        eager = DataCube(data.copy())
+        self._pipeline(eager, vignette_map)
+
+        lazy = DataCube(data.copy())
+        lazy.start_lazy()
+        self._pipeline(lazy, vignette_map)
+        assert len(lazy._graph) == 4
+        # small blocks, so the reductions span several blocks
+        lazy.compute(block_bytes=9 * 7 * 8 * 5)
+
+        assert lazy.cube.dtype == eager.cube.dtype
+        np.testing.assert_allclose(lazy.cube, eager.cube, rtol=1e-6)
+
+    def test_cube_access_materializes(self):
+        dc = create_test_cube(shape=(3, 4, 4))
+        expected = dc.cube.max() - dc.cube
+        dc.start_lazy()
+        assert dc.lazy
+        assert dc.inverse() is dc
+        assert len(dc._graph) == 1
+        np.testing.assert_allclose(dc.cube, expected)
+        assert len(dc._graph) == 0
+
+    def test_non_fusable_ops_keep_order(self):
+        data = np.random.rand(4, 8, 8)
+        eager = DataCube(data.copy())
+        eager.inverse().normalize()
+        eager.resize(x_new=4, y_new=4)
+        eager.inverse()
+
+        lazy = DataCube(data.copy())
+        lazy.start_lazy()
+        lazy.inverse().normalize()
+        lazy.resize(x_new=4, y_new=4)
+        lazy.inverse()
+        lazy.stop_lazy()
+
+        assert not lazy.lazy
+        assert lazy.shape == (4, 4, 4)
+        np.testing.assert_allclose(lazy.cube, eager.cube, rtol=1e-6)
+
+    def test_fuse_stages(self):
+        from wizard._core.fusion import fuse_stages
+        names = ['inverse', 'normalize', 'resize', 'remove_vignette', 'uniform_filter_dc', 'inverse']
+        stages = fuse_stages([{'name': n} for n in names])
+        assert [[node['name'] for node in stage] for stage in stages] == [
+            ['inverse', 'normalize'], ['resize'], ['remove_vignette', 'uniform_filter_dc', 'inverse']]
+
+    def test_invalid_parameters_raise_on_compute(self):
+        dc = create_test_cube(shape=(3, 4, 5))
+        dc.start_lazy()
+        dc.inverse().remove_vignette(vignette_map=np.ones((3, 3)))
+        with pytest.raises(ValueError):
+            dc.compute()
+
+
+class TestTemplateCheckpoints:
+
+    def _write_template(self, path, steps):
+        with open(path, 'w') as template_file:
+            yaml.dump(steps, template_file)
+        return str(path)
+
+    def test_resume_after_edited_step(self, tmp_path, caplog):
+        data = np.random.rand(4, 6, 6)
+        ckpt = str(tmp_path / 'ckpt')
+        steps = [{'method': 'inverse', 'kwargs': {}}, {'method': 'normalize', 'kwargs': {}}]
+        template = self._write_template(tmp_path / 'a.yml', steps)
+        DataCube(data.copy()).execute_template(template, checkpoint_dir=ckpt)
+        assert len(os.listdir(ckpt)) == 4
+
+        edited = self._write_template(tmp_path / 'b.yml', steps + [{'method': 'uniform_filter_dc', 'kwargs': {'size': 3}}])
+        with caplog.at_level('INFO', logger='wizard._core.datacube'):
+            with wizard.profiler.profiling() as records:
+                dc = DataCube(data.copy(), name='resumed')
+                dc.execute_template(edited, checkpoint_dir=ckpt)
+        assert [r['method'] for r in records] == ['uniform_filter_dc']
+        assert 'after step 2/3' in caplog.text
+
+        expected = DataCube(data.copy())
+        expected.execute_template(edited)
+        np.testing.assert_allclose(dc.cube, expected.cube)
+        np.testing.assert_array_equal(dc.wavelengths, expected.wavelengths)
+
+    def test_changed_input_does_not_resume(self, tmp_path):
+        ckpt = str(tmp_path / 'ckpt')
+        template = self._write_template(tmp_path / 'a.yml', [{'method': 'inverse', 'kwargs': {}}])
+        DataCube(np.random.rand(2, 3, 3)).execute_template(template, checkpoint_dir=ckpt)
+
+        data = np.random.rand(2, 3, 3)
+        dc = DataCube(data.copy())
+        dc.execute_template(template, checkpoint_dir=ckpt)
+        np.testing.assert_allclose(dc.cube, data.max() - data)
+        assert len(os.listdir(ckpt)) == 4
+
+    def test_incomplete_checkpoint_is_ignored(self, tmp_path):
+        ckpt = str(tmp_path / 'ckpt')
+        template = self._write_template(tmp_path / 'a.yml', [{'method': 'inverse', 'kwargs': {}}])
+        data = np.random.rand(2, 3, 3)
+        DataCube(data.copy()).execute_template(template, checkpoint_dir=ckpt)
+        for name in os.listdir(ckpt):
+            if name.endswith('.json'):
+                os.remove(os.path.join(ckpt, name))
+
+        with wizard.profiler.profiling() as records:
+            DataCube(data.copy()).execute_template(template, checkpoint_dir=ckpt)
+        assert [r['method'] for r in records] == ['inverse']
+
+
+    def test_resume_keeps_transforms(self, tmp_path):
+        data = np.random.rand(3, 8, 8)
+        ckpt = str(tmp_path / 'ckpt')
+        registration.TransformSet(
+            [[[1, 0, i], [0, 1, 0], [0, 0, 1]] for i in range(3)], (8, 8)).save(str(tmp_path / 'rig.npz'))
+        steps = [{'method': 'apply_transforms', 'kwargs': {'transforms': str(tmp_path / 'rig.npz')}}]
+        template = self._write_template(tmp_path / 'a.yml', steps)
+        DataCube(data.copy()).execute_template(template, checkpoint_dir=ckpt)
+
+        edited = self._write_template(tmp_path / 'b.yml', steps + [{'method': 'inverse', 'kwargs': {}}])
+        with wizard.profiler.profiling() as records:
+            dc = DataCube(data.copy())
+            dc.execute_template(edited, checkpoint_dir=ckpt)
+        assert [r['method'] for r in records] == ['inverse']
+        assert dc.registered is True
+        np.testing.assert_array_equal(dc.transforms.homographies[:, 0, 2], [0, 1, 2])
+        assert dc.transforms.shape == (8, 8)
+
+
+class TestTiledExecution:
+
+    steps = [
+        {'method': 'remove_spikes', 'kwargs': {'threshold': 500, 'window': 3}},
+        {'method': 'inverse', 'kwargs': {}},
+        {'method': 'uniform_filter_dc', 'kwargs': {'size': 3}},
+        {'method': 'normalize', 'kwargs': {}},
+        {'method': 'uniform_filter_dc', 'kwargs': {'size': 5}},
+    ]
+
+    @pytest.fixture
+    def template(self, tmp_path):
+        path = tmp_path / 'template.yml'
+        with open(path, 'w') as template_file:
+            yaml.dump(self.steps, template_file)
+        return str(path)
+
+    @pytest.fixture
+    def data(self):
+        data = np.random.rand(6, 23, 17) * 100
+        data[2, 5, 5] = 5000
+        data[4, 20, 3] = 8000
+        return data
+
+    def _eager(self, data):
+        dc = DataCube(data.copy())
+        for step in self.steps:
+            getattr(dc, step['method'])(**step['kwargs'])
+        return dc.cube
+
+    def test_tiled_matches_eager(self, template, data):
+        dc = DataCube(data.copy())
+        with wizard.profiler.profiling() as records:
+            dc.execute_template(template, tile_size=5, n_jobs=2)
+        assert [r['method'] for r in records] == [
+            'tiled(remove_spikes+inverse+uniform_filter_dc+normalize+uniform_filter_dc)']
+        np.testing.assert_allclose(dc.cube, self._eager(data), rtol=1e-5)
+
+    def test_memory_mapped_input_streams_to_out(self, template, data, tmp_path):
+        wizard.write(DataCube(data.astype(np.float32)), str(tmp_path / 'in.hdr'))
+        dc = wizard.read(str(tmp_path / 'in.hdr'), mmap=True)
+        out = np.lib.format.open_memmap(str(tmp_path / 'out.npy'), mode='w+', dtype=np.float32, shape=dc.shape)
+
+        with wizard.profiler.profiling() as records:
+            dc.execute_template(template, out=out)
+        assert records[0]['method'].startswith('tiled(')
+        assert dc.cube is out
+        np.testing.assert_allclose(np.load(str(tmp_path / 'out.npy')), self._eager(data.astype(np.float32)),
+                                   rtol=1e-5, atol=1e-6)
+
+    def test_non_tileable_template_runs_eagerly(self, tmp_path, data):
+        path = tmp_path / 'template.yml'
+        with open(path, 'w') as template_file:
+            yaml.dump([{'method': 'inverse', 'kwargs': {}}, {'method': 'resize', 'kwargs': {'x_new': 10, 'y_new': 8}}],
+                      template_file)
+        dc = DataCube(data.copy())
+        with wizard.profiler.profiling() as records:
+            dc.execute_template(str(path), tile_size=4)
+        assert [r['method'] for r in records] == ['inverse', 'resize']
+        assert dc.shape == (6, 10, 8)
+
+
+def _fill_band(dc, band):
+    # worker for TestSharedDataCube, module level so spawned processes can import it
+    dc.cube[band] = band
+    return len(dc.inverse.__name__)
+
+
+class TestSharedDataCube:
+
+    @pytest.mark.parametrize('backend', ['shm', 'mmap'])
+    def test_pickle_sends_handle_only(self, backend, tmp_path):
+        dc = create_test_cube(shape=(8, 64, 64))
+        expected = dc.cube.copy()
+        with dc.share(backend=backend, path=str(tmp_path / 'cube.npy')):
+            np.testing.assert_array_equal(dc.cube, expected)
+            payload = pickle.dumps(dc)
+            assert len(payload) < dc.cube.nbytes // 10
+
+            remote = pickle.loads(payload)
+            np.testing.assert_array_equal(remote.cube, expected)
+            remote.cube[0] = -1
+            assert np.all(dc.cube[0] == -1)
+            np.testing.assert_array_equal(remote.wavelengths, dc.wavelengths)
+
+    def test_replaced_cube_is_pickled_by_value(self):
+        dc = create_test_cube()
+        with dc.share():
+            dc.inverse()
+            remote = pickle.loads(pickle.dumps(dc))
+            np.testing.assert_array_equal(remote.cube, dc.cube)
+
+    def test_attach_in_worker_processes(self):
+        dc = create_test_cube(shape=(4, 5, 5))
+        with dc.share():
+            with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results = list(pool.map(_fill_band, [dc] * 4, range(4)))
+            assert results == [len('inverse')] * 4
+            np.testing.assert_array_equal(dc.cube[:, 2, 3], np.arange(4))
+
+    @pytest.mark.parametrize('backend', ['shm', 'mmap'])
+    def test_pickle_after_unlink(self, backend, tmp_path):
+        dc = create_test_cube(shape=(3, 8, 8))
+        with dc.share(backend=backend, path=str(tmp_path / 'cube.npy')):
+            dc.cube[0] = -1
+        assert dc._shared is None
+        assert not (tmp_path / 'cube.npy').exists()
+        remote = pickle.loads(pickle.dumps(dc))
+        np.testing.assert_array_equal(remote.cube, dc.cube)
+        assert np.all(remote.cube[0] == -1)
+
+    def test_attach_keeps_transforms(self):
+        dc = create_test_cube(shape=(2, 5, 5))
+        dc.transforms = registration.TransformSet.identity(2, (5, 5), method='phase')
+        with dc.share() as handle:
+            remote = pickle.loads(pickle.dumps(handle)).attach()
+            assert remote.transforms.info == {'method': 'phase'}
+            np.testing.assert_array_equal(remote.transforms.homographies, dc.transforms.homographies)
+            remote._shared.close()
+
+    def test_invalid_backend(self):
+        dc = create_test_cube()
+        with pytest.raises(ValueError):
+            dc.share(backend='disk')
+        with pytest.raises(ValueError):
+            dc.share(backend='mmap')
+
+
+class TestIterators:
+
+    def test_nested_iteration_is_independent(self):
+        dc = create_test_cube(shape=(3, 4, 4))
+        pairs = [(a.sum(), b.sum()) for a in dc for b in dc]
+        assert len(pairs) == 9
+        np.testing.assert_allclose([p[1] for p in pairs[:3]], dc.cube.sum(axis=(1, 2)))
+
+    def test_iter_bands(self):
+        dc = create_test_cube(shape=(7, 4, 5))
+        blocks = list(dc.iter_bands(3))
+        assert [bands for bands, _ in blocks] == [slice(0, 3), slice(3, 6), slice(6, 7)]
+        np.testing.assert_array_equal(np.concatenate([b for _, b in blocks]), dc.cube)
+
+    def test_iter_tiles(self):
+        dc = create_test_cube(shape=(2, 5, 7))
+        out = np.zeros_like(dc.cube)
+        iterator = dc.iter_tiles(3)
+        assert len(iterator) == 6
+        for (rows, cols), block in iterator:
+            assert block.shape[0] == 2
+            out[:, rows, cols] = block
+        np.testing.assert_array_equal(out, dc.cube)
+
+    def test_iter_pixels(self):
+        dc = create_test_cube(shape=(4, 5, 7))
+        flat = dc.cube.reshape(4, -1).T
+        for pixels, spectra in dc.iter_pixels(6):
+            assert spectra.flags['C_CONTIGUOUS']
+            np.testing.assert_array_equal(spectra, flat[pixels])
+        with pytest.raises(ValueError):
+            dc.iter_pixels(0)
+
+    def test_shared_iterator_across_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        dc = create_test_cube(shape=(3, 64, 64))
+        iterator = dc.iter_pixels(100)
+        seen = []
+
+        def consume():
+            for pixels, spectra in iterator:
+                seen.append((pixels.start, spectra.shape[0]))
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            for future in [pool.submit(consume) for _ in range(4)]:
+                future.result()
+        assert sorted(start for start, _ in seen) == list(range(0, 64 * 64, 100))
+        assert sum(n for _, n in seen) == 64 * 64
+
+
+class TestBandStats:
+
+    def test_values_match_numpy(self):
+        dc = create_test_cube(shape=(4, 6, 5))
+        cube = dc.cube
+        np.testing.assert_array_equal(dc.stats.min, cube.min(axis=(1, 2)))
+        np.testing.assert_array_equal(dc.stats.max, cube.max(axis=(1, 2)))
+        np.testing.assert_allclose(dc.stats.mean, cube.mean(axis=(1, 2)))
+        np.testing.assert_allclose(dc.stats.std, cube.std(axis=(1, 2)))
+        np.testing.assert_allclose(dc.stats.percentile([5, 95]),
+                                   np.percentile(cube.reshape(4, -1), [5, 95], axis=1))
+        assert dc.stats.percentile(50).shape == (4,)
+        counts, edges = dc.stats.histogram(8)
+        assert counts.shape == (4, 8) and edges.shape == (4, 9)
+        np.testing.assert_array_equal(counts.sum(axis=1), 30)
+
+    def test_blockwise_moments_match_numpy(self, monkeypatch):
+        monkeypatch.setattr('wizard._core.stats.BLOCK_BYTES', 3 * 5 * 8 * 2)
+        rng = np.random.default_rng(0)
+        cube = (rng.random((3, 7, 5)) * 10 + 1e6).astype(np.float32)
+        dc = DataCube(cube)
+        np.testing.assert_array_equal(dc.stats.min, cube.min(axis=(1, 2)))
+        np.testing.assert_array_equal(dc.stats.max, cube.max(axis=(1, 2)))
+        np.testing.assert_allclose(dc.stats.mean, cube.mean(axis=(1, 2), dtype=np.float64))
+        np.testing.assert_allclose(dc.stats.std, cube.std(axis=(1, 2), dtype=np.float64))
+
+    def test_repeated_queries_are_cached(self):
+        dc = create_test_cube(shape=(3, 4, 4))
+        assert dc.stats is dc.stats
+        assert dc.stats.max is dc.stats.max
+        assert dc.stats.histogram(4) is dc.stats.histogram(4)
+
+    def test_invalidated_by_set_cube_and_setitem(self):
+        dc = create_test_cube(shape=(3, 4, 4))
+        before = dc.stats.max.copy()
+        dc[0] = dc.cube[0] + 100
+        assert dc.stats.max[0] == before[0] + 100
+        dc.set_cube(np.zeros((2, 4, 4)))
+        np.testing.assert_array_equal(dc.stats.max, [0, 0])
+
+    def test_ops_see_writes_into_the_cube_array(self):
+        dc = DataCube(np.ones((2, 3, 3)), wavelengths=[0, 1])
+        dc.cube[:, 0, 0] = 0
+        dc.stats.max
+        dc.cube[:, 1, 1] = 10
+        inverted = DataCube(dc.cube, wavelengths=[0, 1]).inverse()
+        assert inverted.cube[:, 1, 1].max() == 0 and inverted.cube.max() == 10
+        dc.normalize()
+        assert dc.cube.max() == 1.0 and dc.cube.min() == 0.0
+
+    def test_not_pickled(self):
+        dc = create_test_cube(shape=(3, 4, 4))
+        dc.stats.mean
+        restored = pickle.loads(pickle.dumps(dc))
+        assert restored._stats is None
+        np.testing.assert_array_equal(restored.stats.mean, dc.stats.mean)
+
+
+class TestDataCubeView:
+
+    def test_window_shares_memory(self):
+        dc = create_test_cube(shape=(6, 8, 8))
+        roi = dc.view(bands=slice(1, 4), x=(2, 5), y=slice(0, 8, 2))
+        assert roi.cube.shape == (3, 3, 4)
+        assert np.shares_memory(roi.cube, dc.cube)
+        np.testing.assert_array_equal(roi.wavelengths, [1, 2, 3])
+        roi[0] = -1
+        assert np.all(dc.cube[1, 2:5, 0:8:2] == -1)
+
+    def test_wavelength_range(self):
+        dc = DataCube(np.random.rand(5, 4, 4), wavelengths=[500, 600, 700, 800, 900], notation='nm')
+        sub = dc.view(wavelengths=(600, 800))
+        np.testing.assert_array_equal(sub.wavelengths, [600, 700, 800])
+        assert np.shares_memory(sub.cube, dc.cube)
+        assert sub.notation == 'nm' and sub.shape == (3, 4, 4)
+
+    def test_band_indices(self):
+        dc = create_test_cube(shape=(8, 3, 3))
+        sub = dc.view(bands=[1, 3, 5])
+        np.testing.assert_array_equal(sub.cube, dc.cube[[1, 3, 5]])
+        assert np.shares_memory(sub.cube, dc.cube)
+        assert dc.view(bands=2).shape == (1, 3, 3)
+        with pytest.raises(ValueError):
+            dc.view(bands=[1, 2, 5])
+        with pytest.raises(ValueError):
+            dc.view(bands=[1], wavelengths=(0, 2))
+
+    def test_view_slices_transforms(self):
+        dc = create_test_cube(shape=(6, 10, 12))
+        homographies = np.repeat(np.eye(3)[None], 6, axis=0)
+        homographies[:, 0, 2] = np.arange(6)
+        homographies[:, 0, 0] = 1.1
+        dc.transforms = registration.TransformSet(homographies, (10, 12))
+
+        roi = dc.view(bands=slice(2, 5), x=(2, 8), y=(3, 9))
+        assert roi.transforms.shape == (6, 6)
+        assert len(roi.transforms.homographies) == 3
+        # a point of the window maps to the same place as the point in the full cube
+        point, origin = np.array([4., 1., 1.]), np.array([3., 2., 0.])
+        for h_view, h in zip(roi.transforms.homographies, homographies[2:5]):
+            np.testing.assert_allclose(h_view @ point + origin, h @ (point + origin))
+        assert dc.view(x=slice(0, 10, 2)).transforms is None
+
+    def test_band_tuple_is_index_list(self):
+        dc = create_test_cube(shape=(8, 3, 3))
+        np.testing.assert_array_equal(dc.view(bands=(2, 5)).cube, dc.view(bands=[2, 5]).cube)
+        np.testing.assert_array_equal(dc.view(bands=(2, 5)).cube, dc.cube[[2, 5]])
+        assert dc.view(x=(0, 2)).shape == (8, 2, 3)
+
+
+class TestWavelengthIndex:
+
+    def test_lookups(self):
+        dc = DataCube(np.zeros((5, 2, 2)), wavelengths=[400, 410, 420, 430, 440])
+        index = dc.wavelength_index
+        assert index.nearest(414) == 1 and index.nearest(416) == 2
+        assert index.floor(419) == 1 and index.ceil(411) == 2
+        assert index.floor(399) == -1 and index.ceil(441) == -1
+        assert index.nearest(500, max_deviation=10) == -1
+        np.testing.assert_array_equal(index.nearest([380, 425.1, 1000]), [0, 3, 4])
+        assert index.to_slice(405, 430) == slice(1, 4)
+
+    def test_unsorted_wavelengths_map_to_bands(self):
+        dc = DataCube(np.zeros((4, 2, 2)), wavelengths=[700, 500, 600, 800])
+        index = dc.wavelength_index
+        np.testing.assert_array_equal(index.nearest([500, 610, 790]), [1, 2, 3])
+        np.testing.assert_array_equal(index.bands_in_range(550, 750), [0, 2])
+        with pytest.raises(ValueError):
+            index.to_slice(550, 800)
+
+    def test_rebuilt_when_wavelengths_change(self):
+        dc = DataCube(np.zeros((3, 2, 2)), wavelengths=[1, 2, 3])
+        assert dc.wavelength_index is dc.wavelength_index
+        dc.set_wavelengths(np.array([30, 20, 10]))
+        assert dc.wavelength_index.nearest(11) == 2
+
+    def test_of_reuses_cached_index(self):
+        from wizard._utils import helper
+
+        dc = DataCube(np.zeros((3, 2, 2)), wavelengths=np.array([700, 500, 600]))
+        index = dc.wavelength_index
+        assert WavelengthIndex.of(dc) is index
+        assert WavelengthIndex.of(index) is index
+        assert WavelengthIndex.of(dc.wavelengths) is index
+        assert WavelengthIndex.of(dc.wavelengths.copy()) is not index
+        assert helper.find_nex_greater_wave(dc.wavelengths, 598) == 600
+
+    def test_sorted_wavelengths_are_not_sorted_again(self):
+        waves = np.array([400, 410, 410, 420])
+        index = WavelengthIndex(waves)
+        assert index._sorted is index.wavelengths
+        assert index.ceil(405) == 1 and index.floor(415) == 2
+
+
+class TestMemoryLayout:
+
+    def test_set_layout_keeps_values(self):
+        dc = create_test_cube(shape=(5, 6, 7))
+        original = dc.cube.copy()
+        assert dc.layout == 'bsq'
+        dc.set_layout('bip')
+        assert dc.layout == 'bip' and dc.cube.shape == (5, 6, 7)
+        np.testing.assert_array_equal(dc.cube, original)
+        assert dc.cube.reshape(5, -1).T.flags['C_CONTIGUOUS']
+        with pytest.raises(ValueError):
+            dc.set_layout('bil')
+
+    def test_as_layout_is_cached(self):
+        dc = create_test_cube(shape=(3, 4, 4))
+        bip = dc.as_layout('bip')
+        assert dc.as_layout('bip') is bip
+        assert dc.as_layout('bsq') is dc.cube
+        dc[0] = 0
+        assert dc.as_layout('bip') is not bip
+        assert np.all(dc.as_layout('bip')[0] == 0)
+
+    def test_ops_convert_to_preferred_layout(self):
+        dc = create_test_cube(shape=(6, 5, 5))
+        expected = create_test_cube(shape=(6, 5, 5))
+        expected.set_cube(dc.cube.copy())
+        dc.baseline_als(lam=100, p=0.1, niter=2)
+        assert dc.layout == 'bip'
+        for i in range(5):
+            for j in range(5):
+                spectrum = expected.cube[:, i, j]
+                np.testing.assert_allclose(dc.cube[:, i, j], spectrum - spec_baseline_als(spectrum, 100, 0.1, 2))
+        dc.uniform_filter_dc(size=3)
+        assert dc.layout == 'bsq'
+
+    def test_inplace_and_out_keep_layout(self):
+        dc = create_test_cube(shape=(6, 5, 5))
+        expected = create_test_cube(shape=(6, 5, 5))
+        expected.set_cube(dc.cube.copy())
+        expected.baseline_als(lam=100, p=0.1, niter=2)
+        cube = dc.cube
+        dc.baseline_als(lam=100, p=0.1, niter=2, inplace=True)
+        assert dc.cube is cube and dc.layout == 'bsq'
+        np.testing.assert_allclose(dc.cube, expected.cube)
+
+        out = np.empty_like(cube)
+        dc.remove_spikes(threshold=3, window=3, out=out)
+        assert dc.cube is out and dc.layout == 'bsq'
+
+    def test_stats_survive_layout_change(self):
+        dc = create_test_cube(shape=(3, 4, 4))
+        stats = dc.stats
+        dc.set_layout('bip')
+        assert dc.stats is stats
+
+
+def peak_memory(func, *args, **kwargs):
+    """Return the peak number of bytes allocated while calling `func`."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# operation, keyword arguments, cube shape and peak memory of a call without and with
+# `inplace` in multiples of the cube size; all of them can run in place on a float32 cube
+MEMORY_OPS = [
+    ('inverse', {}, (20, 80, 80), 1.5, 0.5),
+    ('normalize', {}, (20, 80, 80), 1.5, 0.5),
+    ('remove_vignette', {'vignette_map': np.full((80, 80), 0.1, dtype=np.float32)}, (20, 80, 80), 1.5, 0.5),
+    ('remove_vignetting', {'sigma': 5}, (20, 80, 80), 1.5, 0.5),
+    ('remove_vignetting_poly', {}, (20, 80, 80), 1.5, 0.5),
+    ('uniform_filter_dc', {'size': 3}, (20, 80, 80), 1.5, 0.5),
+    ('resize', {'x_new': 80, 'y_new': 80}, (20, 80, 80), 1.5, 0.5),
+    ('calibrate', {'dark': np.full((20, 1, 1), 0.01, dtype=np.float32),
+                   'white': np.full((20, 1, 1), 2., dtype=np.float32)}, (20, 80, 80), 1.5, 0.5),
+    ('remove_background', {'threshold': 50}, (20, 80, 80), 1.5, 0.5),
+    # the z-scores take one array of the size of the cube plus a boolean mask
+    ('remove_spikes', {'threshold': 3}, (20, 80, 80), 2.5, 1.5),
+    # without `inplace` the cube is converted to the 'bip' layout first; few pixels, as it is slow
+    ('baseline_als', {'lam': 100, 'p': 0.1, 'niter': 2}, (100, 16, 16), 3., 0.5),
+    ('register_layers_simple', {'max_features': 1000}, (20, 80, 80), 1.5, 0.5),
+    # the layers of a wave keep their aligned image and edge maps until the wave is written
+    ('register_layers_best', {'ref_layer': 0, 'scale_thresh': 2.2, 'rot_thresh': 20.}, (24, 160, 140), 3.5, 2.5),
+]
+
+
+class TestOpMemory:
+
+    @pytest.fixture(autouse=True)
+    def fake_rembg(self, monkeypatch):
+        # the background model of rembg is downloaded on first use; keep bright pixels instead
+        from wizard._core import datacube_ops
+
+        def remove(img):
+            gray = np.asarray(img)
+            alpha = np.where(gray > 127, 255, 0).astype(np.uint8)
+            return Image.fromarray(np.dstack([gray, gray, gray, alpha]))
+
+        monkeypatch.setattr(datacube_ops.rembg, 'remove', remove)
+
+    @staticmethod
+    def create_float32_cube(shape=(20, 80, 80)):
+        # noise with a shifting square, so the registration operations find features
+        cube = np.random.default_rng(0).random(shape, dtype=np.float32) * 0.1
+        x, y = shape[1] // 3, shape[2] // 3
+        for idx in range(shape[0]):
+            cube[idx, x + idx % 4:2 * x + idx % 4, y + idx % 4:2 * y + idx % 4] = 0.9
+        return DataCube(cube=cube, wavelengths=np.arange(shape[0]))
+
+    @pytest.mark.parametrize('op, kwargs, shape, copy_limit, inplace_limit', MEMORY_OPS)
+    def test_peak_memory(self, op, kwargs, shape, copy_limit, inplace_limit):
+        # warm up, so imports and caches of the first call are not measured
+        getattr(self.create_float32_cube(shape), op)(**kwargs)
+
+        dc = self.create_float32_cube(shape)
+        nbytes = dc.cube.nbytes
+        assert peak_memory(getattr(dc, op), **kwargs) < copy_limit * nbytes
+
+        dc = self.create_float32_cube(shape)
+        cube = dc.cube
+        assert peak_memory(getattr(dc, op), inplace=True, **kwargs) < inplace_limit * nbytes
+        assert dc.cube is cube
+
+    def test_apply_transforms_memory(self):
+        transforms = registration.TransformSet(
+            [[[1, 0, i % 3], [0, 1, -(i % 4)], [0, 0, 1]] for i in range(20)], (80, 80))
+        self.create_float32_cube().apply_transforms(transforms)
+
+        dc = self.create_float32_cube()
+        expected = transforms.apply(dc.cube)
+        nbytes = dc.cube.nbytes
+        assert peak_memory(dc.apply_transforms, transforms) < 1.5 * nbytes
+
+        dc = self.create_float32_cube()
+        cube = dc.cube
+        expected = transforms.apply(cube)
+        assert peak_memory(dc.apply_transforms, transforms, inplace=True) < 0.5 * nbytes
+        assert dc.cube is cube
+        np.testing.assert_array_equal(dc.cube, expected)
+
+    @pytest.mark.parametrize('op, kwargs, shape, copy_limit, inplace_limit', MEMORY_OPS)
+    def test_copy_inplace_and_out_agree(self, op, kwargs, shape, copy_limit, inplace_limit):
+        dc = self.create_float32_cube(shape)
+        original = dc.cube.copy()
+        expected = self.create_float32_cube(shape)
+        expected.set_cube(original.copy())
+        getattr(expected, op)(**kwargs)
+
+        cube = dc.cube
+        getattr(dc, op)(**kwargs)
+        assert dc.cube is not cube
+        np.testing.assert_array_equal(cube, original)
+        np.testing.assert_allclose(dc.cube, expected.cube, rtol=1e-6)
+
+        dc.set_cube(original.copy())
+        cube = dc.cube
+        getattr(dc, op)(inplace=True, **kwargs)
+        assert dc.cube is cube
+        np.testing.assert_allclose(dc.cube, expected.cube, rtol=1e-6)
+
+        dc.set_cube(original.copy())
+        out = np.empty_like(original)
+        getattr(dc, op)(out=out, **kwargs)
+        assert dc.cube is out
+        np.testing.assert_allclose(out, expected.cube, rtol=1e-6)
+
+    def test_inplace_updates_stats(self):
+        dc = self.create_float32_cube()
+        assert dc.stats.max.max() <= 1
+        dc.inverse(inplace=True)
+        np.testing.assert_allclose(dc.stats.max, dc.cube.reshape(20, -1).max(axis=1))
+
+    def test_invalid_buffers(self):
+        dc = create_test_cube(shape=(3, 8, 8))
+        dc.set_cube((dc.cube * 255).astype(np.uint8))
+        with pytest.raises(ValueError):
+            dc.normalize(inplace=True)
+        with pytest.raises(ValueError):
+            dc.resize(x_new=4, y_new=4, inplace=True)
+        with pytest.raises(ValueError):
+            dc.inverse(inplace=True, out=np.empty_like(dc.cube))
+        with pytest.raises(ValueError):
+            dc.inverse(out=np.empty((3, 4, 4), dtype=np.uint8))
+        with pytest.raises(ValueError):
+            dc.normalize(out=np.empty((3, 8, 8), dtype=np.uint8))
+        read_only = dc.cube
+        read_only.flags.writeable = False
+        with pytest.raises(ValueError):
+            dc.inverse(inplace=True)
+
+    def test_resize_into_out(self):
+        dc = create_test_cube(shape=(3, 8, 8))
+        out = np.empty((3, 4, 4), dtype=dc.cube.dtype)
+        dc.resize(x_new=4, y_new=4, out=out)
+        assert dc.cube is out
+
+    def test_buffers_are_not_fused(self):
+        dc = self.create_float32_cube(shape=(3, 8, 8))
+        out = np.empty_like(dc.cube)
+        expected = dc.cube.max() - dc.cube
+        expected = (expected - expected.min(axis=(1, 2), keepdims=True)) / np.ptp(expected, axis=(1, 2), keepdims=True)
+        dc.start_lazy()
+        dc.inverse()
+        dc.normalize(out=out)
+        assert dc.cube is out
+        dc.stop_lazy()
+        np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-6)
+        stages = wizard._core.fusion.fuse_stages([
+            {'name': 'inverse', 'kwargs': {}},
+            {'name': 'normalize', 'kwargs': {'out': out}},
+            {'name': 'inverse', 'kwargs': {'inplace': True}},
+        ])
+        assert [len(stage) for stage in stages] == [1, 1, 1]
+
+
+class TestCalibrate:
+
+    @pytest.fixture
+    def raw(self):
+        rng = np.random.default_rng(1)
+        dark = rng.random((5, 1, 12)) * 10
+        white = dark + 100 + rng.random((5, 9, 12)) * 50
+        reflectance = rng.random((5, 9, 12))
+        return dark, white, dark + reflectance * (white - dark), reflectance
+
+    def test_calibrate(self, raw):
+        dark, white, cube, reflectance = raw
+        dc = DataCube(cube.copy())
+        dc.calibrate(dark=dark, white=white)
+        assert dc.cube.dtype == np.float32
+        np.testing.assert_allclose(dc.cube, reflectance, rtol=1e-4, atol=1e-5)
+
+    def test_averages_recordings(self, raw):
+        dark, white, cube, reflectance = raw
+        darks = np.stack([dark - 1, dark + 1])
+        whites = [DataCube(white * 0.9), white * 1.1]
+        dc = DataCube(cube.copy())
+        dc.calibrate(dark=darks, white=whites, clip=None)
+        expected = (cube - dark) / (white - dark)
+        np.testing.assert_allclose(dc.cube, expected, rtol=1e-4, atol=1e-5)
+
+    def test_clip_and_zero_division(self, raw):
+        dark, white, cube, reflectance = raw
+        white = white.copy()
+        white[:, 0, 0] = dark[:, 0, 0]
+        dc = DataCube((cube * 1.5).astype(np.float32))
+        cube = dc.cube
+        dc.calibrate(dark=dark, white=white, clip=(0, 1), inplace=True)
+        assert dc.cube is cube
+        assert np.all(dc.cube[:, 0, 0] == 0)
+        assert dc.cube.min() >= 0 and dc.cube.max() <= 1
+        with pytest.raises(ValueError):
+            dc.calibrate(dark=np.zeros((5, 2, 12)))
+        with pytest.raises(ValueError):
+            dc.calibrate()
+
+    def test_template_keeps_references(self, raw, tmp_path):
+        dark, white, cube, reflectance = raw
+        wizard.write(DataCube(white), str(tmp_path / 'white.hdr'))
+        dc = DataCube(cube.copy())
+        dc.start_recording()
+        dc.calibrate(dark=dark, white=str(tmp_path / 'white.hdr'), clip=None)
+        dc.stop_recording()
+        path = str(tmp_path / 'template.yml')
+        dc.save_template(path)
+
+        replay = DataCube(cube.copy())
+        replay.execute_template(path)
+        np.testing.assert_allclose(replay.cube, dc.cube)
+        np.testing.assert_allclose(replay.cube, reflectance, rtol=1e-4, atol=1e-5)
+
+    def test_template_refuses_datacube_references(self, raw, tmp_path):
+        dark, white, cube, reflectance = raw
+        dc = DataCube(cube.copy())
+        dc.start_recording()
+        dc.calibrate(dark=DataCube(dark), white=DataCube(white))
+        dc.stop_recording()
+        with pytest.raises(ValueError, match='dark'):
+            dc.save_template(str(tmp_path / 'template.yml'))
+
+    def test_fused_and_tiled(self, raw, tmp_path):
+        dark, white, cube, reflectance = raw
+        eager = DataCube(cube.copy())
+        eager.calibrate(dark=dark, white=white).inverse()
+
+        lazy = DataCube(cube.copy())
+        lazy.start_lazy()
+        lazy.calibrate(dark=dark, white=white).inverse()
+        with wizard.profiler.profiling() as records:
+            lazy.compute(block_bytes=9 * 12 * 8 * 2)
+        assert records[0]['method'] == 'fused(calibrate+inverse)'
+        np.testing.assert_allclose(lazy.cube, eager.cube, rtol=1e-5)
+
+        wizard.write(DataCube(white), str(tmp_path / 'white.hdr'))
+        path = tmp_path / 'template.yml'
+        with open(path, 'w') as template_file:
+            yaml.dump([{'method': 'calibrate', 'kwargs': {'dark': dark.tolist(), 'white': str(tmp_path / 'white.hdr')}},
+                       {'method': 'inverse', 'kwargs': {}}], template_file)
+        tiled = DataCube(cube.copy())
+        with wizard.profiler.profiling() as records:
+            tiled.execute_template(str(path), tile_size=4, n_jobs=2)
+        assert records[0]['method'] == 'tiled(calibrate+inverse)'
+        np.testing.assert_allclose(tiled.cube, eager.cube, rtol=1e-4, atol=1e-5)
@@ -33,6 +33,8 @@ from wizard._processing.cluster import (
     isodata,
 )
 
+from wizard._processing import filters, flatfield, registration
+
 
 # Fixtures for sample data
 @pytest.fixture
@@ -290,6 +292,18 @@ class TestClustering:
         assert labels.shape == (2, 2)
         assert set(np.unique(labels)).issubset({0, 1})
 
+    def test_clustering_does_not_cache_layouts(self):
+        cube = np.random.default_rng(0).random((4, 6, 5))
+        dc = wizard.DataCube(cube=cube, wavelengths=np.arange(4))
+        cluster = wizard._processing.cluster
+        cluster.kmeans(dc, n_clusters=2, n_init=1)
+        cluster.pca(dc, n_components=2)
+        cluster.spatial_agglomerative_clustering(dc, n_clusters=2)
+        cluster.smooth_kmeans(dc, n_clusters=2, mrf_iterations=1, kernel_size=3, sigma=0.5)
+        cluster.isodata(dc, k=2, it=2)
+        # no converted copy of the cube is kept on the DataCube
+        assert dc._layouts == {}
+
     def test_smooth_cluster_errors_and_identity(self):
         # bad type
         with pytest.raises(TypeError):
@@ -302,3 +316,289 @@ class TestClustering:
         result = wizard._processing.cluster.smooth_cluster(img, sigma=2.0)
         assert result.dtype == img.dtype
         assert np.array_equal(result, img)
+
+
+# --------------- Flat-Field Tests ---------------
+
+@pytest.fixture
+def vignetted_cube():
+    """Fixture: Generate a 3-band cube with a radial vignette and noise."""
+    xx, yy = np.mgrid[0:120:1, 0:160:1]
+    vignette = 1 - 0.25 * (((xx - 60) / 60) ** 2 + ((yy - 80) / 80) ** 2)
+    rng = np.random.default_rng(0)
+    return np.stack([vignette * scale + rng.random((120, 160)) for scale in (50, 100, 200)]).astype(np.float32)
+
+
+class TestFlatField:
+
+    @pytest.mark.parametrize('method, tolerance', [('downsample', 1e-2), ('fft', 1e-3)])
+    def test_methods_match_direct(self, vignetted_cube, method, tolerance):
+        from scipy.ndimage import gaussian_filter
+        expected = np.stack([gaussian_filter(band, sigma=20) for band in vignetted_cube])
+        illumination = flatfield.estimate_illumination(vignetted_cube, sigma=20, method=method)
+        assert illumination.shape == vignetted_cube.shape
+        assert np.abs(illumination - expected).max() < tolerance * expected.mean()
+
+    def test_threads_match_single_thread(self, vignetted_cube):
+        single = flatfield.estimate_illumination(vignetted_cube, sigma=20, n_jobs=1)
+        threaded = flatfield.estimate_illumination(vignetted_cube, sigma=20, n_jobs=3)
+        np.testing.assert_array_equal(single, threaded)
+
+    def test_flat_field(self, vignetted_cube):
+        flat = flatfield.estimate_flat_field(vignetted_cube, sigma=20)
+        np.testing.assert_allclose(flat.mean(axis=(1, 2)), 1, rtol=1e-5)
+        shared = flatfield.estimate_flat_field(vignetted_cube, sigma=20, shared=True)
+        assert shared.shape == (1, 120, 160)
+        # bands without signal are left uncorrected
+        flat = flatfield.estimate_flat_field(np.zeros((2, 20, 20)), sigma=5)
+        np.testing.assert_array_equal(flat, 1)
+
+    def test_invalid_method(self, vignetted_cube):
+        with pytest.raises(ValueError):
+            flatfield.estimate_illumination(vignetted_cube, method='box')
+
+    @pytest.mark.parametrize('shared', [False, True])
+    def test_remove_vignetting_flattens(self, vignetted_cube, shared):
+        dc = wizard.DataCube(cube=vignetted_cube.copy(), wavelengths=np.arange(3))
+        dc.remove_vignetting(sigma=20, shared=shared, n_jobs=2)
+        def falloff(cube):
+            return cube[:, :15, :15].mean() / cube[:, 50:70, 70:90].mean()
+        assert falloff(vignetted_cube) < 0.7
+        assert falloff(dc.cube) > 0.8
+
+
+class TestFlatFieldModel:
+
+    @pytest.fixture(autouse=True)
+    def empty_cache(self):
+        flatfield.clear_models()
+        yield
+        flatfield.clear_models()
+
+    def test_estimate_from_references(self, vignetted_cube):
+        references = [wizard.DataCube(cube=vignetted_cube * f, wavelengths=np.arange(3)) for f in (0.9, 1.1)]
+        model = flatfield.FlatFieldModel.estimate(references, sigma=20, instrument='cam-a')
+        expected = flatfield.estimate_flat_field(vignetted_cube, sigma=20)
+        np.testing.assert_allclose(model.flat, expected, rtol=1e-4)
+        np.testing.assert_allclose(model.gain * model.flat, 1, rtol=1e-6)
+        np.testing.assert_array_equal(model.wavelengths, np.arange(3))
+        assert model.key == 'cam-a' and not model.shared
+        with pytest.raises(ValueError):
+            flatfield.FlatFieldModel.estimate([vignetted_cube, vignetted_cube[:, :10]])
+
+    def test_save_and_load(self, vignetted_cube, tmp_path, monkeypatch):
+        model = flatfield.FlatFieldModel.estimate(vignetted_cube, sigma=20, shared=True)
+        path = str(tmp_path / 'model')
+        model.save(path)
+        loaded = flatfield.FlatFieldModel.load(path + '.npz')
+        np.testing.assert_array_equal(loaded.flat, model.flat)
+        assert loaded.shared and loaded.instrument is None and loaded.wavelengths is None
+        assert loaded.info['sigma'] == 20 and loaded.info['n_references'] == 1
+
+        monkeypatch.setattr(flatfield, 'FORMAT_VERSION', 2)
+        model.save(path)
+        monkeypatch.undo()
+        with pytest.raises(ValueError):
+            flatfield.FlatFieldModel.load(path + '.npz')
+
+    def test_apply_flat_field(self, vignetted_cube, tmp_path):
+        model = flatfield.FlatFieldModel.estimate(vignetted_cube, sigma=20, instrument='cam-a')
+        expected = vignetted_cube / model.flat
+
+        dc = wizard.DataCube(cube=vignetted_cube.copy(), wavelengths=np.arange(3))
+        cube = dc.cube
+        dc.apply_flat_field(model, inplace=True)
+        assert dc.cube is cube
+        np.testing.assert_allclose(dc.cube, expected, rtol=1e-5)
+
+        model.save(str(tmp_path / 'cam-a.npz'))
+        dc = wizard.DataCube(cube=vignetted_cube.copy(), wavelengths=np.arange(3))
+        dc.apply_flat_field(str(tmp_path / 'cam-a.npz'))
+        np.testing.assert_allclose(dc.cube, expected, rtol=1e-5)
+
+        dc = wizard.DataCube(cube=vignetted_cube.astype(np.uint16), wavelengths=np.arange(3))
+        dc.apply_flat_field(model)
+        assert dc.cube.dtype == np.uint16
+        np.testing.assert_allclose(dc.cube, np.rint(vignetted_cube.astype(np.uint16) / model.flat), atol=1)
+
+    def test_registered_models(self, vignetted_cube):
+        dc = wizard.DataCube(cube=vignetted_cube.copy(), wavelengths=np.arange(3))
+        with pytest.raises(ValueError):
+            dc.apply_flat_field()
+        model = flatfield.FlatFieldModel.estimate(vignetted_cube, sigma=20, shared=True)
+        flatfield.register_model(model)
+        assert flatfield.get_model((120, 160)) is model
+        dc.apply_flat_field()
+        np.testing.assert_allclose(dc.cube, vignetted_cube / model.flat, rtol=1e-5)
+
+        flatfield.register_model(flatfield.FlatFieldModel(np.ones((3, 120, 160)), instrument='cam-b'))
+        dc.apply_flat_field(instrument='cam-b')
+        with pytest.raises(ValueError):
+            dc.apply_flat_field(instrument='cam-c')
+        with pytest.raises(ValueError):
+            dc.apply_flat_field(flatfield.FlatFieldModel(np.ones((2, 120, 160))))
+
+
+class TestFilters:
+
+    @pytest.mark.parametrize('dtype', [np.float32, np.float64, np.uint16])
+    @pytest.mark.parametrize('n_jobs', [1, 3])
+    def test_uniform_filter_cube_matches_per_band(self, dtype, n_jobs):
+        from scipy.ndimage import uniform_filter
+        cube = (np.random.rand(7, 30, 25) * 1000).astype(dtype)
+        expected = np.stack([uniform_filter(band, size=5, mode='nearest') for band in cube])
+        result = filters.uniform_filter_cube(cube, 5, mode='nearest', n_jobs=n_jobs)
+        assert result.dtype == dtype
+        np.testing.assert_array_equal(result, expected)
+
+        out = cube.copy()
+        assert filters.uniform_filter_cube(out, 5, mode='nearest', out=out, n_jobs=n_jobs) is out
+        np.testing.assert_array_equal(out, expected)
+
+    def test_uniform_filter_cube_more_jobs_than_bands(self):
+        cube = np.random.rand(2, 10, 10)
+        np.testing.assert_allclose(filters.uniform_filter_cube(cube, 3, n_jobs=8),
+                                   filters.uniform_filter_cube(cube, 3, n_jobs=1))
+
+
+class TestRegistrationWaves:
+
+    @staticmethod
+    def chain_align(layer, references):
+        # a layer can only be aligned to its direct neighbour
+        return layer * 10 if {layer - 1, layer + 1} & references else None
+
+    @pytest.mark.parametrize('n_jobs', [1, 3])
+    def test_waves_see_aligned_set_at_wave_start(self, n_jobs):
+        committed = []
+        aligned = {0}
+        failed = registration.align_in_waves(range(1, 6), aligned, self.chain_align,
+                                             lambda layer, result: committed.append((layer, result)),
+                                             wave_size=2, n_jobs=n_jobs)
+        # wave [1, 2]: only 1 touches 0; wave [3, 4]: neither touches {0, 1}; wave [5]: no
+        assert committed == [(1, 10)]
+        assert failed == [2, 3, 4, 5]
+        assert aligned == {0, 1}
+
+    def test_default_wave_size_does_not_depend_on_n_jobs(self):
+        results = []
+        for n_jobs in (1, 4):
+            aligned = {0}
+            failed = registration.align_in_waves(range(1, 20), aligned, self.chain_align,
+                                                 lambda layer, result: None, n_jobs=n_jobs)
+            results.append((failed, aligned))
+        assert results[0] == results[1]
+        # the first wave holds WAVE_SIZE layers, of which only layer 1 touches layer 0
+        assert results[0][1] == {0, 1}
+
+    def test_wave_size_one_is_sequential(self):
+        aligned = {0}
+        failed = registration.align_in_waves(range(1, 6), aligned, self.chain_align,
+                                             lambda layer, result: None, wave_size=1, n_jobs=2)
+        assert failed == []
+        assert aligned == set(range(6))
+
+    def test_retry_and_prepare(self):
+        aligned = {0}
+        prepared = []
+        kwargs = dict(align=self.chain_align, commit=lambda layer, result: None, wave_size=3, n_jobs=2,
+                      prepare=prepared.append)
+        failed = registration.align_in_waves([3, 2, 1], aligned, **kwargs)
+        assert failed == [3, 2]
+        failed = registration.align_in_waves(failed, aligned, **kwargs)
+        assert failed == [3]
+        assert prepared == [[1], [2]]
+
+    def test_register_pair_phase_falls_back(self, monkeypatch):
+        from wizard._utils import helper
+        rng = np.random.default_rng(0)
+        img = np.zeros((96, 96))
+        img[30:60, 20:50] = 1
+        calls = []
+        feature_registration = helper.feature_registration
+
+        def counting(*args, **kwargs):
+            calls.append(1)
+            return feature_registration(*args, **kwargs)
+
+        monkeypatch.setattr(helper, 'feature_registration', counting)
+        _, h = registration.register_pair(img, np.roll(img, 3, axis=1), method='phase')
+        np.testing.assert_allclose(h[:2, 2], [-3, 0], atol=0.25)
+        assert calls == []
+        with pytest.raises(helper.RegistrationError):
+            registration.register_pair(img, rng.random(img.shape), method='phase')
+        assert calls == [1]
+
+    def test_register_pair_unknown_method(self):
+        img = np.zeros((8, 8))
+        with pytest.raises(ValueError):
+            registration.register_pair(img, img, method='optical_flow')
+
+
+class TestTransformSet:
+
+    @staticmethod
+    def translations(shifts):
+        return np.array([[[1, 0, dx], [0, 1, dy], [0, 0, 1]] for dx, dy in shifts], dtype=float)
+
+    def test_apply_matches_per_band_warp(self):
+        import cv2
+        cube = np.random.default_rng(0).random((6, 40, 30)).astype(np.float32)
+        homographies = self.translations([(0, 0), (0, 0), (2, 1), (2, 1), (-1.5, 3), (0, 0)])
+        homographies[4, 0, 1] = 0.05
+        transforms = registration.TransformSet(homographies, (40, 30))
+
+        result = transforms.apply(cube, n_jobs=2)
+        for band, h in zip(range(6), homographies):
+            np.testing.assert_array_equal(result[band], cv2.warpPerspective(cube[band], h, (30, 40)))
+
+        # band-interleaved cubes warp runs of equal homographies as one image
+        interleaved = np.ascontiguousarray(cube.transpose(1, 2, 0)).transpose(2, 0, 1)
+        np.testing.assert_allclose(transforms.apply(interleaved), result, atol=0.05)
+
+    def test_apply_in_place_and_dtypes(self):
+        cube = np.random.default_rng(1).integers(0, 1000, (4, 20, 20)).astype(np.int32)
+        transforms = registration.TransformSet(self.translations([(0, 0), (1, 0), (0, 2), (3, 3)]), (20, 20))
+        expected = transforms.apply(cube)
+        assert expected.dtype == np.int32
+        np.testing.assert_array_equal(expected[1, :, 1:], cube[1, :, :-1])
+
+        result = transforms.apply(cube, out=cube)
+        assert result is cube
+        np.testing.assert_array_equal(cube, expected)
+
+    def test_save_load(self, tmp_path):
+        transforms = registration.TransformSet(self.translations([(0, 0), (1, 2)]), (8, 9), instrument='rig-a',
+                                               wavelengths=[500, 510], method='phase', reference=0)
+        transforms.save(str(tmp_path / 'rig'))
+        loaded = registration.TransformSet.load(str(tmp_path / 'rig.npz'))
+        np.testing.assert_array_equal(loaded.homographies, transforms.homographies)
+        assert loaded.shape == (8, 9)
+        assert loaded.instrument == 'rig-a'
+        np.testing.assert_array_equal(loaded.wavelengths, [500, 510])
+        assert loaded.info == {'method': 'phase', 'reference': 0}
+        assert not (tmp_path / 'rig.npz.tmp').exists()
+
+    def test_load_newer_version(self, tmp_path, monkeypatch):
+        transforms = registration.TransformSet.identity(2, (4, 4))
+        monkeypatch.setattr(registration, 'FORMAT_VERSION', registration.FORMAT_VERSION + 1)
+        transforms.save(str(tmp_path / 'new.npz'))
+        monkeypatch.undo()
+        with pytest.raises(ValueError):
+            registration.TransformSet.load(str(tmp_path / 'new.npz'))
+
+    def test_compose_and_check(self):
+        first = registration.TransformSet(self.translations([(1, 0), (0, 1)]), (10, 10))
+        second = registration.TransformSet(self.translations([(2, 0), (0, 3)]), (10, 10), method='feature')
+        composed = second.compose(first)
+        np.testing.assert_array_equal(composed.homographies[:, :2, 2], [[3, 0], [0, 4]])
+        assert composed.info == {'method': 'feature'}
+        assert second.compose(None) is second
+        assert second.compose(registration.TransformSet.identity(3, (10, 10))) is second
+
+        with pytest.raises(ValueError):
+            second.check((3, 10, 10))
+        with pytest.raises(ValueError):
+            second.check((2, 10, 11))
+        with pytest.raises(ValueError):
+            registration.TransformSet(np.eye(3), (10, 10))
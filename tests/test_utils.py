@@ -3,11 +3,12 @@
 
 
 from wizard._utils.example import generate_pattern_stack
-from wizard._utils import helper, _loader, decorators
+from wizard._utils import helper, _loader, decorators, config
 from wizard._core.datacube import DataCube
 import wizard
 
 import os
+import json
 import time
 import pytest
 import tempfile
@@ -906,3 +907,298 @@ class TestFeatureRegistration:
 
         # Assert that the homography is not None
         assert h is not None, "Homography should not be None."
+
+    def test_feature_registration_precomputed_features(self):
+        """
+        Precomputed features give the same homography as detecting them in the call.
+        """
+        rng = np.random.default_rng(0)
+        img1 = (rng.random((120, 120)) * 255).astype(np.uint8)
+        img2 = np.roll(img1, shift=4, axis=1)
+
+        _, h_ref = helper.feature_registration(img1, img2, max_features=1000)
+        _, h = helper.feature_registration(img1, img2, max_features=1000,
+                                           o_features=helper.detect_features(img1, 1000),
+                                           a_features=helper.detect_features(img2, 1000))
+        np.testing.assert_allclose(h, h_ref)
+
+    @staticmethod
+    def squares_image(seed=0):
+        img = np.zeros((160, 140))
+        img[50:100, 40:90] = 0.9
+        img[20:35, 100:120] = 0.5
+        return img + np.random.default_rng(seed).random(img.shape) * 0.1
+
+    @pytest.mark.parametrize('levels', [0, 1, 2])
+    def test_phase_registration_integer_shift(self, levels):
+        img = self.squares_image()
+        shifted = np.roll(img, shift=(4, -7), axis=(0, 1))
+
+        aligned, h = helper.phase_registration(img, shifted, levels=levels)
+        np.testing.assert_allclose(h[:2, 2], [7, -4], atol=0.1)
+        np.testing.assert_allclose(aligned[20:-20, 20:-20], img[20:-20, 20:-20], atol=0.15)
+
+    def test_phase_registration_subpixel_shift(self):
+        from scipy.ndimage import fourier_shift
+        img = self.squares_image()
+        shifted = np.fft.ifftn(fourier_shift(np.fft.fftn(img), (1.5, -2.5))).real
+
+        _, h = helper.phase_registration(img, shifted)
+        np.testing.assert_allclose(h[:2, 2], [2.5, -1.5], atol=0.5)
+
+    def test_phase_registration_low_response(self):
+        img = self.squares_image()
+        with pytest.raises(helper.RegistrationError):
+            helper.phase_registration(img, np.random.default_rng(1).random(img.shape))
+        with pytest.raises(helper.RegistrationError):
+            helper.phase_registration(img, img[:100])
+
+    def test_translate_image(self):
+        img = self.squares_image().astype(np.float32)
+        moved = helper.translate_image(img, 3, -2)
+        assert moved.dtype == np.float32
+        np.testing.assert_allclose(moved[10:-10, 10:-10], img[12:-8, 7:-13])
+
+    def test_feature_cache(self, monkeypatch):
+        """
+        The cache detects features and edges once per key until it is invalidated.
+        """
+        calls = []
+        detect = helper.detect_features
+
+        def counting_detect(img, max_features=5000, orb=None):
+            calls.append(img.shape)
+            return detect(img, max_features, orb)
+
+        monkeypatch.setattr(helper, 'detect_features', counting_detect)
+        img = (np.random.default_rng(1).random((64, 64)) * 255).astype(np.uint8)
+        cache = helper.FeatureCache(500)
+
+        first = cache.features(0, img)
+        assert cache.features(0, img) is first
+        edges = cache.edges(0, img)
+        assert cache.edges(0, img) is edges
+        cache.edge_features(0, img)
+        cache.edge_features(0, img)
+        assert len(calls) == 2
+
+        cache.invalidate(0)
+        assert cache.features(0, img) is not first
+        assert len(calls) == 3
+
+
+class TestCli:
+
+    @pytest.fixture
+    def template_path(self, tmp_path):
+        path = tmp_path / 'template.yml'
+        path.write_text('- method: inverse\n  kwargs: {}\n')
+        return str(path)
+
+    @pytest.fixture
+    def input_paths(self, tmp_path):
+        paths = []
+        for i in range(3):
+            dc = DataCube(cube=np.random.rand(4, 5, 6), wavelengths=[400, 410, 420, 430], name=f'cube{i}', notation='nm')
+            path = str(tmp_path / f'cube{i}.nrrd')
+            _loader.nrrd._write_nrrd(dc, path)
+            paths.append(path)
+        return paths
+
+    def test_parse_memory(self):
+        from wizard._utils import cli
+        assert cli.parse_memory('512') == 512
+        assert cli.parse_memory('2K') == 2048
+        assert cli.parse_memory('1.5GB') == int(1.5 * 1024 ** 3)
+        for value in ['', 'G', '-1M', '12X']:
+            with pytest.raises(ValueError):
+                cli.parse_memory(value)
+
+    def test_expand_inputs(self, tmp_path, input_paths):
+        from wizard._utils import cli
+        assert cli.expand_inputs([str(tmp_path / '*.nrrd')]) == sorted(input_paths)
+        with pytest.raises(FileNotFoundError):
+            cli.expand_inputs([str(tmp_path / '*.csv')])
+
+    def test_write_registry(self, sample_data_cube, tmp_path):
+        path = str(tmp_path / 'out.nrrd')
+        wizard.write(sample_data_cube, path)
+        np.testing.assert_array_almost_equal(wizard.read(path).cube, sample_data_cube.cube)
+        with pytest.raises(NotImplementedError):
+            wizard.write(sample_data_cube, str(tmp_path / 'out.unknown'))
+
+    @pytest.mark.parametrize('jobs, budget', [(1, None), (2, '1K')])
+    def test_main_processes_all_inputs(self, tmp_path, template_path, input_paths, capsys, jobs, budget):
+        from wizard._utils import cli
+        out_dir = tmp_path / 'out'
+        argv = [template_path, str(tmp_path / '*.nrrd'), '-o', str(out_dir), '-f', 'nrrd', '-j', str(jobs)]
+        if budget:
+            argv += ['-m', budget]
+
+        assert cli.main(argv) == 0
+
+        for path in input_paths:
+            expected = DataCube(cube=_loader.nrrd._read_nrrd(path).cube.copy())
+            expected.inverse()
+            result = _loader.nrrd._read_nrrd(str(out_dir / os.path.basename(path)))
+            np.testing.assert_array_almost_equal(result.cube, expected.cube)
+        assert '3/3 inputs processed' in capsys.readouterr().out
+
+    def test_output_paths_mirror_inputs(self, tmp_path):
+        from wizard._utils import cli
+        inputs = [str(tmp_path / 'a' / 'scan.fsm'), str(tmp_path / 'b' / 'scan.fsm')]
+        assert cli.output_paths(inputs, 'out', 'nrrd') == [os.path.join('out', 'a', 'scan.nrrd'),
+                                                            os.path.join('out', 'b', 'scan.nrrd')]
+        assert cli.output_paths(inputs[:1], 'out', 'nrrd') == [os.path.join('out', 'scan.nrrd')]
+        with pytest.raises(ValueError, match='scan.nrrd'):
+            cli.output_paths([str(tmp_path / 'scan.fsm'), str(tmp_path / 'scan.hdr')], 'out', 'nrrd')
+
+    def test_main_keeps_inputs_with_the_same_name_apart(self, tmp_path, template_path, input_paths):
+        from wizard._utils import cli
+        for folder in ('a', 'b'):
+            (tmp_path / folder).mkdir()
+            os.replace(input_paths.pop(), str(tmp_path / folder / 'cube.nrrd'))
+        out_dir = tmp_path / 'out'
+        assert cli.main([template_path, str(tmp_path / '*' / 'cube.nrrd'), '-o', str(out_dir)]) == 0
+        assert (out_dir / 'a' / 'cube.nrrd').exists() and (out_dir / 'b' / 'cube.nrrd').exists()
+
+    def test_main_rejects_colliding_outputs(self, tmp_path, template_path, input_paths):
+        from wizard._utils import cli
+        os.replace(input_paths[0], str(tmp_path / 'cube1.hdr'))
+        with pytest.raises(SystemExit):
+            cli.main([template_path, str(tmp_path / 'cube1.*'), '-o', str(tmp_path / 'out')])
+        assert not (tmp_path / 'out').exists()
+
+    def test_main_reports_failures(self, tmp_path, input_paths, capsys):
+        from wizard._utils import cli
+        template = tmp_path / 'bad.yml'
+        template.write_text('- method: does_not_exist\n  kwargs: {}\n')
+        assert cli.main([str(template), input_paths[0], '-o', str(tmp_path / 'out')]) == 1
+        assert 'AttributeError' in capsys.readouterr().out
+
+
+class TestProfiler:
+
+    @pytest.fixture(autouse=True)
+    def reset_profiler(self):
+        yield
+        wizard.profiler.stop_profiling()
+        wizard.profiler.clear_records()
+
+    def test_records_dynamic_methods(self, sample_data_cube):
+        with wizard.profiler.profiling() as records:
+            sample_data_cube.inverse()
+            sample_data_cube.resize(x_new=5, y_new=6)
+            sample_data_cube.set_name('not profiled')
+
+        assert [r['method'] for r in records] == ['inverse', 'resize']
+        inverse, resize = records
+        assert inverse['input_shape'] == (10, 11, 12)
+        assert resize['output_shape'] == (10, 5, 6)
+        assert inverse['wall'] >= 0 and inverse['cpu'] >= 0
+        # inverse allocates at least one float64 copy of the cube
+        assert inverse['peak_bytes'] >= 10 * 11 * 12 * 8
+        assert wizard.profiler.get_records('resize') == [resize]
+
+    def test_disabled_by_default(self, sample_data_cube):
+        sample_data_cube.inverse()
+        assert not wizard.profiler.is_profiling()
+        assert wizard.profiler.get_records() == []
+
+    def test_failed_call_is_recorded(self, sample_data_cube):
+        with wizard.profiler.profiling():
+            with pytest.raises(ValueError):
+                sample_data_cube.uniform_filter_dc(size=0)
+        record, = wizard.profiler.get_records()
+        assert record['error'].startswith('ValueError')
+
+    def test_summary_and_json(self, sample_data_cube, tmp_path):
+        with wizard.profiler.profiling():
+            sample_data_cube.inverse()
+            sample_data_cube.inverse()
+            sample_data_cube.normalize()
+
+        stats = wizard.profiler.summary()
+        assert stats['inverse']['calls'] == 2
+        assert sum(s['share'] for s in stats.values()) == pytest.approx(1)
+
+        path = tmp_path / 'profile.json'
+        wizard.profiler.to_json(str(path))
+        data = json.loads(path.read_text())
+        assert len(data['records']) == 3
+        assert set(data['summary']) == {'inverse', 'normalize'}
+
+    def test_lazy_stages_are_profiled(self, sample_data_cube):
+        with wizard.profiler.profiling():
+            sample_data_cube.start_lazy()
+            sample_data_cube.inverse().normalize()
+            sample_data_cube.stop_lazy()
+        assert [r['method'] for r in wizard.profiler.get_records()] == ['fused(inverse+normalize)']
+
+
+class TestConfig:
+
+    def test_context_restores_previous_values(self):
+        before = wizard.get_config()
+        with wizard.config_context(n_jobs=2, backend='processes', memory_budget='1M') as active:
+            assert active['n_jobs'] == 2
+            assert active['memory_budget'] == 1024 ** 2
+            assert config.joblib_kwargs() == {'n_jobs': 2, 'prefer': 'processes'}
+        assert wizard.get_config() == before
+
+    def test_invalid_values(self):
+        with pytest.raises(KeyError):
+            wizard.set_config(workers=2)
+        with pytest.raises(ValueError):
+            wizard.set_config(backend='gpu')
+        with pytest.raises(ValueError):
+            wizard.set_config(n_jobs=0)
+        with pytest.raises(ValueError):
+            wizard.set_config(blas_threads=0)
+
+    def test_compute_dtype(self):
+        assert config.compute_dtype() == np.float32
+        assert generate_pattern_stack(2, 8, 8).dtype == np.float32
+        with wizard.config_context(compute_dtype=np.float64):
+            assert generate_pattern_stack(2, 8, 8).dtype == np.float64
+        with pytest.raises(ValueError):
+            wizard.set_config(compute_dtype='int16')
+
+    def test_thread_caps(self):
+        import cv2
+        from threadpoolctl import threadpool_info
+        with wizard.config_context(blas_threads=1, cv2_threads=1):
+            assert cv2.getNumThreads() == 1
+            assert all(pool['num_threads'] == 1 for pool in threadpool_info())
+
+    def test_resolve_n_jobs(self):
+        with wizard.config_context(n_jobs=-1):
+            assert config.resolve_n_jobs() >= 1
+            assert config.resolve_n_jobs(3) == 3
+        with wizard.config_context(n_jobs=4):
+            assert config.resolve_n_jobs() == 4
+            assert config.native_thread_limit() == 4
+
+    def test_worker_config_splits_cores(self):
+        with wizard.config_context(n_jobs=8, memory_budget='8M'):
+            settings = config.worker_config(4)
+        assert settings['n_jobs'] == 8
+        assert settings['blas_threads'] == 2
+        assert settings['memory_budget'] == 2 * 1024 ** 2
+
+    def test_environment_variables(self, monkeypatch):
+        before = wizard.get_config()
+        monkeypatch.setenv('WIZARD_N_JOBS', '3')
+        monkeypatch.setenv('WIZARD_MEMORY_BUDGET', '2G')
+        try:
+            config._from_env()
+            assert wizard.get_config()['n_jobs'] == 3
+            assert wizard.get_config()['memory_budget'] == 2 * 1024 ** 3
+        finally:
+            wizard.set_config(**before)
+
+    def test_operations_follow_config(self, sample_data_cube):
+        expected = sample_data_cube.cube.copy()
+        with wizard.config_context(n_jobs=1, backend='threads'):
+            sample_data_cube.remove_spikes(threshold=10, window=3)
+        np.testing.assert_allclose(sample_data_cube.cube, expected)
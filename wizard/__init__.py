@@ -19,7 +19,9 @@ This module imports essential submodules and classes/functions, including:
 
 - `DataCube` from the `_core.datacube` module
 - `plotter` from the `_exploration.plotter` module
-- `read` from the `_utils._loader` module
+- `read` and `write` from the `_utils._loader` module
+- `profiler` from the `_utils` package
+- `get_config`, `set_config` and `config_context` from the `_utils.config` module
 
 :no-index:
 """
@@ -29,7 +31,9 @@ from ._core.datacube import DataCube
 from ._exploration.plotter import plotter
 from ._exploration.surface import plot_surface
 from ._exploration.faces import plot_datacube_faces
-from ._utils._loader import read
+from ._utils._loader import read, write
+from ._utils import profiler
+from ._utils.config import get_config, set_config, config_context
 from ._processing.cluster import isodata, smooth_kmeans
 
 #  Define what should be accessible when using 'from wizard import *'
@@ -0,0 +1,17 @@
+"""
+__main__.py
+===========
+
+.. module:: __main__
+   :platform: Unix
+   :synopsis: Allow running the `wizard` command with `python -m wizard`.
+
+:no-index:
+"""
+
+import sys
+
+from ._utils.cli import main
+
+if __name__ == '__main__':
+    sys.exit(main())
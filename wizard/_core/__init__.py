@@ -23,7 +23,7 @@ Functions
 
 """
 
-import multiprocessing
+import inspect
 from functools import wraps
 
 from .datacube import DataCube
@@ -37,7 +37,11 @@ def func_as_method(func):
     Converts a standalone function into a method that can be dynamically attached to a class.
 
     This function ensures that the method retains the original function's name and signature
-    by using the `wraps` decorator.
+    by using the `wraps` decorator. If the function declares a preferred memory layout
+    (see `wizard._utils.decorators.prefers_layout`), the cube is converted to it first,
+    unless the result goes to the current cube or a given array (``inplace=True`` or
+    `out`); converting would allocate a copy of the cube, so the operation then runs
+    on the current layout.
 
     Parameters
     ----------
@@ -49,8 +53,15 @@ def func_as_method(func):
     function
         The wrapped function as a method, with a flag indicating it is dynamic.
     """
+    layout = getattr(func, '__layout__', None)
+    signature = inspect.signature(func) if layout is not None else None
+
     @wraps(func)
     def method(self, *args, **kwargs):
+        if layout is not None and self.cube is not None:
+            arguments = signature.bind_partial(self, *args, **kwargs).arguments
+            if not arguments.get('inplace') and arguments.get('out') is None:
+                self.set_layout(layout)
         return func(self, *args, **kwargs)
 
     # Mark the function as dynamic for tracking purposes
@@ -69,8 +80,9 @@ def attach_datacube_operations():
     the `DataCube` class. Each method is wrapped with the `TrackExecutionMeta.record_method`
     decorator to enable execution tracking.
 
-    This operation is only performed once, controlled by the `_dynamic_methods_attached` flag,
-    and only in the main process to avoid issues in multiprocessing contexts.
+    This operation is only performed once per process, controlled by the `_dynamic_methods_attached`
+    flag. It also runs in child processes, so DataCubes handed to spawned workers (e.g. by the
+    `wizard` command-line tool) have the full set of operations.
 
     Notes
     -----
@@ -84,15 +96,13 @@ def attach_datacube_operations():
     from . import datacube_ops  # prevent circular import errors
     global _dynamic_methods_attached
     if not _dynamic_methods_attached:
-        # Ensure we're in the main process, not a child process
-        if multiprocessing.current_process().name == "MainProcess":
-            for name in dir(datacube_ops):
-                func = getattr(datacube_ops, name)
-                if callable(func):
-                    # Wrap the method with the tracking decorator before attaching
-                    wrapped_func = TrackExecutionMeta.record_method(func_as_method(func))
-                    setattr(DataCube, name, wrapped_func)  # Attach the wrapped function
-            _dynamic_methods_attached = True  # Set flag after the first call
+        for name in dir(datacube_ops):
+            func = getattr(datacube_ops, name)
+            if callable(func):
+                # Wrap the method with the tracking decorator before attaching
+                wrapped_func = TrackExecutionMeta.record_method(func_as_method(func))
+                setattr(DataCube, name, wrapped_func)  # Attach the wrapped function
+        _dynamic_methods_attached = True  # Set flag after the first call
 
 
 # Attach methods to the DataCube class on import
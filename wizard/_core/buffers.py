@@ -0,0 +1,107 @@
+"""
+_core/buffers.py
+================
+
+.. module:: buffers
+   :platform: Unix
+   :synopsis: Output buffers of DataCube operations.
+
+Module Overview
+---------------
+
+Every operation in `datacube_ops` replaces the cube of the DataCube it is called on and
+accepts two arguments that control where its result is written:
+
+- ``inplace=False`` (default): the result is written into a newly allocated array. The
+  previous cube array is left unchanged, so other references to it (views, shared
+  memory of other processes, the caller's own array) keep their values.
+- ``inplace=True``: the result is written into the current cube array. No array of the
+  size of the cube is allocated for the result. Only possible if the result has the
+  shape and dtype of the cube and the cube is writable.
+- ``out=array``: the result is written into `array`, which then becomes the cube, e.g. a
+  preallocated or memory-mapped array. It must have the shape of the result and a dtype
+  the result can be cast to, and must not overlap the cube.
+
+The helpers below implement these rules for the operations.
+
+Functions
+---------
+
+.. autofunction:: result_buffer
+.. autofunction:: store_result
+
+"""
+
+import numpy as np
+
+
+def result_buffer(dc, shape: tuple, dtype, inplace: bool = False, out: np.ndarray = None,
+                  op: str = 'operation') -> np.ndarray:
+    """
+    Return the array an operation writes its result into.
+
+    Parameters
+    ----------
+    dc : DataCube
+        The DataCube the operation runs on.
+    shape : tuple
+        Shape of the result.
+    dtype : numpy.dtype
+        Data type of the result.
+    inplace : bool, optional
+        Write into the cube of `dc`. Default is False.
+    out : np.ndarray, optional
+        Write into this array.
+    op : str, optional
+        Name of the operation, used in error messages.
+
+    Returns
+    -------
+    np.ndarray
+        The cube of `dc`, `out`, or a new uninitialized array. A new array of the
+        shape of the cube has the memory layout of the cube.
+
+    Raises
+    ------
+    ValueError
+        If both `inplace` and `out` are given, or the result does not fit the
+        requested buffer.
+    """
+    dtype = np.dtype(dtype)
+    if out is not None:
+        if inplace:
+            raise ValueError(f'`{op}`: use either `inplace` or `out`, not both.')
+        if out.shape != tuple(shape):
+            raise ValueError(f'`{op}`: `out` has shape {out.shape}, the result has shape {tuple(shape)}.')
+        if not np.can_cast(dtype, out.dtype, casting='same_kind'):
+            raise ValueError(f'`{op}`: the {dtype} result can not be stored in an `out` array of {out.dtype}.')
+        return out
+    if inplace:
+        cube = dc.cube
+        if cube.shape != tuple(shape) or cube.dtype != dtype:
+            raise ValueError(f'`{op}` can not run in place: the result is {dtype} with shape {tuple(shape)}, '
+                             f'the cube is {cube.dtype} with shape {cube.shape}. Use `out` or `inplace=False`.')
+        if not cube.flags.writeable:
+            raise ValueError(f'`{op}` can not run in place on a read-only cube.')
+        return cube
+    if dc.cube is not None and dc.cube.shape == tuple(shape):
+        # keep the memory layout of the cube, see `wizard._core.layout`
+        return np.empty_like(dc.cube, dtype=dtype, subok=False)
+    return np.empty(shape, dtype=dtype)
+
+
+def store_result(dc, result: np.ndarray) -> None:
+    """
+    Make the array returned by `result_buffer` the cube of `dc`.
+
+    Parameters
+    ----------
+    dc : DataCube
+        The DataCube the operation runs on.
+    result : np.ndarray
+        The filled result buffer.
+    """
+    if result is dc.cube:
+        dc.invalidate_caches()
+    else:
+        dc.set_cube(result)
@@ -35,6 +35,7 @@ Here is an example of how to use this module:
 """
 
 import inspect
+import logging
 import warnings
 
 from rich import print
@@ -42,7 +43,41 @@ import numpy as np
 import yaml
 # from traitlets import ValidateHandler
 
+from wizard._utils import checkpoint, profiler
 from wizard._utils.tracker import TrackExecutionMeta
+from wizard._core import fusion, iterators
+from wizard._core.layout import get_layout, to_layout
+from wizard._core.stats import BandStats
+from wizard._core.wavelengths import WavelengthIndex
+
+logger = logging.getLogger(__name__)
+
+
+def _as_slice(index, size: int, name: str, ranges: bool = True) -> slice:
+    """
+    Convert a band or pixel selection into a slice, so indexing returns a view.
+
+    With `ranges`, a 2-tuple is read as ``(start, stop)``; otherwise every sequence is
+    a list of indices.
+    """
+    if index is None:
+        return slice(None)
+    if isinstance(index, slice):
+        return index
+    if isinstance(index, (int, np.integer)):
+        index = int(index) % size
+        return slice(index, index + 1)
+    if ranges and isinstance(index, tuple) and len(index) == 2:
+        return slice(*index)
+
+    index = np.asarray(index, dtype=int)
+    if index.size == 0:
+        return slice(0, 0)
+    index = index % size
+    step = int(index[1] - index[0]) if index.size > 1 else 1
+    if step < 1 or np.any(np.diff(index) != step):
+        raise ValueError(f'`{name}` must be evenly spaced and ascending to be viewed without copying.')
+    return slice(int(index[0]), int(index[-1]) + 1, step)
 
 
 class DataCube(metaclass=TrackExecutionMeta):
@@ -104,6 +139,11 @@ class DataCube(metaclass=TrackExecutionMeta):
         registered: bool optional
             If True images are allready registered. Default is False
         """
+        self._graph = None  # pending operations while the dc is lazy
+        self._shared = None  # handle of the shared memory backing the cube
+        self._stats = None  # cached per-band statistics, dropped when the cube changes
+        self._wavelength_index = None  # sorted wavelengths, rebuilt when they are replaced
+        self._layouts = {}  # cube converted to other memory layouts, dropped when the cube changes
         self.name = name  # name of the dc
         self.shape = None if cube is None else cube.shape  # shape of the dc
         self.dim = None  # get dimension of the dc 2d, 3d, 4d ...
@@ -113,11 +153,145 @@ class DataCube(metaclass=TrackExecutionMeta):
         self.cube = None if cube is None else cube
         self.notation = notation
         self.registered = registered
+        self.transforms = None  # per-band registration transforms, see `wizard._processing.registration`
 
         self.record = record
         if self.record:
             self.start_recording()
 
+    @property
+    def cube(self):
+        """
+        The data of the `DataCube` as a 3D numpy array of shape (v, x, y).
+
+        If the `DataCube` is lazy, pending operations are executed before the
+        data is returned.
+        """
+        if self._graph:
+            self.compute()
+        return self._cube
+
+    @cube.setter
+    def cube(self, cube) -> None:
+        self._cube = cube
+        self._shared = None  # a new cube is no longer backed by shared memory
+        self._stats = None
+        self._layouts = {}
+
+    @property
+    def layout(self) -> str:
+        """
+        Memory layout of the cube, ``'bsq'`` (bands contiguous) or ``'bip'`` (spectra contiguous).
+
+        The logical shape is (v, x, y) in both layouts. None if the `DataCube` is empty
+        or the cube is not contiguous. See `wizard._core.layout`.
+        """
+        return None if self.cube is None else get_layout(self.cube)
+
+    def as_layout(self, layout: str) -> np.ndarray:
+        """
+        Return the cube in a memory layout without changing the `DataCube`.
+
+        The converted cube is cached until the cube changes, so repeated calls convert
+        only once. The cache holds a second copy of the cube for the lifetime of the
+        `DataCube`; use `wizard._core.layout.to_layout` for a one-off read.
+
+        Parameters
+        ----------
+        layout : str
+            ``'bsq'`` or ``'bip'``.
+
+        Returns
+        -------
+        np.ndarray
+            Cube of shape (v, x, y) in the requested layout. Treat it as read-only.
+        """
+        cube = self.cube
+        if get_layout(cube) == layout:
+            return cube
+        if layout not in self._layouts:
+            self._layouts[layout] = to_layout(cube, layout)
+        return self._layouts[layout]
+
+    def set_layout(self, layout: str):
+        """
+        Convert the cube to a memory layout.
+
+        Operations declare their preferred layout (see
+        `wizard._utils.decorators.prefers_layout`) and call this before they run, so a
+        sequence of spectral operations converts the cube only once. A cube in shared
+        memory is no longer shared after a conversion.
+
+        Parameters
+        ----------
+        layout : str
+            ``'bsq'`` or ``'bip'``.
+
+        Returns
+        -------
+        DataCube
+            The `DataCube` itself.
+        """
+        cube = self.as_layout(layout)
+        if cube is not self._cube:
+            stats = self._stats
+            self.cube = cube
+            if stats is not None:
+                # same values in another layout, the statistics stay valid
+                stats._cube = cube
+                self._stats = stats
+        return self
+
+    @property
+    def stats(self) -> BandStats:
+        """
+        Cached per-band statistics of the cube.
+
+        Minimum, maximum, mean and standard deviation are computed together on first
+        access; percentiles and histograms on request. The cache is dropped when the
+        cube is replaced or written through indexing (``dc[idx] = value``). Writes to
+        the array itself (``dc.cube[idx] = value``) are not tracked; call
+        `invalidate_caches` after those. See `wizard._core.stats.BandStats`.
+
+        Returns
+        -------
+        BandStats
+            Statistics of the current cube.
+        """
+        cube = self.cube
+        if self._stats is None or self._stats._cube is not cube:
+            self._stats = BandStats(cube)
+        return self._stats
+
+    @property
+    def wavelength_index(self) -> WavelengthIndex:
+        """
+        Sorted index of the wavelengths for O(log n) wavelength to band lookups.
+
+        The index is rebuilt when `wavelengths` is replaced. See
+        `wizard._core.wavelengths.WavelengthIndex`.
+
+        Returns
+        -------
+        WavelengthIndex
+            Index of the current wavelengths.
+        """
+        index = self._wavelength_index
+        if index is None or index.wavelengths is not self.wavelengths:
+            index = self._wavelength_index = WavelengthIndex(self.wavelengths)
+        return index
+
+    def invalidate_caches(self) -> None:
+        """
+        Drop cached statistics and converted layouts of the cube.
+
+        Call this after writing to the cube array directly (``dc.cube[idx] = value``).
+        Replacing the cube, indexing assignments on the `DataCube` and operations called
+        with ``inplace=True`` do this automatically.
+        """
+        self._stats = None
+        self._layouts = {}
+
     def __add__(self, other):
         """
         Add two `DataCube` instances.
@@ -190,7 +364,9 @@ class DataCube(metaclass=TrackExecutionMeta):
         np.ndarray
             Selected item from the data cube.
         """
-        return self.cube[idx]
+        if self._graph:
+            self.compute()
+        return self._cube[idx]
 
     def __setitem__(self, idx, value) -> None:
         """
@@ -203,39 +379,138 @@ class DataCube(metaclass=TrackExecutionMeta):
         value : np.ndarray
             Value to be set at the given index.
         """
-        self.cube[idx] = value
+        if self._graph:
+            self.compute()
+        self._cube[idx] = value
+        self.invalidate_caches()
 
-    def __iter__(self):
+    def view(self, bands=None, wavelengths: tuple = None, x=None, y=None):
         """
-        Return an iterator for the data cube.
+        Return a sub-cube that shares the data of this `DataCube`.
+
+        The returned `DataCube` is a view: no data is copied, and writes to its cube
+        are visible in this `DataCube` and vice versa. Its wavelengths and registration
+        transforms are sliced accordingly; name, notation and registration state are kept.
+
+        Parameters
+        ----------
+        bands : int | slice | sequence of int, optional
+            Band indices to keep. A sequence (list or tuple) is a list of indices and
+            must be evenly spaced and ascending to be viewed without copying; other
+            sequences raise a `ValueError`. Use a `slice` for a range of bands.
+        wavelengths : tuple, optional
+            Inclusive ``(low, high)`` wavelength range to keep. Can not be combined with
+            `bands`. The kept bands must be contiguous in the cube.
+        x : slice | tuple, optional
+            Window along x as `slice` or ``(start, stop)``.
+        y : slice | tuple, optional
+            Window along y as `slice` or ``(start, stop)``.
 
         Returns
         -------
         DataCube
-            Iterator for the data cube.
+            The sub-cube, with a cube of shape (v', x', y').
+
+        Raises
+        ------
+        ValueError
+            If the `DataCube` is empty, both `bands` and `wavelengths` are given, or
+            the selected bands can not be expressed as a slice.
+
+        Examples
+        --------
+        >>> roi = dc.view(wavelengths=(700, 900), x=(100, 200), y=(300, 400))
+        >>> roi.normalize()  # works on a copy, `dc` stays unchanged
+        """
+        cube = self.cube
+        if cube is None:
+            raise ValueError('Can not take a view of an empty DataCube.')
+        if bands is not None and wavelengths is not None:
+            raise ValueError('Use either `bands` or `wavelengths`, not both.')
+
+        if wavelengths is not None:
+            bands = self.wavelength_index.to_slice(*wavelengths)
+        bands = _as_slice(bands, cube.shape[0], 'bands', ranges=False)
+        x = _as_slice(x, cube.shape[1], 'x')
+        y = _as_slice(y, cube.shape[2], 'y')
+
+        sub = cube[bands, x, y]
+        sub_wavelengths = None if self.wavelengths is None else self.wavelengths[bands].copy()
+        view = DataCube(sub, wavelengths=sub_wavelengths, name=self.name,
+                        notation=self.notation, registered=self.registered)
+        if self.transforms is not None:
+            view.transforms = self.transforms.view(bands, x, y)
+        return view
+
+    def __iter__(self):
         """
-        self.idx = 0
-        return self
+        Return a new iterator over the layers of the data cube.
+
+        Every call returns an independent iterator, so nested loops and loops in
+        several threads over the same `DataCube` do not interfere.
+
+        Returns
+        -------
+        CubeIterator
+            Iterator yielding the layers of shape (x, y).
+        """
+        return iterators.iter_layers(self.cube)
 
-    def __next__(self):
+    def iter_bands(self, batch_size: int = 1):
         """
-        Return the next item in the data cube during iteration.
+        Iterate over groups of bands.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            Number of bands per group. Default is 1.
 
         Returns
         -------
-        tuple
-            Next cube layer and corresponding wavelength.
+        CubeIterator
+            Thread-safe iterator yielding ``(bands, block)`` with the band `slice` and
+            a view of shape (n_bands, x, y).
 
-        Raises
-        ------
-        StopIteration
-            If no more items are available in the data cube.
+        Examples
+        --------
+        >>> for bands, block in dc.iter_bands(16):
+        ...     dc[bands] = block / block.max(axis=(1, 2), keepdims=True)
         """
-        if self.idx >= len(self.cube):
-            raise StopIteration
-        else:
-            self.idx += 1
-            return self.cube[self.idx - 1]
+        return iterators.iter_bands(self.cube, batch_size)
+
+    def iter_tiles(self, tile_size: int = 256):
+        """
+        Iterate over spatial tiles with all bands.
+
+        Parameters
+        ----------
+        tile_size : int, optional
+            Edge length of the tiles; tiles at the border can be smaller. Default is 256.
+
+        Returns
+        -------
+        CubeIterator
+            Thread-safe iterator yielding ``((rows, cols), block)`` with the `slice` of
+            the tile along x and y and a view of shape (v, n_rows, n_cols).
+        """
+        return iterators.iter_tiles(self.cube, tile_size)
+
+    def iter_pixels(self, batch_size: int = 4096):
+        """
+        Iterate over blocks of pixel spectra.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            Number of pixels per block. Default is 4096.
+
+        Returns
+        -------
+        CubeIterator
+            Thread-safe iterator yielding ``(pixels, spectra)`` with the `slice` of the
+            row-major pixel numbers and a C-contiguous array of shape (n_pixels, v).
+        """
+        return iterators.iter_pixels(self.cube, batch_size)
 
     def __str__(self) -> str:
         """
@@ -397,6 +672,104 @@ class DataCube(metaclass=TrackExecutionMeta):
         self.record = False
         TrackExecutionMeta.stop_recording()
 
+    def __getstate__(self) -> dict:
+        """Pickle the `DataCube`; a shared cube is sent by the name of its shared memory."""
+        state = self.__dict__.copy()
+        state['_stats'] = None
+        state['_layouts'] = {}
+        if state.get('_shared') is not None:
+            state['_cube'] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """Restore a pickled `DataCube` and attach to its shared memory if it has one."""
+        state.setdefault('_graph', None)
+        state.setdefault('_shared', None)
+        state.setdefault('_stats', None)
+        state.setdefault('_wavelength_index', None)
+        state.setdefault('_layouts', {})
+        self.__dict__.update(state)
+        if self._shared is not None:
+            self._cube = self._shared.array()
+
+    def share(self, backend: str = 'shm', path: str = None):
+        """
+        Move the cube into shared memory so worker processes can use it without copying.
+
+        The cube of the `DataCube` is replaced by a view of the shared memory. When the
+        `DataCube` is pickled, e.g. as argument of a `ProcessPoolExecutor` task, only the
+        name of the shared memory is sent and the worker attaches to it zero-copy. Writes
+        to the cube are visible in all processes. See `wizard._core.shared.SharedDataCube`.
+
+        Parameters
+        ----------
+        backend : str, optional
+            ``'shm'`` (default) for `multiprocessing.shared_memory`, or ``'mmap'`` for a
+            memory-mapped ``.npy`` file at `path`.
+        path : str, optional
+            Path of the ``.npy`` file for the ``'mmap'`` backend.
+
+        Returns
+        -------
+        SharedDataCube
+            Handle of the shared memory. Use it as context manager, or call its `unlink`
+            method, to free the memory when all workers are done; the `DataCube` then
+            keeps a private copy of the cube.
+        """
+        from wizard._core.shared import SharedDataCube  # prevent circular import errors
+
+        handle = SharedDataCube.create(self, backend=backend, path=path)
+        self.cube = handle.array()
+        self._shared = handle
+        handle.bind(self)
+        return handle
+
+    @property
+    def lazy(self) -> bool:
+        """Whether calls to dynamic methods are deferred instead of executed."""
+        return self._graph is not None
+
+    def start_lazy(self) -> None:
+        """
+        Start deferring dynamic method calls of the `DataCube`.
+
+        While lazy, calls such as `dc.inverse()` or `dc.normalize()` are appended to an
+        operation graph and return immediately. The graph is executed when the data is
+        accessed through `cube` or when `compute` is called. Consecutive element-wise
+        and per-band spatial operations are fused into single passes over the data,
+        so no full-size intermediate cube is written between them.
+
+        Notes
+        -----
+        Attributes such as `shape` and `wavelengths` describe the last computed state
+        until the pending operations are executed.
+        """
+        if self._graph is None:
+            self._graph = fusion.OperationGraph()
+
+    def stop_lazy(self) -> None:
+        """Execute all pending operations and return to eager execution."""
+        self.compute()
+        self._graph = None
+
+    def compute(self, block_bytes: int = None):
+        """
+        Execute all pending operations of a lazy `DataCube`.
+
+        Parameters
+        ----------
+        block_bytes : int, optional
+            Target size in bytes of the blocks of bands processed by fused operations.
+
+        Returns
+        -------
+        DataCube
+            The `DataCube` itself, with all pending operations applied.
+        """
+        if self._graph is not None and len(self._graph):
+            self._graph.execute(self, block_bytes=block_bytes)
+        return self
+
     def save_template(self, filename) -> None:
         """
         Save a template of recorded methods to a YAML file.
@@ -474,15 +847,19 @@ class DataCube(metaclass=TrackExecutionMeta):
         cleaned_data = []
 
         for method_name, args, kwargs in recorded_methods:
-            # Clean out DataCube instances from the arguments
-            cleaned_args = [arg for arg in args if not isinstance(arg, DataCube)]
-
             # Get the actual function object from the DataCube class
             func = getattr(DataCube, method_name, None)
 
             if func is not None:
-                # Map positional args to kwargs using cleaned args
-                full_kwargs = self._map_args_to_kwargs(func, cleaned_args, kwargs)
+                # Map positional args to kwargs, then clean out required DataCube arguments
+                # (the DataCube itself, the second cube of `merge_cubes`); replaying without
+                # them fails, while a dropped optional one would silently change the result
+                full_kwargs = self._map_args_to_kwargs(func, args, kwargs)
+                params = inspect.signature(func).parameters
+                required = {key for key, param in params.items() if param.default is inspect.Parameter.empty}
+                full_kwargs = {key: self._template_value(method_name, key, value)
+                               for key, value in full_kwargs.items()
+                               if not (isinstance(value, DataCube) and key in required)}
             else:
                 print(f"Warning: Method {method_name} not found in DataCube.")
                 full_kwargs = kwargs
@@ -496,20 +873,104 @@ class DataCube(metaclass=TrackExecutionMeta):
 
         return cleaned_data
 
-    def execute_template(self, filename) -> None:
+    @staticmethod
+    def _template_value(method_name, key, value):
+        """
+        Convert a recorded argument into a value that can be stored in a YAML template.
+
+        Parameters
+        ----------
+        method_name : str
+            Name of the recorded method, used in error messages.
+        key : str
+            Name of the argument, used in error messages.
+        value : object
+            The recorded value.
+
+        Returns
+        -------
+        object
+            `value`, with arrays converted to nested lists, also inside lists and tuples.
+
+        Raises
+        ------
+        ValueError
+            If `value` is or contains a DataCube, which can not be stored in a template.
+        """
+        if isinstance(value, DataCube):
+            raise ValueError(f'`{method_name}`: the DataCube passed as `{key}` can not be stored in a template. '
+                             f'Pass its file path or an array instead.')
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, (list, tuple)):
+            return type(value)(DataCube._template_value(method_name, key, item) for item in value)
+        return value
+
+    def execute_template(self, filename, checkpoint_dir: str = None, tile_size: int = None,
+                         n_jobs: int = None, out: np.ndarray = None) -> None:
         """
         Load a template and execute the corresponding methods.
 
+        Templates that consist only of spatially local steps (see
+        `wizard._core.fusion.TILEABLE_OPS`, e.g. `remove_spikes`, `inverse`, `normalize`
+        and `uniform_filter_dc`) are detected and run per spatial tile if `tile_size` is
+        given or the cube is memory-mapped (e.g. read with ``wizard.read(path, mmap=True)``).
+        Together with a memory-mapped `out`, the whole cube is then never held in memory.
+
         Parameters
         ----------
         filename : str
             Name of the YAML file containing the template.
+        checkpoint_dir : str, optional
+            Directory for step checkpoints. If given, the state of the `DataCube` is saved
+            after every step, keyed by the input data and the template steps up to that
+            step. A rerun on the same input resumes after the last step with a valid
+            checkpoint, so a failed or edited later step does not recompute earlier ones.
+            Tiled runs only checkpoint the final step. Default is None (no checkpoints).
+        tile_size : int, optional
+            Edge length of the spatial tiles for tiled execution. Default is None, which
+            tiles with a size chosen by `wizard._core.fusion.run_tiled` if the cube is
+            memory-mapped and runs the steps on the whole cube otherwise.
+        n_jobs : int, optional
+            Number of threads processing tiles in tiled execution. Default is None, the
+            configured number of workers (see `wizard._utils.config`).
+        out : np.ndarray, optional
+            Array that receives the result of a tiled execution, e.g. a `np.memmap` of the
+            cube's shape. Default is None (a new in-memory array).
 
         """
         with open(filename, 'rb') as template_file:
             template_data = yaml.safe_load(template_file)
 
-        for i in range(len(template_data)):
+        start = 0
+        if checkpoint_dir is not None:
+            keys = checkpoint.step_keys(self, template_data)
+            for i in reversed(range(len(keys))):
+                if checkpoint.load_checkpoint(self, checkpoint_dir, keys[i]):
+                    start = i + 1
+                    logger.info('Resuming template after step %d/%d from checkpoint.', start, len(keys))
+                    break
+
+        steps = template_data[start:]
+        if fusion.is_tileable([step['method'] for step in steps]) and \
+                (tile_size is not None or fusion.is_memory_mapped(self.cube)):
+            nodes = [{'name': step['method'], 'func': getattr(DataCube, step['method']),
+                      'args': (), 'kwargs': step['kwargs']} for step in steps]
+            kwargs = {'tile_size': tile_size, 'n_jobs': n_jobs, 'out': out}
+            if profiler.is_profiling():
+                name = 'tiled(' + '+'.join(node['name'] for node in nodes) + ')'
+                profiler.profile_call(name, fusion.run_tiled, self, nodes, **kwargs)
+            else:
+                fusion.run_tiled(self, nodes, **kwargs)
+            if checkpoint_dir is not None:
+                checkpoint.save_checkpoint(self, checkpoint_dir, keys[-1], step=len(keys) - 1,
+                                           method=template_data[-1]['method'])
+            return
+
+        for i in range(start, len(template_data)):
             method = getattr(self, template_data[i]['method'])
             kwargs = template_data[i]['kwargs']
             method(**kwargs)
+            if checkpoint_dir is not None:
+                checkpoint.save_checkpoint(self, checkpoint_dir, keys[i], step=i,
+                                           method=template_data[i]['method'])
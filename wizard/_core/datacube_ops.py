@@ -20,17 +20,20 @@ import random
 import numpy as np
 from PIL import Image
 from joblib import Parallel, delayed
+from concurrent import futures
 from scipy.signal import savgol_filter
-from scipy.ndimage import gaussian_filter, uniform_filter
-from skimage.transform import warp
 
 
-from . import DataCube 
+from . import DataCube, buffers, fusion, layout
+from .._processing import calibration, filters, flatfield, registration
 from .._processing.spectral import calculate_modified_z_score, spec_baseline_als
-from .._utils.helper import _process_slice, feature_registration, RegistrationError, auto_canny, decompose_homography, normalize_polarity
+from .._utils import config, decorators, helper
+from .._utils.helper import _process_slice, feature_registration, RegistrationError, decompose_homography
 
 
-def remove_spikes(dc: DataCube, threshold: int = 6500, window: int = 5) -> DataCube:
+@decorators.prefers_layout('bip')
+def remove_spikes(dc: DataCube, threshold: int = 6500, window: int = 5, inplace: bool = False,
+                  out: np.ndarray = None) -> DataCube:
     """
     Remove cosmic spikes from each pixel's spectral data.
 
@@ -46,6 +49,11 @@ def remove_spikes(dc: DataCube, threshold: int = 6500, window: int = 5) -> DataC
         Threshold for spike detection via modified z-score, defaults to 6500.
     window : int, optional
         Window size (in spectral channels) for mean replacement of spikes, defaults to 5.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -59,9 +67,11 @@ def remove_spikes(dc: DataCube, threshold: int = 6500, window: int = 5) -> DataC
 
     Notes
     -----
-    - The original DataCube is not modified in place; es wird eine Kopie zurückgegeben.
     - Die Modifizierte z-Score-Berechnung erwartet Input mit Form (n_samples, n_features).
     - Parallelisierung beschleunigt die Einzelpixel-Bearbeitung.
+    - Memory: the z-scores take one array of the size of the cube plus a boolean
+      mask; the result takes another unless `inplace` or `out` is used. Only
+      spectra with spikes are processed and copied.
 
     Examples
     --------
@@ -74,32 +84,33 @@ def remove_spikes(dc: DataCube, threshold: int = 6500, window: int = 5) -> DataC
         raise ValueError(f"window must be between 1 and {v}, got {window}")
 
     # reshape to (n_pixels, v)
-    n_pixels = x * y
-    flat_cube = dc.cube.reshape(v, n_pixels).T  # shape: (n_pixels, v)
+    cube = dc.cube
+    flat_cube = cube.reshape(v, x * y).T  # shape: (n_pixels, v)
 
     # Berechne pro-pixel modifizierten z-score
     z_scores = calculate_modified_z_score(flat_cube)  # (n_pixels, v)
-    spikes = np.abs(z_scores) > threshold
-    flat_out = flat_cube.copy()
-
-    # Parallel auf jedes Pixel anwenden
-    results = Parallel(n_jobs=-1)(
-        delayed(_process_slice)(flat_out, spikes, idx, window)
-        for idx in range(n_pixels)
+    np.abs(z_scores, out=z_scores)
+    spikes = z_scores > threshold
+    del z_scores
+
+    # Parallel auf jedes Pixel mit Spikes anwenden, alle anderen bleiben unverändert
+    results = Parallel(**config.joblib_kwargs())(
+        delayed(_process_slice)(flat_cube, spikes, idx, window)
+        for idx in np.flatnonzero(spikes.any(axis=1))
     )
-    for idx, spec in results:
-        flat_out[idx] = spec
 
-    # zurück in (v, x, y) formen
-    clean_cube = flat_out.T.reshape(v, x, y)
-
-    # Kopie des DataCube mit dem bereinigten Cube
+    target = buffers.result_buffer(dc, cube.shape, cube.dtype, inplace, out, 'remove_spikes')
+    if target is not cube:
+        target[...] = cube
+    for idx, spec in results:
+        target[:, idx // y, idx % y] = spec
 
-    dc.set_cube(clean_cube)
+    buffers.store_result(dc, target)
     return dc
 
 
-def remove_background(dc: DataCube, threshold: int = 50, style: str = 'dark') -> DataCube:
+def remove_background(dc: DataCube, threshold: int = 50, style: str = 'dark', inplace: bool = False,
+                      out: np.ndarray = None) -> DataCube:
     """
     Remove background from images in a DataCube.
 
@@ -118,6 +129,11 @@ def remove_background(dc: DataCube, threshold: int = 50, style: str = 'dark') ->
         Style of background removal, 'dark' or 'bright', defaults to 'dark'.
         If 'dark', background pixels are set to 0.
         If 'bright', background pixels are set to the max value of the cube.y
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -129,6 +145,10 @@ def remove_background(dc: DataCube, threshold: int = 50, style: str = 'dark') ->
     ValueError
         If style is not 'dark' or 'bright'.
 
+    Notes
+    -----
+    Memory: one array of the size of the cube for the result, none with `inplace`.
+
     Examples
     --------
     >>> import wizard
@@ -136,29 +156,38 @@ def remove_background(dc: DataCube, threshold: int = 50, style: str = 'dark') ->
     >>> dc.remove_background(threshold=50, style='bright') # or style 'dark'
     """
     img = dc.cube[0]
-    img = ((img - img.min()) / (img.max() - img.min()) * 255).astype('uint8')
+    low, high = img.min(), img.max()
+    img = ((img - low) / (high - low) * 255).astype('uint8')
     img = Image.fromarray(img)
     img_removed_bg = rembg.remove(img)
     mask = np.array(img_removed_bg.getchannel('A'))
 
-    cube = dc.cube.copy()
     if style == 'dark':
-        cube[:, mask < threshold] = 0
+        value = 0
     elif style == 'bright':
-        cube[:, mask < threshold] = dc.cube.max()
+        value = dc.cube.max()
     else:
         raise ValueError("Type must be 'dark' or 'bright'")
-    dc.set_cube(cube)
+
+    cube = dc.cube
+    target = buffers.result_buffer(dc, cube.shape, cube.dtype, inplace, out, 'remove_background')
+    if target is not cube:
+        target[...] = cube
+    target[:, mask < threshold] = value
+    buffers.store_result(dc, target)
     return dc
 
 
-def resize(dc: DataCube, x_new: int, y_new: int, interpolation: str = 'linear') -> None:
+def resize(dc: DataCube, x_new: int, y_new: int, interpolation: str = 'linear', pyramid: bool = False,
+           batch_size: int = None, n_jobs: int = None, inplace: bool = False, out: np.ndarray = None) -> None:
     """
     Resize the DataCube to new x and y dimensions.
     dc.shape is v,x,y
 
-    Resizes each 2D slice (x, y) of the DataCube using the specified
-    interpolation method.
+    Resizes the 2D slices (x, y) of the DataCube using the specified
+    interpolation method. The bands are split into batches that are resized
+    on several threads. A band-interleaved cube (see `wizard._core.layout`)
+    is resized with one multi-channel `cv2.resize` call per batch.
 
     Interpolation methods:
         * ``linear``: Bilinear interpolation (ideal for enlarging).
@@ -178,6 +207,19 @@ def resize(dc: DataCube, x_new: int, y_new: int, interpolation: str = 'linear')
     interpolation : str, optional
         Interpolation method, defaults to 'linear'.
         Options: 'linear', 'nearest', 'area', 'cubic', 'lanczos'.
+    pyramid : bool, optional
+        For reductions by more than a factor of 2, first halve the bands with
+        area interpolation until the remaining factor is at most 2. Faster and
+        less aliased for large reductions, defaults to False.
+    batch_size : int, optional
+        Number of bands per batch, at most 128. Defaults to splitting the bands
+        evenly across the threads.
+    n_jobs : int, optional
+        Number of threads, defaults to the configured ``n_jobs``.
+    inplace : bool, optional
+        Not supported, the result has a different shape than the cube.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -189,6 +231,13 @@ def resize(dc: DataCube, x_new: int, y_new: int, interpolation: str = 'linear')
     ValueError
         If the interpolation method is not recognized.
 
+    Notes
+    -----
+    The resized cube keeps the dtype of the input. Dtypes OpenCV can not
+    interpolate (e.g. int32) are resized in the compute dtype and rounded back.
+    Memory: one array of the resized shape for the result (or `out`); for a
+    band-interleaved cube also one contiguous copy of every batch in flight.
+
     Examples
     --------
     >>> import wizard
@@ -215,14 +264,50 @@ def resize(dc: DataCube, x_new: int, y_new: int, interpolation: str = 'linear')
     else:
         raise ValueError(f'Interpolation method `{interpolation}` not recognized.')
 
-    _cube = np.empty(shape=(shape[0], x_new, y_new))
-    for idx, layer in enumerate(dc.cube):
-        _cube[idx] = cv2.resize(layer, (y_new, x_new), interpolation=mode)
-    dc.cube = _cube
-    dc._set_cube_shape()
+    cube = dc.cube
+    dtype = cube.dtype
+    _cube = buffers.result_buffer(dc, (shape[0], x_new, y_new), dtype, inplace, out, 'resize')
+
+    n_jobs = config.resolve_n_jobs(n_jobs)
+    if batch_size is None:
+        batch_size = -(-shape[0] // n_jobs)
+    batch_size = max(1, min(batch_size, helper.CV2_MAX_CHANNELS))
+    # band-interleaved cubes are resized as multi-channel images, a batch of a band
+    # sequential cube band by band, as the channel-last copy would cost more than the resize
+    interleaved = layout.get_layout(cube) == layout.BIP
+
+    def to_dtype(resized):
+        if np.issubdtype(dtype, np.integer) and resized.dtype != dtype:
+            info = np.iinfo(dtype)
+            resized = np.clip(np.rint(resized), info.min, info.max)
+        return resized
+
+    def resize_batch(start):
+        batch = cube[start:start + batch_size]
+        if dtype not in helper.CV2_RESIZE_DTYPES:
+            batch = batch.astype(config.compute_dtype())
+        if interleaved:
+            batch = np.ascontiguousarray(batch.transpose(1, 2, 0))
+            resized = helper.resize_image(batch, (y_new, x_new), mode, pyramid=pyramid)
+            _cube[start:start + batch_size] = to_dtype(resized).transpose(2, 0, 1)
+        else:
+            for i, layer in enumerate(batch, start):
+                _cube[i] = to_dtype(helper.resize_image(layer, (y_new, x_new), mode, pyramid=pyramid))
+
+    starts = range(0, shape[0], batch_size)
+    if n_jobs == 1 or len(starts) == 1:
+        for start in starts:
+            resize_batch(start)
+    else:
+        # cv2 releases the GIL, so threads resize batches in parallel on the shared cube
+        with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(resize_batch, starts))
+    buffers.store_result(dc, _cube)
 
 
-def baseline_als(dc: DataCube, lam: float = 1000000, p: float = 0.01, niter: int = 10) -> DataCube:
+@decorators.prefers_layout('bip')
+def baseline_als(dc: DataCube, lam: float = 1000000, p: float = 0.01, niter: int = 10, inplace: bool = False,
+                 out: np.ndarray = None) -> DataCube:
     """
     Apply Adaptive Smoothness (ALS) baseline correction.
 
@@ -242,30 +327,39 @@ def baseline_als(dc: DataCube, lam: float = 1000000, p: float = 0.01, niter: int
         towards the data (0 for minimal, 1 for maximal).
     niter : int, optional
         The number of iterations for the ALS algorithm, defaults to 10.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
     DataCube
         The DataCube with baseline correction applied.
 
+    Notes
+    -----
+    Memory: one array of the size of the cube for the result, none with `inplace`.
+
     Examples
     --------
     >>> import wizard
     >>> dc = wizard.read("example.fsm")
     >>> dc.baseline_als(lam=1e6, p=.001, niter=10)
     """
-    for x in range(dc.shape[1]):
-        for y in range(dc.shape[2]):
-            dc.cube[:, x, y] -= spec_baseline_als(
-                spectrum=dc.cube[:, x, y],
-                lam=lam,
-                p=p,
-                niter=niter
-            )
+    cube = dc.cube
+    v, x, y = cube.shape
+    spectra = cube.reshape(v, -1).T  # (x*y, v), contiguous spectra in the 'bip' layout
+    target = buffers.result_buffer(dc, cube.shape, cube.dtype, inplace, out, 'baseline_als')
+    for i, spectrum in enumerate(spectra):
+        target[:, i // y, i % y] = spectrum - spec_baseline_als(spectrum=spectrum, lam=lam, p=p, niter=niter)
+    buffers.store_result(dc, target)
     return dc
 
 
-def merge_cubes(dc1: DataCube, dc2: DataCube, register: bool = False) -> DataCube:
+def merge_cubes(dc1: DataCube, dc2: DataCube, register: bool = False, inplace: bool = False,
+                out: np.ndarray = None) -> DataCube:
     """
     Merge two DataCubes into a single DataCube, with optional registration.
 
@@ -283,6 +377,10 @@ def merge_cubes(dc1: DataCube, dc2: DataCube, register: bool = False) -> DataCub
         The second DataCube to be merged into the first.
     register : bool, optional
         If True (default), registration will be attempted if both cubes are marked as registered.
+    inplace : bool, optional
+        Not supported, the result has a different shape than the cube.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -295,6 +393,14 @@ def merge_cubes(dc1: DataCube, dc2: DataCube, register: bool = False) -> DataCub
         If the cubes have mismatched spatial dimensions and cannot be merged,
         or if wavelengths overlap without being purely indices.
 
+    Notes
+    -----
+    Memory: one array for the merged cube. `dc2` is not modified, registered
+    layers of `dc2` are written into the merged cube.
+
+    With registration, `dc1.transforms` maps the bands of both cubes onto the merged
+    cube, see `apply_transforms`; otherwise it is None.
+
     Examples
     --------
     >>> import wizard
@@ -307,10 +413,21 @@ def merge_cubes(dc1: DataCube, dc2: DataCube, register: bool = False) -> DataCub
     wave1 = dc1.wavelengths
     wave2 = dc2.wavelengths
 
+    # Spatial size check
+    if c1.shape[1:] != c2.shape[1:]:
+        raise NotImplementedError(
+            'Sorry - this function can only merge cubes with the same spatial dimensions.'
+        )
+    c3 = buffers.result_buffer(dc1, (c1.shape[0] + c2.shape[0],) + c1.shape[1:], np.result_type(c1, c2),
+                               inplace, out, 'merge_cubes')
+    np.concatenate([c1, c2], axis=0, out=c3)
+
     # Optional registration step with sampling
+    merged_transforms = None
     if register and getattr(dc1, 'registered', False) and getattr(dc2, 'registered', False):
         print("Both datacubes registered. Sampling layers for alignment...")
         ref_img = c1[0]
+        ref_features = helper.detect_features(ref_img)
         num_layers = c2.shape[0]
         sample_indices = random.sample(range(num_layers), min(10, num_layers))
 
@@ -319,7 +436,7 @@ def merge_cubes(dc1: DataCube, dc2: DataCube, register: bool = False) -> DataCub
         # Try to register sampled layers and pick best
         for idx in sample_indices:
             try:
-                aligned_slice, transform = feature_registration(ref_img, c2[idx])
+                aligned_slice, transform = feature_registration(ref_img, c2[idx], o_features=ref_features)
                 # Compute alignment quality (mean squared error)
                 mse = np.mean((ref_img - aligned_slice)**2)
                 if mse < best_score:
@@ -329,23 +446,18 @@ def merge_cubes(dc1: DataCube, dc2: DataCube, register: bool = False) -> DataCub
                 print(f"Registration of sampled layer {idx} failed: {e}")
 
         if best_transform is not None:
-            # Apply best transform to all layers of dc2
-            for i in range(num_layers):
-                try:
-                    c2[i] = warp(c2[i], inverse_map=best_transform.inverse, preserve_range=True)
-                except Exception as e:
-                    print(f"Failed to apply best transform to layer {i}: {e}")
+            # Apply best transform to all layers of dc2 in one pass
+            transforms = registration.TransformSet(np.repeat(best_transform[None], num_layers, axis=0), c2.shape[1:])
+            transforms.apply(c2, out=c3[c1.shape[0]:])
+            # map the raw bands of both cubes onto the merged cube
+            first = registration.TransformSet.identity(c1.shape[0], c1.shape[1:]).compose(dc1.transforms)
+            second = transforms.compose(dc2.transforms)
+            merged_transforms = registration.TransformSet(
+                np.concatenate([first.homographies, second.homographies]), c1.shape[1:], method='merge_cubes'
+            )
         else:
             print("No successful sampled registration. Skipping registration.")
 
-    # Spatial size check
-    if c1.shape[1:] == c2.shape[1:]:
-        c3 = np.concatenate([c1, c2], axis=0)
-    else:
-        raise NotImplementedError(
-            'Sorry - this function can only merge cubes with the same spatial dimensions.'
-        )
-
     # Handle wavelength merge
     if set(wave1) & set(wave2):
         # If wavelengths are index-based, just concatenate indices
@@ -359,54 +471,59 @@ def merge_cubes(dc1: DataCube, dc2: DataCube, register: bool = False) -> DataCub
         wave3 = np.concatenate((wave1, wave2))
 
     # Create new merged DataCube (modify dc1 in-place)
-    dc1.set_cube(c3)
+    buffers.store_result(dc1, c3)
     dc1.set_wavelengths(wave3)
+    dc1.transforms = merged_transforms
 
     return dc1
 
 
-def inverse(dc: DataCube) -> DataCube:
+def inverse(dc: DataCube, inplace: bool = False, out: np.ndarray = None) -> DataCube:
     """
     Invert the DataCube values.
 
     This operation is useful for converting between transmission and
     reflectance data, or similar inversions. The formula applied is:
-    `tmp = cube * -1`
-    `tmp += -tmp.min()`
-    The data type of the cube is preserved if it's 'uint16' or 'uint8'
-    after temporary conversion to 'float16' for calculation.
+    `cube.max() - cube`
+    The data type of the cube is preserved.
 
     Parameters
     ----------
     dc : DataCube
         The DataCube to invert.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
     DataCube
         The DataCube with inverted values.
 
+    Notes
+    -----
+    Memory: one array of the size of the cube for the result, none with `inplace`.
+
     Examples
     --------
     >>> import wizard
     >>> dc = wizard.read('example.fsm')
     >>> dc.inverse()
     """
-    dtype = dc.cube.dtype
-    if dtype == np.uint16 or dtype == np.uint8:  # Use np types for comparison
-        cube = dc.cube.astype(np.float32)
-    else:
-        cube = dc.cube.copy()
-
-    tmp = cube
-    tmp *= -1
-    tmp += -tmp.min()
-
-    dc.set_cube(tmp.astype(dtype))
+    cube = dc.cube
+    target = buffers.result_buffer(dc, cube.shape, cube.dtype, inplace, out, 'inverse')
+    # max - cube is exact in the dtype of the cube, also for unsigned integers
+    np.subtract(cube.max(), cube, out=target)
+    buffers.store_result(dc, target)
     return dc
 
 
-def register_layers_simple(dc: DataCube, max_features: int = 5000, match_percent: float = 0.1) -> DataCube:
+@decorators.prefers_layout('bsq')
+def register_layers_simple(dc: DataCube, max_features: int = 5000, match_percent: float = 0.1,
+                           method: str = 'feature', n_jobs: int = None, inplace: bool = False,
+                           out: np.ndarray = None) -> DataCube:
     """
     Align images within a DataCube using simple feature-based registration.
 
@@ -422,38 +539,89 @@ def register_layers_simple(dc: DataCube, max_features: int = 5000, match_percent
     match_percent : float, optional
         Percentage of keypoint matches to consider for homography,
         defaults to 0.1 (10%).
+    method : str, optional
+        ``'feature'`` for ORB features and a homography, ``'phase'`` for FFT phase
+        correlation, which estimates a sub-pixel translation and falls back to the
+        features for layers with a low correlation response. Defaults to ``'feature'``.
+    n_jobs : int, optional
+        Number of threads featurizing and aligning layers, defaults to the configured
+        ``n_jobs``.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
     DataCube
         The DataCube with layers registered.
 
+    Raises
+    ------
+    ValueError
+        If the method is unknown.
+
+    Notes
+    -----
+    Memory: one array of the size of the cube for the result, none with `inplace`.
+    The layers only depend on the first one, so they are featurized and aligned in
+    parallel; the result does not depend on `n_jobs`.
+
+    The homographies are kept in `dc.transforms`, see `apply_transforms`; layers that
+    could not be registered keep the identity.
+
     Examples
     --------
     >>> import wizard
     >>> dc = wizard.read('example.fsm')
     >>> dc.register_layers_simple()
     """
-    o_img = dc.cube[0, :, :]
-    for i in range(dc.cube.shape[0]):
-        if i > 0:
-            a_img = copy.deepcopy(dc.cube[i, :, :])
-            try:
-                _, h = feature_registration(
-                    o_img=o_img, a_img=a_img,
-                    max_features=max_features, match_percent=match_percent
-                )
-                height, width = o_img.shape
-                aligned_img = cv2.warpPerspective(a_img, h, (width, height))
-                dc.cube[i, :, :] = aligned_img
-            except RegistrationError as e:
-                print(f"Warning: Could not register layer {i} in simple registration: {e}")
-                pass
+    if method not in registration.METHODS:
+        raise ValueError(f'Unknown method `{method}`, use one of {registration.METHODS}.')
+    cube = dc.cube
+    target = buffers.result_buffer(dc, cube.shape, cube.dtype, inplace, out, 'register_layers_simple')
+    if target is not cube:
+        target[...] = cube
+    o_img = cube[0, :, :]
+    features = helper.FeatureCache(max_features)
+    if method == 'feature':
+        features.prefetch(range(cube.shape[0]), cube, n_jobs)
+    homographies = np.repeat(np.eye(3)[None], cube.shape[0], axis=0)
+    failed = []
+
+    def align(i):
+        a_img = copy.deepcopy(cube[i, :, :])
+        try:
+            _, h = registration.register_pair(
+                o_img, a_img, method, max_features=max_features, match_percent=match_percent,
+                cache=features, keys=(0, i)
+            )
+            height, width = o_img.shape
+            aligned_img = cv2.warpPerspective(a_img, h, (width, height))
+            target[i, :, :] = aligned_img
+            homographies[i] = h
+        except RegistrationError as e:
+            print(f"Warning: Could not register layer {i} in simple registration: {e}")
+            failed.append(i)
+
+    n_jobs = min(config.resolve_n_jobs(n_jobs), max(cube.shape[0] - 1, 1))
+    if n_jobs == 1:
+        for i in range(1, cube.shape[0]):
+            align(i)
+    else:
+        with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(align, range(1, cube.shape[0])))
+    buffers.store_result(dc, target)
     dc.registered = True
+    dc.transforms = registration.TransformSet(
+        homographies, cube.shape[1:], wavelengths=dc.wavelengths, method=method, reference=0, failed=sorted(failed)
+    ).compose(dc.transforms)
     return dc
 
 
-def remove_vignetting_poly(dc: DataCube, axis: int = 1, slice_params: dict = None) -> DataCube:
+def remove_vignetting_poly(dc: DataCube, axis: int = 1, slice_params: dict = None, inplace: bool = False,
+                           out: np.ndarray = None) -> DataCube:
     """
     Remove vignetting using polynomial fitting along a specified axis.
 
@@ -461,6 +629,8 @@ def remove_vignetting_poly(dc: DataCube, axis: int = 1, slice_params: dict = Non
     for each spectral layer, fits a polynomial to this mean profile
     (after Savitzky-Golay smoothing), and subtracts this fitted profile
     from the corresponding rows/columns of the layer to correct for vignetting.
+    The profiles of all layers are smoothed together and subtracted by
+    broadcasting.
 
     Parameters
     ----------
@@ -474,17 +644,27 @@ def remove_vignetting_poly(dc: DataCube, axis: int = 1, slice_params: dict = Non
         Dictionary for slicing behavior before mean calculation.
         Keys: ``"start"`` (int), ``"end"`` (int), ``"step"`` (int).
         Defaults to full slice with step 1.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
     DataCube
-        The processed DataCube with vignetting removed.
+        The processed DataCube with vignetting removed, in the compute dtype.
 
     Raises
     ------
     ValueError
         If the DataCube is empty or axis is not 1 or 2.
 
+    Notes
+    -----
+    Memory: one array of the size of the cube in the compute dtype for the result;
+    none with `inplace`, which needs a cube of the compute dtype.
+
     Examples
     --------
     >>> import wizard
@@ -508,22 +688,25 @@ def remove_vignetting_poly(dc: DataCube, axis: int = 1, slice_params: dict = Non
     else:
         raise ValueError('Axis can only be 1 or 2.')
 
-    corrected_cube = dc.cube.copy().astype(np.float32)
-
-    for i, layer_profile in enumerate(summed_data):
-        smoothed_layer_profile = savgol_filter(layer_profile, window_length=71, polyorder=1)
-        if axis == 1:
-            for j_col in range(dc.cube.shape[2]):
-                corrected_cube[i, :, j_col] -= smoothed_layer_profile
-        elif axis == 2:
-            for j_row in range(dc.cube.shape[1]):
-                corrected_cube[i, j_row, :] -= smoothed_layer_profile
+    cube = dc.cube
+    corrected_cube = buffers.result_buffer(dc, cube.shape, config.compute_dtype(), inplace, out,
+                                           'remove_vignetting_poly')
+    if corrected_cube is not cube:
+        corrected_cube[...] = cube
+
+    # one filter for all bands: the Savitzky-Golay coefficients are the least-squares
+    # solution on a single Vandermonde matrix shared by every profile
+    smoothed_profiles = savgol_filter(summed_data, window_length=71, polyorder=1, axis=1)
+    if axis == 1:
+        corrected_cube -= smoothed_profiles[:, :, None]
+    else:
+        corrected_cube -= smoothed_profiles[:, None, :]
 
-    dc.set_cube(corrected_cube)
+    buffers.store_result(dc, corrected_cube)
     return dc
 
 
-def normalize(dc: DataCube) -> DataCube:
+def normalize(dc: DataCube, inplace: bool = False, out: np.ndarray = None) -> DataCube:
     """
     Normalize spectral information in the data cube to the range [0, 1].
 
@@ -536,11 +719,21 @@ def normalize(dc: DataCube) -> DataCube:
     ----------
     dc : DataCube
         The DataCube instance to normalize.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
     DataCube
-        The normalized DataCube.
+        The normalized DataCube, in the compute dtype.
+
+    Notes
+    -----
+    Memory: one array of the size of the cube in the compute dtype for the result;
+    none with `inplace`, which needs a cube of the compute dtype.
 
     Examples
     --------
@@ -548,25 +741,35 @@ def normalize(dc: DataCube) -> DataCube:
     >>> dc = wizard.read('example.fsm')
     >>> dc.normalize()
     """
-    cube = dc.cube.astype(np.float32)
-    min_vals = cube.min(axis=(1, 2), keepdims=True)
-    max_vals = cube.max(axis=(1, 2), keepdims=True)
+    dtype = config.compute_dtype()
+    cube = dc.cube
+    # computed from the cube itself, the cached statistics miss writes into the array
+    min_vals = cube.min(axis=(1, 2)).astype(dtype)[:, None, None]
+    max_vals = cube.max(axis=(1, 2)).astype(dtype)[:, None, None]
 
     range_vals = max_vals - min_vals
     range_vals[range_vals == 0] = 1
 
-    cube = (cube - min_vals) / range_vals
-    dc.set_cube(cube)
+    target = buffers.result_buffer(dc, cube.shape, dtype, inplace, out, 'normalize')
+    np.subtract(cube, min_vals, out=target, dtype=dtype)
+    np.divide(target, range_vals, out=target)
+    buffers.store_result(dc, target)
     return dc
 
 
+@decorators.prefers_layout('bsq')
 def register_layers_best(
         dc: DataCube,
         ref_layer: int = 0,
         max_features: int = 5000,
         match_percent: float = 0.1,
         rot_thresh: float = 20.0,
-        scale_thresh: float = 1.1
+        scale_thresh: float = 1.1,
+        method: str = 'feature',
+        wave_size: int = None,
+        n_jobs: int = None,
+        inplace: bool = False,
+        out: np.ndarray = None
 ) -> DataCube:
     """
     Align DataCube layers with robust registration.
@@ -593,6 +796,23 @@ def register_layers_best(
     scale_thresh : float, optional
         Scale threshold for homography validation, defaults to 1.1.
         Checks if max_scale <= scale_thresh and min_scale >= 1/scale_thresh.
+    method : str, optional
+        ``'feature'`` for ORB features and a homography, ``'phase'`` for FFT phase
+        correlation, which estimates a sub-pixel translation and falls back to the
+        features for pairs with a low correlation response. Defaults to ``'feature'``.
+    wave_size : int, optional
+        Number of layers matched in parallel against the layers aligned so far, see
+        `wizard._processing.registration`. 1 aligns the layers one after another.
+        Defaults to `wizard._processing.registration.WAVE_SIZE`, independent of
+        `n_jobs`, so the result is the same on every machine.
+    n_jobs : int, optional
+        Number of threads aligning the layers of a wave, defaults to the configured
+        ``n_jobs``. Does not change the result.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -601,35 +821,60 @@ def register_layers_best(
 
     Raises
     ------
+    ValueError
+        If the method is unknown.
     RuntimeError
         If alignment fails for a layer after retry.
 
+    Notes
+    -----
+    Memory: one array of the size of the cube for the result, none with `inplace`.
+    Layers are aligned against already aligned layers of the result. Until a wave is
+    written, every layer in it holds its aligned image and, if it falls back to edge
+    registration, its edge map, i.e. about three layers per layer of the wave.
+
+    The ORB features and edge maps of every layer are computed once per call and
+    reused for all pairs the layer takes part in, see `wizard._utils.helper.FeatureCache`.
+    The entries of a layer are dropped when its aligned version is written.
+
+    With the feature method, all layers are featurized on threads first. The layers are then aligned in waves
+    of `wave_size` layers, each matched on a thread against the layers aligned before
+    the wave; the layers that fail are retried once the same way.
+
+    The homographies are kept in `dc.transforms`, see `apply_transforms`.
+
     Examples
     --------
     >>> import wizard
     >>> dc = wizard.read('example.fsm')
     >>> dc.register_layers_best()
     """
+    if method not in registration.METHODS:
+        raise ValueError(f'Unknown method `{method}`, use one of {registration.METHODS}.')
     aligned_indices = {ref_layer}
-    waitlist = set()
     n_layers, H_dim, W_dim = dc.cube.shape
+    cube = buffers.result_buffer(dc, dc.cube.shape, dc.cube.dtype, inplace, out, 'register_layers_best')
+    if cube is not dc.cube:
+        cube[...] = dc.cube
+
+    features = helper.FeatureCache(max_features)
 
-    def try_align(layer_idx: int, current_aligned_indices: set) -> bool:
-        # nonlocal dc
-        a_img = dc.cube[layer_idx]
-        best_alignment_img = None
+    def try_align(layer_idx: int, current_aligned_indices: set) -> tuple:
+        a_img = cube[layer_idx]
+        best_alignment_img = best_h = None
 
         for ref_idx in current_aligned_indices:
             try:
-                o_img = dc.cube[ref_idx]
-                aligned_img_feat, H_ij = feature_registration(
-                    o_img, a_img, max_features, match_percent
+                o_img = cube[ref_idx]
+                aligned_img_feat, H_ij = registration.register_pair(
+                    o_img, a_img, method, max_features, match_percent,
+                    cache=features, keys=(ref_idx, layer_idx)
                 )
                 angle, S = decompose_homography(H_ij)
                 s_ok = (S.max() <= scale_thresh and S.min() >= 1 / scale_thresh)
                 if abs(angle) <= rot_thresh and s_ok:
                     print(f"[Layer {layer_idx}] aligned to {ref_idx}: θ={angle:.1f}°, S={S.round(3)}")
-                    best_alignment_img = aligned_img_feat
+                    best_alignment_img, best_h = aligned_img_feat, H_ij
                     break
                 else:
                     print(f"[Layer {layer_idx}] reject vs {ref_idx}: θ={angle:.1f}°, S={S.round(3)}")
@@ -639,16 +884,16 @@ def register_layers_best(
         if best_alignment_img is None:
             print(f"[Layer {layer_idx}] edge-map fallback to reference layer {ref_layer}")
             try:
-                ref_img_for_edge = normalize_polarity(dc.cube[ref_layer])
-                tgt_img_for_edge = normalize_polarity(a_img)
-                edges_ref = auto_canny(ref_img_for_edge)
-                edges_tgt = auto_canny(tgt_img_for_edge)
+                edges_ref = features.edges(ref_layer, cube[ref_layer])
+                edges_tgt = features.edges(layer_idx, a_img)
                 aligned_img_edge, H_e = feature_registration(
-                    edges_ref.astype(float), edges_tgt.astype(float),
-                    max_features, match_percent
+                    edges_ref, edges_tgt, max_features, match_percent,
+                    o_features=features.edge_features(ref_layer, cube[ref_layer]),
+                    a_features=features.edge_features(layer_idx, a_img)
                 )
                 h_orig, w_orig = a_img.shape
                 best_alignment_img = cv2.warpPerspective(a_img, H_e, (w_orig, h_orig), flags=cv2.INTER_LINEAR)
+                best_h = H_e
                 angle_e, S_e = decompose_homography(H_e)
                 print(f"[Layer {layer_idx}] edges (vs layer {ref_layer}): θ={angle_e:.1f}°, S={S_e.round(3)}")
             except RegistrationError as e:
@@ -656,38 +901,47 @@ def register_layers_best(
             except Exception as e:
                 print(f"[Layer {layer_idx}] unexpected error in edge registration: {e}")
 
-        if best_alignment_img is not None:
-            dc.cube[layer_idx] = best_alignment_img
-            return True
-        return False
+        return None if best_alignment_img is None else (best_alignment_img, best_h)
 
-    for i in range(n_layers):
-        if i == ref_layer:
-            continue
-        if try_align(i, aligned_indices.copy()):
-            aligned_indices.add(i)
-        else:
-            waitlist.add(i)
+    def commit(layer_idx: int, result: tuple) -> None:
+        cube[layer_idx], homographies[layer_idx] = result
+        features.invalidate(layer_idx)
+
+    def prepare(layers: list) -> None:
+        features.prefetch(layers, cube, n_jobs)
+
+    homographies = np.repeat(np.eye(3)[None], n_layers, axis=0)
+    if method == 'feature':
+        features.prefetch(range(n_layers), cube, n_jobs)
+    waves = dict(align=try_align, commit=commit, wave_size=wave_size, n_jobs=n_jobs,
+                 prepare=prepare if method == 'feature' else None)
+    pending = [i for i in range(n_layers) if i != ref_layer]
+    waitlist = registration.align_in_waves(pending, aligned_indices, **waves)
 
     if waitlist:
-        print(f"\nRetrying layers: {list(waitlist)}\n")
-        for i in list(waitlist):
-            if try_align(i, aligned_indices.copy()):
-                aligned_indices.add(i)
-                waitlist.remove(i)
-            else:
-                raise RuntimeError(f"Layer {i}: alignment failed after retry.")
+        print(f"\nRetrying layers: {waitlist}\n")
+        failed = registration.align_in_waves(waitlist, aligned_indices, **waves)
+        if failed:
+            raise RuntimeError(f"Layer {failed[0]}: alignment failed after retry.")
+    buffers.store_result(dc, cube)
     dc.registered = True
+    dc.transforms = registration.TransformSet(
+        homographies, cube.shape[1:], wavelengths=dc.wavelengths, method=method, reference=ref_layer
+    ).compose(dc.transforms)
     return dc
 
 
-def remove_vignetting(dc: DataCube, sigma: float = 50, clip: bool = True, epsilon: float = 1e-6) -> DataCube:
+@decorators.prefers_layout('bsq')
+def remove_vignetting(dc: DataCube, sigma: float = 50, clip: bool = True, epsilon: float = 1e-6, method: str = 'auto',
+                      shared: bool = False, n_jobs: int = None, inplace: bool = False, out: np.ndarray = None) -> DataCube:
     """
     Remove vignetting from a hyperspectral DataCube.
 
     Corrects vignetting in each spectral band by estimating a smooth
     background using Gaussian blur and then performing flat-field correction.
-    The background is normalized by its mean before correction.
+    The background is normalized by its mean before correction. For large
+    sigmas the blur is computed on a downsampled band, see
+    `wizard._processing.flatfield`.
 
     Parameters
     ----------
@@ -703,6 +957,21 @@ def remove_vignetting(dc: DataCube, sigma: float = 50, clip: bool = True, epsilo
     epsilon : float, optional
         A small constant to add to the background before division
         to prevent division by zero errors. Defaults to 1e-6.
+    method : str, optional
+        Blur method: ``'auto'``, ``'direct'``, ``'downsample'`` or ``'fft'``.
+        ``'auto'`` blurs small sigmas directly and downsamples for large ones.
+        Defaults to ``'auto'``.
+    shared : bool, optional
+        Estimate one background from the mean of all bands and use it for every
+        band. Defaults to False.
+    n_jobs : int, optional
+        Number of threads correcting bands in parallel, defaults to the configured
+        ``n_jobs``.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -710,36 +979,53 @@ def remove_vignetting(dc: DataCube, sigma: float = 50, clip: bool = True, epsilo
         The DataCube with vignetting corrected. The output cube has the
         same shape and dtype as the input.
 
+    Notes
+    -----
+    Memory: one array of the size of the cube for the result, none with `inplace`,
+    plus a few bands in the compute dtype per thread.
+
     Examples
     --------
     >>> import wizard
     >>> dc = wizard.read('example.fsm')
     >>> dc.remove_vignetting()
     """
-    corrected_cube = np.empty_like(dc.cube)
+    corrected_cube = buffers.result_buffer(dc, dc.cube.shape, dc.cube.dtype, inplace, out, 'remove_vignetting')
     orig_dtype = dc.cube.dtype
     is_int = np.issubdtype(orig_dtype, np.integer)
+    dtype = config.compute_dtype()
+    cube = dc.cube
+    shared_flat = flatfield.estimate_flat_field(cube, sigma, method, shared=True, epsilon=epsilon,
+                                                n_jobs=n_jobs)[0] if shared else None
 
-    for i in range(dc.cube.shape[0]):
-        band = dc.cube[i].astype(np.float64)
-        background = gaussian_filter(band, sigma=sigma)
-        background = np.maximum(background, epsilon)
-        background_mean = background.mean()
-        if background_mean > epsilon:
-            background /= background_mean
+    def correct_band(i):
+        band = cube[i].astype(dtype)
+        if shared_flat is None:
+            flat = flatfield.estimate_flat_field(band[None], sigma, method, epsilon=epsilon, n_jobs=1)[0]
         else:
-            background = np.ones_like(background, dtype=np.float64)
-        corrected_band = band / background
+            flat = shared_flat
+        corrected_band = np.divide(band, flat, out=band)
         if is_int:
             info = np.iinfo(orig_dtype)
             corrected_band = np.round(corrected_band)
             corrected_band = np.clip(corrected_band, info.min, info.max)
-        corrected_cube[i] = corrected_band.astype(orig_dtype)
-    dc.set_cube(corrected_cube)
+        corrected_cube[i] = corrected_band
+
+    n_jobs = config.resolve_n_jobs(n_jobs)
+    if n_jobs == 1:
+        for i in range(cube.shape[0]):
+            correct_band(i)
+    else:
+        # bands are written in place, so an inplace run never reads a corrected band
+        with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(correct_band, range(cube.shape[0])))
+    buffers.store_result(dc, corrected_cube)
     return dc
 
 
-def upscale_datacube_edsr(dc: DataCube, scale: int, model_path: str):
+@decorators.prefers_layout('bsq')
+def upscale_datacube_edsr(dc: DataCube, scale: int, model_path: str, inplace: bool = False,
+                          out: np.ndarray = None):
     """
     Upscale the spatial dimensions of a DataCube using the EDSR super-resolution model.
 
@@ -760,6 +1046,10 @@ def upscale_datacube_edsr(dc: DataCube, scale: int, model_path: str):
     model_path : str
         Filesystem path to the pretrained EDSR `.pb` model file
         (e.g., `"EDSR_x4.pb"`).
+    inplace : bool, optional
+        Not supported, the result has a different shape than the cube.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -780,7 +1070,8 @@ def upscale_datacube_edsr(dc: DataCube, scale: int, model_path: str):
     -----
     - Requires `opencv-contrib-python>=4.3.0`.
     - Processing is done slice-by-slice and may be slow for large cubes.
-    - Memory usage grows by approximately `scale^2`.
+    - Memory usage grows by approximately `scale^2`; the result is written band by
+      band into one array of the upscaled size (or `out`).
 
     Examples
     --------
@@ -799,7 +1090,7 @@ def upscale_datacube_edsr(dc: DataCube, scale: int, model_path: str):
 
     v, x, y = dc.shape
     new_x, new_y = x * scale, y * scale
-    up_cube = np.empty((v, new_x, new_y), dtype=dc.cube.dtype)
+    up_cube = buffers.result_buffer(dc, (v, new_x, new_y), dc.cube.dtype, inplace, out, 'upscale')
 
     for i in range(v):
         # Extract single-band slice
@@ -817,11 +1108,13 @@ def upscale_datacube_edsr(dc: DataCube, scale: int, model_path: str):
         up_cube[i, :, :] = up_band
 
     # Build new DataCube
-    dc.set_cube(up_cube)
+    buffers.store_result(dc, up_cube)
     return dc
 
 
-def upscale_datacube_espcn(dc: DataCube, scale: int, model_path: str):
+@decorators.prefers_layout('bsq')
+def upscale_datacube_espcn(dc: DataCube, scale: int, model_path: str, inplace: bool = False,
+                           out: np.ndarray = None):
     """
     Upscale the spatial dimensions of a DataCube using the ESPCN super-resolution model.
 
@@ -842,6 +1135,10 @@ def upscale_datacube_espcn(dc: DataCube, scale: int, model_path: str):
     model_path : str
         Filesystem path to the pretrained ESPCN `.pb` model file
         (e.g., "ESPCN_x3.pb").
+    inplace : bool, optional
+        Not supported, the result has a different shape than the cube.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -862,7 +1159,8 @@ def upscale_datacube_espcn(dc: DataCube, scale: int, model_path: str):
     -----
     - Requires `opencv-contrib-python>=4.3.0`.
     - Processing is done slice-by-slice and may be slow for large cubes.
-    - Memory usage grows by approximately `scale**2`.
+    - Memory usage grows by approximately `scale**2`; the result is written band by
+      band into one array of the upscaled size (or `out`).
 
     Examples
     --------
@@ -884,7 +1182,7 @@ def upscale_datacube_espcn(dc: DataCube, scale: int, model_path: str):
 
     v, x, y = dc.shape
     new_x, new_y = x * scale, y * scale
-    up_cube = np.empty((v, new_x, new_y), dtype=dc.cube.dtype)
+    up_cube = buffers.result_buffer(dc, (v, new_x, new_y), dc.cube.dtype, inplace, out, 'upscale')
 
     for i in range(v):
         # extract single-band slice
@@ -901,11 +1199,13 @@ def upscale_datacube_espcn(dc: DataCube, scale: int, model_path: str):
         up_cube[i, :, :] = up_band
 
     # assemble new DataCube
-    dc.set_cube(up_cube)
+    buffers.store_result(dc, up_cube)
     return dc
 
 
-def upscale_datacube_with_reference(dc: DataCube, reference_image: np.ndarray) -> 'DataCube':
+@decorators.prefers_layout('bsq')
+def upscale_datacube_with_reference(dc: DataCube, reference_image: np.ndarray, inplace: bool = False,
+                                    out: np.ndarray = None) -> 'DataCube':
     """
     Upscales a DataCube to match the spatial resolution of a reference image using ESRGAN.
 
@@ -920,6 +1220,10 @@ def upscale_datacube_with_reference(dc: DataCube, reference_image: np.ndarray) -
 
     reference_image : np.ndarray
         A high-resolution reference image (e.g., RGB) that defines the target (x, y) resolution.
+    inplace : bool, optional
+        Not supported, the result has a different shape than the cube.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -934,6 +1238,7 @@ def upscale_datacube_with_reference(dc: DataCube, reference_image: np.ndarray) -
     Notes
     -----
     This method uses the ESRGAN model via TensorFlow Hub. The model is applied to each spectral band independently.
+    Memory: one float32 array of the upscaled size for the result (or `out`).
 
     Examples
     --------
@@ -954,7 +1259,8 @@ def upscale_datacube_with_reference(dc: DataCube, reference_image: np.ndarray) -
     if x >= target_x or y >= target_y:
         raise ValueError("Reference image must be larger than the DataCube in spatial dimensions.")
 
-    upscaled_bands = []
+    upscaled_cube_array = buffers.result_buffer(dc, (v, target_x, target_y), np.float32, inplace, out,
+                                                'upscale_datacube_with_reference')
 
     for i in range(v):
         band = dc.cube[i, :, :]
@@ -979,15 +1285,14 @@ def upscale_datacube_with_reference(dc: DataCube, reference_image: np.ndarray) -
         sr_gray = cv2.cvtColor((sr_image * 255).astype(np.uint8), cv2.COLOR_RGB2GRAY)
         resized_band = cv2.resize(sr_gray.astype(np.float32), (target_y, target_x), interpolation=cv2.INTER_CUBIC)
 
-        upscaled_bands.append(resized_band)
-
-    upscaled_cube_array = np.stack(upscaled_bands, axis=0)
+        upscaled_cube_array[i] = resized_band
 
-    dc.set_cube(upscaled_cube_array)
+    buffers.store_result(dc, upscaled_cube_array)
     return dc
 
 
-def upscale_datacube_fsrcnn(dc, scale, model_path):
+@decorators.prefers_layout('bsq')
+def upscale_datacube_fsrcnn(dc, scale, model_path, inplace=False, out=None):
     """
     Upscale the spatial dimensions of a DataCube using the FSRCNN super-resolution model.
 
@@ -1008,6 +1313,10 @@ def upscale_datacube_fsrcnn(dc, scale, model_path):
     model_path : str
         Filesystem path to the pretrained FSRCNN `.pb` model file
         (e.g., "FSRCNN_x3.pb").
+    inplace : bool, optional
+        Not supported, the result has a different shape than the cube.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -1028,7 +1337,8 @@ def upscale_datacube_fsrcnn(dc, scale, model_path):
     -----
     - Requires `opencv-contrib-python>=4.3.0`.
     - Processing is done slice-by-slice and may be slow for large cubes.
-    - Memory usage grows by approximately `scale**2`.
+    - Memory usage grows by approximately `scale**2`; the result is written band by
+      band into one array of the upscaled size (or `out`).
 
     Examples
     --------
@@ -1052,7 +1362,7 @@ def upscale_datacube_fsrcnn(dc, scale, model_path):
     # Prepare new cube
     v, x, y = dc.cube.shape
     new_x, new_y = x * scale, y * scale
-    up_cube = np.empty((v, new_x, new_y), dtype=dc.cube.dtype)
+    up_cube = buffers.result_buffer(dc, (v, new_x, new_y), dc.cube.dtype, inplace, out, 'upscale')
 
     # Upscale each spectral band
     for i in range(v):
@@ -1063,11 +1373,12 @@ def upscale_datacube_fsrcnn(dc, scale, model_path):
         up_cube[i, :, :] = up_band
 
     # Create and return new DataCube
-    dc.set_cube(up_cube)
+    buffers.store_result(dc, up_cube)
     return dc
 
 
-def remove_vignette(dc: DataCube, vignette_map: np.ndarray, flip: bool = False) -> DataCube:
+def remove_vignette(dc: DataCube, vignette_map: np.ndarray, flip: bool = False, inplace: bool = False,
+                    out: np.ndarray = None) -> DataCube:
     """
     Subtract a vignette pattern from every spectral layer.
 
@@ -1086,11 +1397,16 @@ def remove_vignette(dc: DataCube, vignette_map: np.ndarray, flip: bool = False)
         Values should be on the same scale as the cube’s pixel intensities.
     flip : bool, default=False
         If True, invert the vignette_map before subtraction.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
-    None
-        Modifies the DataCube.cube in-place.
+    DataCube
+        The DataCube with the vignette removed.
 
     Raises
     ------
@@ -1101,6 +1417,7 @@ def remove_vignette(dc: DataCube, vignette_map: np.ndarray, flip: bool = False)
     -----
     - After subtraction, any negative values in the cube are clipped to zero.
     - Assumes cube and vignette_map share the same intensity scale.
+    - Memory: one array of the size of the cube for the result, none with `inplace`.
 
     Examples
     --------
@@ -1116,7 +1433,7 @@ def remove_vignette(dc: DataCube, vignette_map: np.ndarray, flip: bool = False)
             f"vignette_map shape {vignette_map.shape} does not match cube spatial shape {dc.cube.shape[1:]}"
         )
 
-    cube = dc.cube.copy()
+    cube = buffers.result_buffer(dc, dc.cube.shape, dc.cube.dtype, inplace, out, 'remove_vignette')
 
     # Optionally invert the vignette pattern
     if flip:
@@ -1124,17 +1441,220 @@ def remove_vignette(dc: DataCube, vignette_map: np.ndarray, flip: bool = False)
 
     # Subtract vignette from each layer
     # Using broadcasting: vignette_map has shape (x, y), expand to (1, x, y)
-    cube -= vignette_map[np.newaxis, :, :]
+    np.subtract(dc.cube, vignette_map[np.newaxis, :, :], out=cube)
 
     # Clip negative values to zero
     np.clip(cube, a_min=0, a_max=None, out=cube)
 
-    dc.set_cube(cube)
+    buffers.store_result(dc, cube)
+
+    return dc
+
+
+def calibrate(dc: DataCube, dark=None, white=None, clip: tuple = (0, None), epsilon: float = 1e-12,
+              n_jobs: int = None, inplace: bool = False, out: np.ndarray = None) -> DataCube:
+    """
+    Calibrate raw intensities to reflectance with dark and white references.
+
+    Computes ``(raw - dark) / (white - dark)``. The references are averaged once and
+    turned into the reciprocal gain ``1 / (white - dark)``; the cube is then
+    processed in blocks of bands, each with one subtraction and one multiplication
+    into the result buffer, followed by clipping.
+
+    Parameters
+    ----------
+    dc : DataCube
+        The DataCube with raw intensities.
+    dark : DataCube | np.ndarray | str | list, optional
+        Dark reference: a cube of shape (v, x, y), a frame that broadcasts against
+        the cube, e.g. (v, 1, y) or (v, 1, 1), a file path, a stack of recordings
+        along a leading axis, or a list of recordings. Recordings are averaged.
+        Defaults to zeros.
+    white : DataCube | np.ndarray | str | list, optional
+        White reference, in the same forms as `dark`. Defaults to no gain
+        correction (a white reference of ``dark + 1``).
+    clip : tuple, optional
+        Lower and upper bound of the reflectance, None for no bound. Defaults to
+        (0, None). Pass None to disable clipping.
+    epsilon : float, optional
+        Pixels where ``white - dark`` is not above `epsilon` are set to 0 instead
+        of being divided by zero. Defaults to 1e-12.
+    n_jobs : int, optional
+        Number of threads processing blocks of bands, defaults to the configured
+        ``n_jobs``.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. Needs a cube of the compute dtype. See
+        `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
+
+    Returns
+    -------
+    DataCube
+        The calibrated DataCube, in the compute dtype.
+
+    Raises
+    ------
+    ValueError
+        If neither `dark` nor `white` is given, or a reference does not fit the cube.
 
+    Notes
+    -----
+    Memory: one array of the size of the cube in the compute dtype for the result,
+    none with `inplace`, plus the averaged references and the gain. In recorded
+    templates, array references are stored as nested lists and paths as they are; a
+    DataCube reference can not be stored, pass its file path instead. The operation
+    is fused with neighbouring operations in lazy mode and can run tiled in
+    templates, see `wizard._core.fusion`.
+
+    Examples
+    --------
+    >>> dc.calibrate(dark=dark_dc, white=[white_1, white_2], clip=(0, 1))
+    """
+    cube = dc.cube
+    dark, gain = calibration.prepare_references(cube.shape, dark, white, epsilon)
+    target = buffers.result_buffer(dc, cube.shape, config.compute_dtype(), inplace, out, 'calibrate')
+
+    v, x, y = cube.shape
+    block_bands = max(1, fusion.DEFAULT_BLOCK_BYTES // max(1, x * y * target.itemsize))
+
+    def calibrate_block(start):
+        region = (slice(start, min(start + block_bands, v)), slice(None), slice(None))
+        calibration.apply_calibration(cube[region], calibration.reference_block(dark, region),
+                                      calibration.reference_block(gain, region), clip, out=target[region])
+
+    n_jobs = config.resolve_n_jobs(n_jobs)
+    starts = range(0, v, block_bands)
+    if n_jobs == 1 or len(starts) == 1:
+        for start in starts:
+            calibrate_block(start)
+    else:
+        with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(calibrate_block, starts))
+    buffers.store_result(dc, target)
+    return dc
+
+
+def apply_flat_field(dc: DataCube, model=None, instrument: str = None, inplace: bool = False,
+                     out: np.ndarray = None) -> DataCube:
+    """
+    Correct vignetting with a precomputed flat-field model.
+
+    Multiplies the cube with the gain of a `FlatFieldModel`, estimated once from
+    reference cubes of the same instrument, see `wizard._processing.flatfield`.
+
+    Parameters
+    ----------
+    dc : DataCube
+        The DataCube to correct.
+    model : FlatFieldModel | str, optional
+        The model, or the path of a model saved with `FlatFieldModel.save`.
+        Defaults to the registered model of `instrument`, or of the spatial
+        shape of the cube.
+    instrument : str, optional
+        Name of the registered model to use if `model` is not given.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
+
+    Returns
+    -------
+    DataCube
+        The corrected DataCube. The cube keeps its dtype; integer cubes are
+        rounded and clipped.
+
+    Raises
+    ------
+    ValueError
+        If no model is given or registered, or the model does not fit the cube.
+
+    Notes
+    -----
+    Memory: one array of the size of the cube for the result, none with `inplace`;
+    integer cubes need one more array of the size of the cube in the compute dtype.
+
+    Examples
+    --------
+    >>> from wizard._processing.flatfield import FlatFieldModel
+    >>> FlatFieldModel.estimate([white_1, white_2], instrument='cam-a').save('cam-a.npz')
+    >>> dc.apply_flat_field('cam-a.npz')
+    """
+    if isinstance(model, str):
+        model = flatfield.FlatFieldModel.load(model)
+    elif model is None:
+        model = flatfield.get_model(instrument if instrument is not None else dc.cube.shape[1:])
+        if model is None:
+            raise ValueError(f'No flat-field model registered for `{instrument or dc.cube.shape[1:]}`.')
+    model.check(dc.cube.shape)
+    target = buffers.result_buffer(dc, dc.cube.shape, dc.cube.dtype, inplace, out, 'apply_flat_field')
+    model.apply(dc.cube, out=target)
+    buffers.store_result(dc, target)
+    return dc
+
+
+def apply_transforms(dc: DataCube, transforms=None, n_jobs: int = None, inplace: bool = False,
+                     out: np.ndarray = None) -> DataCube:
+    """
+    Register a DataCube with precomputed per-band transforms.
+
+    Warps every band with its homography from a `TransformSet`, e.g. from an earlier
+    `register_layers_best` of a cube of the same rig, without matching any features.
+    See `wizard._processing.registration`.
+
+    Parameters
+    ----------
+    dc : DataCube
+        The DataCube to register.
+    transforms : TransformSet | str
+        The transforms, or the path of transforms saved with `TransformSet.save`.
+    n_jobs : int, optional
+        Number of threads, defaults to the configured ``n_jobs``.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
+
+    Returns
+    -------
+    DataCube
+        The registered DataCube, with the dtype of the cube. Its `transforms` are
+        the applied ones.
+
+    Raises
+    ------
+    ValueError
+        If no transforms are given or they do not fit the cube.
+
+    Notes
+    -----
+    Memory: one array of the size of the cube for the result, none with `inplace`;
+    each thread warps one run of bands sharing a homography at a time.
+
+    Examples
+    --------
+    >>> dc_session.register_layers_best()
+    >>> dc_session.transforms.save('rig-a.npz')
+    >>> dc.apply_transforms('rig-a.npz')
+    """
+    if isinstance(transforms, str):
+        transforms = registration.TransformSet.load(transforms)
+    elif transforms is None:
+        raise ValueError('No transforms given, pass a TransformSet or the path of saved transforms.')
+    transforms.check(dc.cube.shape)
+    target = buffers.result_buffer(dc, dc.cube.shape, dc.cube.dtype, inplace, out, 'apply_transforms')
+    transforms.apply(dc.cube, out=target, n_jobs=n_jobs)
+    buffers.store_result(dc, target)
+    dc.registered = True
+    dc.transforms = transforms
     return dc
 
 
-def uniform_filter_dc(dc, size=3):
+@decorators.prefers_layout('bsq')
+def uniform_filter_dc(dc, size=3, n_jobs=None, inplace=False, out=None):
     """
     Smooth each spectral band of a DataCube using a uniform spatial filter.
 
@@ -1150,6 +1670,14 @@ def uniform_filter_dc(dc, size=3):
     size : int, optional
         The size of the square window used by `scipy.ndimage.uniform_filter` for
         smoothing. Must be a positive odd integer. Defaults to 3.
+    n_jobs : int, optional
+        Number of threads filtering blocks of bands, defaults to the configured
+        ``n_jobs``.
+    inplace : bool, optional
+        Write the result into the current cube array instead of a new one,
+        defaults to False. See `wizard._core.buffers`.
+    out : np.ndarray, optional
+        Array to write the result into; it becomes the cube of the DataCube.
 
     Returns
     -------
@@ -1165,14 +1693,19 @@ def uniform_filter_dc(dc, size=3):
     Notes
     -----
     - Requires `scipy.ndimage.uniform_filter` to be imported.
-    - Smoothing is performed independently on each spectral band.
-    - This function updates `dc` in place; no new DataCube is created.
+    - Smoothing is performed independently on each spectral band, with one
+      separable pass over the cube and a (1, size, size) window, see
+      `wizard._processing.filters.uniform_filter_cube`.
+    - This function updates `dc` in place; no new DataCube is created. By default
+      the smoothed data is written to a new array, so read-only (e.g. memory-mapped)
+      cubes can be filtered.
+    - Memory: one array of the size of the cube for the result, none with `inplace`.
 
     """
     if not isinstance(size, int) or size < 1:
         raise ValueError("`size` must be a positive integer")
     cube = dc.cube
-    for i in range(dc.cube.shape[0]):
-        cube[i] = uniform_filter(cube[i], size=size)
-    dc.set_cube(cube)
+    target = buffers.result_buffer(dc, cube.shape, cube.dtype, inplace, out, 'uniform_filter_dc')
+    filters.uniform_filter_cube(cube, size, out=target, n_jobs=n_jobs)
+    buffers.store_result(dc, target)
     return dc
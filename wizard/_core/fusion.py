@@ -0,0 +1,504 @@
+"""
+_core/fusion.py
+===============
+
+.. module:: fusion
+   :platform: Unix
+   :synopsis: Deferred execution and operation fusion for DataCube pipelines.
+
+Module Overview
+---------------
+
+This module contains the operation graph used by the lazy mode of the `DataCube`.
+While a DataCube is lazy, calls to its dynamic methods are not executed but appended
+to an `OperationGraph`. When the cube is materialized, consecutive element-wise and
+per-band spatial operations are fused: instead of writing a full-size intermediate
+cube after every step, the fused operations run one after another on blocks of bands,
+so every block is read once and written once.
+
+Operations that need a statistic of their whole input (e.g. the global maximum for
+`inverse`) get it from an extra reduction pass over the blocks. The reduction pass
+recomputes the preceding fused steps per block instead of storing their output.
+
+Templates that consist only of spatially local steps can also run per spatial tile
+(see `run_tiled`). Every tile is read with a halo large enough for the neighbourhood
+filters in the pipeline, processed by all steps and cropped back before it is written,
+so neither the input nor the output has to be held in memory as a whole when they are
+memory-mapped. Tiles are processed in parallel threads.
+
+Classes
+-------
+
+.. autoclass:: OperationGraph
+   :members:
+
+Functions
+---------
+
+.. autofunction:: fuse_stages
+.. autofunction:: run_fused
+.. autofunction:: is_memory_mapped
+.. autofunction:: is_tileable
+.. autofunction:: run_tiled
+
+"""
+
+import mmap
+import inspect
+
+import numpy as np
+from joblib import Parallel, delayed
+from wizard._processing import calibration
+from wizard._processing.filters import uniform_filter_cube
+
+from wizard._utils import config, profiler
+from wizard._utils.helper import _process_slice
+
+# Target size of one block of bands processed by a fused stage
+DEFAULT_BLOCK_BYTES = 64 * 1024 ** 2
+
+# Default edge length of the spatial tiles processed by `run_tiled`
+DEFAULT_TILE_SIZE = 256
+
+
+def _inverse_reduce(block, params, region):
+    """Maximum of the input, used as offset by `inverse`."""
+    return block.max()
+
+
+def _inverse_combine(partials):
+    """Combine the block maxima of `inverse`."""
+    return max(partials)
+
+
+def _inverse_apply(block, params, stat, region):
+    """Block version of `datacube_ops.inverse`."""
+    dtype = block.dtype
+    if dtype == np.uint16 or dtype == np.uint8:
+        tmp = block.astype(config.compute_dtype())
+    else:
+        tmp = block.copy()
+    tmp *= -1
+    tmp += stat
+    return tmp.astype(dtype)
+
+
+def _normalize_reduce(block, params, region):
+    """Per-band minimum and maximum, used by `normalize`."""
+    block = block.astype(config.compute_dtype())
+    return region[0], block.min(axis=(1, 2)), block.max(axis=(1, 2))
+
+
+def _normalize_combine(partials):
+    """Combine per-band minima and maxima of blocks into full-length arrays."""
+    n_bands = max(bands.stop for bands, _, _ in partials)
+    min_vals = np.full(n_bands, np.inf, dtype=config.compute_dtype())
+    max_vals = np.full(n_bands, -np.inf, dtype=config.compute_dtype())
+    for bands, block_min, block_max in partials:
+        min_vals[bands] = np.minimum(min_vals[bands], block_min)
+        max_vals[bands] = np.maximum(max_vals[bands], block_max)
+    return min_vals, max_vals
+
+
+def _normalize_apply(block, params, stat, region):
+    """Block version of `datacube_ops.normalize`."""
+    bands = region[0]
+    cube = block.astype(config.compute_dtype())
+    min_vals = stat[0][bands][:, None, None]
+    range_vals = stat[1][bands][:, None, None] - min_vals
+    range_vals[range_vals == 0] = 1
+    return (cube - min_vals) / range_vals
+
+
+def _remove_vignette_check(params, shape):
+    """Validate the vignette map against the cube shape."""
+    vignette_map = params['vignette_map']
+    if vignette_map.shape != shape[1:]:
+        raise ValueError(
+            f"vignette_map shape {vignette_map.shape} does not match cube spatial shape {shape[1:]}"
+        )
+
+
+def _remove_vignette_apply(block, params, stat, region):
+    """Block version of `datacube_ops.remove_vignette`."""
+    vignette_map = params['vignette_map']
+    if params['flip']:
+        vignette_map = vignette_map.max() - vignette_map
+    cube = block.copy()
+    cube -= vignette_map[np.newaxis, region[1], region[2]]
+    np.clip(cube, a_min=0, a_max=None, out=cube)
+    return cube
+
+
+def _uniform_filter_check(params, shape):
+    """Validate the filter size of `uniform_filter_dc`."""
+    size = params['size']
+    if not isinstance(size, int) or size < 1:
+        raise ValueError("`size` must be a positive integer")
+
+
+def _uniform_filter_halo(params):
+    """Number of neighbouring pixels `uniform_filter_dc` reads on each side."""
+    return params['size'] // 2
+
+
+def _uniform_filter_apply(block, params, stat, region):
+    """Block version of `datacube_ops.uniform_filter_dc`."""
+    return uniform_filter_cube(block, params['size'], n_jobs=1)
+
+
+def _calibrate_check(params, shape):
+    """Average the references of `calibrate` once, before any block is processed."""
+    params['references'] = calibration.prepare_references(shape, params['dark'], params['white'], params['epsilon'])
+
+
+def _calibrate_apply(block, params, stat, region):
+    """Block version of `datacube_ops.calibrate`."""
+    dark, gain = params['references']
+    return calibration.apply_calibration(block, calibration.reference_block(dark, region),
+                                         calibration.reference_block(gain, region), params['clip'])
+
+
+def _remove_spikes_check(params, shape):
+    """Validate the spectral window of `remove_spikes`."""
+    v = shape[0]
+    if not (1 <= params['window'] <= v):
+        raise ValueError(f"window must be between 1 and {v}, got {params['window']}")
+
+
+def _remove_spikes_reduce(block, params, region):
+    """Sum and number of values, used for the global mean of `remove_spikes`."""
+    return np.sum(block, dtype=np.float64), block.size
+
+
+def _remove_spikes_combine(partials):
+    """Combine block sums into the global mean."""
+    return sum(p[0] for p in partials) / sum(p[1] for p in partials)
+
+
+def _remove_spikes_apply(block, params, stat, region):
+    """Block version of `datacube_ops.remove_spikes`."""
+    v = block.shape[0]
+    flat = block.reshape(v, -1).T
+    spikes = np.abs(flat - stat) > params['threshold']
+    flat_out = flat.copy()
+    for idx in np.flatnonzero(spikes.any(axis=1)):
+        flat_out[idx] = _process_slice(flat_out, spikes, idx, params['window'])[1]
+    return flat_out.T.reshape(block.shape)
+
+
+# Operations that can be fused. Every entry provides `apply(block, params, stat, region)`,
+# which computes the operation on a block of the cube; `region` holds the slices of the
+# block in the full cube. Operations that need a statistic of their whole input also provide
+# `reduce(block, params, region)` and `combine(partials)`; `check(params, shape)` validates
+# the parameters before any block is processed, and `halo(params)` returns the number of
+# neighbouring pixels a spatial filter reads on each side.
+FUSABLE_OPS = {
+    'inverse': {'apply': _inverse_apply, 'reduce': _inverse_reduce, 'combine': _inverse_combine},
+    'normalize': {'apply': _normalize_apply, 'reduce': _normalize_reduce, 'combine': _normalize_combine},
+    'remove_vignette': {'apply': _remove_vignette_apply, 'check': _remove_vignette_check},
+    'uniform_filter_dc': {'apply': _uniform_filter_apply, 'check': _uniform_filter_check,
+                          'halo': _uniform_filter_halo},
+    'calibrate': {'apply': _calibrate_apply, 'check': _calibrate_check},
+}
+
+# Operations that can run per spatial tile. In addition to the fusable operations these
+# include per-pixel spectral operations, which need all bands of a pixel.
+TILEABLE_OPS = dict(FUSABLE_OPS, remove_spikes={
+    'apply': _remove_spikes_apply, 'reduce': _remove_spikes_reduce,
+    'combine': _remove_spikes_combine, 'check': _remove_spikes_check,
+})
+
+
+class OperationGraph:
+    """
+    Ordered graph of deferred DataCube operations.
+
+    Each node is a dictionary with the operation `name`, the callable `func`, and the
+    positional `args` and keyword `kwargs` it was called with (without the DataCube itself).
+
+    Attributes
+    ----------
+    nodes : list of dict
+        The deferred operations in call order.
+    """
+
+    def __init__(self):
+        """Initialize an empty graph."""
+        self.nodes = []
+
+    def __len__(self) -> int:
+        """Return the number of deferred operations."""
+        return len(self.nodes)
+
+    def add(self, func, args: tuple, kwargs: dict) -> None:
+        """
+        Append an operation to the graph.
+
+        Parameters
+        ----------
+        func : callable
+            The operation, called as `func(dc, *args, **kwargs)` on execution.
+        args : tuple
+            Positional arguments without the DataCube.
+        kwargs : dict
+            Keyword arguments.
+        """
+        self.nodes.append({'name': func.__name__, 'func': func, 'args': args, 'kwargs': kwargs})
+
+    def execute(self, dc, block_bytes: int = None) -> None:
+        """
+        Run all operations on `dc` and clear the graph.
+
+        While profiling is enabled, every stage is profiled; fused stages are recorded
+        as ``fused(<op>+<op>...)``.
+
+        Parameters
+        ----------
+        dc : DataCube
+            The DataCube to process. Its cube must already be materialized.
+        block_bytes : int, optional
+            Target size of a block of bands in fused stages, defaults to `DEFAULT_BLOCK_BYTES`.
+        """
+        nodes, self.nodes = self.nodes, []
+        for stage in fuse_stages(nodes):
+            if len(stage) > 1:
+                name = 'fused(' + '+'.join(node['name'] for node in stage) + ')'
+                func, args, kwargs = run_fused, (stage,), {'block_bytes': block_bytes}
+            else:
+                name, func, args, kwargs = stage[0]['name'], stage[0]['func'], stage[0]['args'], stage[0]['kwargs']
+
+            if profiler.is_profiling():
+                profiler.profile_call(name, func, dc, *args, **kwargs)
+            else:
+                func(dc, *args, **kwargs)
+
+
+def _is_fusable(node: dict) -> bool:
+    """Check if a node can be fused; nodes writing into a given buffer run on their own."""
+    kwargs = node.get('kwargs', {})
+    return node['name'] in FUSABLE_OPS and kwargs.get('out') is None and not kwargs.get('inplace')
+
+
+def fuse_stages(nodes: list) -> list:
+    """
+    Group consecutive fusable operations into stages.
+
+    Parameters
+    ----------
+    nodes : list of dict
+        Operation nodes as stored in `OperationGraph.nodes`.
+
+    Returns
+    -------
+    list of list
+        Stages in execution order. A stage with more than one node is executed fused,
+        a single-node stage is executed as a normal method call.
+    """
+    stages = []
+    for node in nodes:
+        if _is_fusable(node) and stages and _is_fusable(stages[-1][0]):
+            stages[-1].append(node)
+        else:
+            stages.append([node])
+    return stages
+
+
+def _bind_params(node: dict) -> dict:
+    """Map the call arguments of a node onto the parameters of its function."""
+    sig = inspect.signature(node['func'])
+    bound = sig.bind(None, *node['args'], **node['kwargs'])
+    bound.apply_defaults()
+    params = dict(bound.arguments)
+    params.pop(next(iter(sig.parameters)))
+    return params
+
+
+def _prepare(nodes: list, shape: tuple, registry: dict) -> list:
+    """Look up the kernels of the nodes and validate their parameters."""
+    ops = []
+    for node in nodes:
+        if node['name'] not in registry:
+            raise ValueError(f"Operation `{node['name']}` can not be fused.")
+        kernel = registry[node['name']]
+        params = _bind_params(node)
+        if 'check' in kernel:
+            kernel['check'](params, shape)
+        ops.append((kernel, params))
+    return ops
+
+
+def _apply_chain(block, ops: list, stats: list, region: tuple):
+    """Apply a chain of fused operations to one block."""
+    for (kernel, params), stat in zip(ops, stats):
+        block = kernel['apply'](block, params, stat, region)
+    return block
+
+
+def _crop(block, core: tuple, ext: tuple):
+    """Crop a block read for region `ext` to the region `core`."""
+    x0, y0 = core[1].start - ext[1].start, core[2].start - ext[2].start
+    return block[:, x0:x0 + core[1].stop - core[1].start, y0:y0 + core[2].stop - core[2].start]
+
+
+def _run_blocks(cube, ops: list, regions: list, out=None, n_jobs: int = 1):
+    """
+    Run a chain of operations block-wise over `cube`.
+
+    `regions` is a list of `(core, ext)` pairs: every block is read for the region `ext`,
+    processed, cropped to `core` and written to `out[core]`.
+    """
+    # blocks share `cube` and `out`, so they always run in threads
+    parallel = Parallel(n_jobs=n_jobs, prefer='threads')
+
+    # reduction passes for operations that need a statistic of their whole input
+    stats = [None] * len(ops)
+    for k, (kernel, params) in enumerate(ops):
+        if 'reduce' in kernel:
+            def partial(core, ext):
+                block = _apply_chain(cube[ext], ops[:k], stats[:k], ext)
+                return kernel['reduce'](_crop(block, core, ext), params, core)
+            stats[k] = kernel['combine'](parallel(delayed(partial)(core, ext) for core, ext in regions))
+
+    def process(core, ext):
+        out[core] = _crop(_apply_chain(cube[ext], ops, stats, ext), core, ext)
+
+    # the first block determines the output dtype
+    core, ext = regions[0]
+    block = _crop(_apply_chain(cube[ext], ops, stats, ext), core, ext)
+    if out is None:
+        out = np.empty(cube.shape, dtype=block.dtype)
+    out[core] = block
+    parallel(delayed(process)(core, ext) for core, ext in regions[1:])
+    return out
+
+
+def _budget_bytes(default: int, parts: int) -> int:
+    """Return `default`, capped to a part of the configured memory budget."""
+    budget = config.get_config()['memory_budget']
+    return default if budget is None else max(1, min(default, budget // parts))
+
+
+def run_fused(dc, nodes: list, block_bytes: int = None) -> None:
+    """
+    Execute fusable operations on `dc` in a single pass over blocks of bands.
+
+    Parameters
+    ----------
+    dc : DataCube
+        The DataCube to process.
+    nodes : list of dict
+        Fusable operation nodes, see `FUSABLE_OPS`.
+    block_bytes : int, optional
+        Target size of a block of bands. Defaults to `DEFAULT_BLOCK_BYTES`, or to a quarter
+        of the configured memory budget if that is smaller.
+
+    Raises
+    ------
+    ValueError
+        If an operation is not fusable or its parameters are invalid for the cube.
+    """
+    cube = dc.cube
+    v, x, y = cube.shape
+    block_bytes = block_bytes or _budget_bytes(DEFAULT_BLOCK_BYTES, 4)
+    ops = _prepare(nodes, cube.shape, FUSABLE_OPS)
+
+    # work on float64-sized blocks, operations may upcast the input
+    block_bands = max(1, int(block_bytes // max(1, x * y * 8)))
+    regions = []
+    for i in range(0, v, block_bands):
+        region = (slice(i, min(i + block_bands, v)), slice(0, x), slice(0, y))
+        regions.append((region, region))
+
+    dc.set_cube(_run_blocks(cube, ops, regions))
+
+
+def is_memory_mapped(array) -> bool:
+    """
+    Check whether an array is backed by a memory-mapped file.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The array to check, e.g. a view of a `np.memmap`.
+
+    Returns
+    -------
+    bool
+        True if the array or one of its bases is a memory map.
+    """
+    while array is not None:
+        if isinstance(array, mmap.mmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def is_tileable(names: list) -> bool:
+    """
+    Check whether a pipeline can run per spatial tile.
+
+    Parameters
+    ----------
+    names : list of str
+        Operation names in pipeline order.
+
+    Returns
+    -------
+    bool
+        True if the pipeline is not empty and every operation is in `TILEABLE_OPS`.
+    """
+    return len(names) > 0 and all(name in TILEABLE_OPS for name in names)
+
+
+def run_tiled(dc, nodes: list, tile_size: int = None, n_jobs: int = None, out: np.ndarray = None) -> None:
+    """
+    Execute a spatially local pipeline on `dc` tile by tile.
+
+    Each tile is read with a halo of the summed halos of all neighbourhood filters, so the
+    cropped result equals the result of running the operations on the whole cube. If the
+    cube of `dc` is memory-mapped (e.g. read with ``wizard.read(path, mmap=True)``) and
+    `out` is a memory-mapped array, the whole cube is never loaded into memory.
+
+    Parameters
+    ----------
+    dc : DataCube
+        The DataCube to process.
+    nodes : list of dict
+        Operation nodes, see `TILEABLE_OPS`.
+    tile_size : int, optional
+        Edge length of the spatial tiles. Defaults to `DEFAULT_TILE_SIZE`, reduced so that
+        the tiles in flight fit into the configured memory budget.
+    n_jobs : int, optional
+        Number of threads processing tiles. Default is the configured number of workers.
+    out : np.ndarray, optional
+        Array of the cube's shape that receives the result, e.g. a `np.memmap`.
+        Values are cast to its dtype. Default is a new in-memory array.
+
+    Raises
+    ------
+    ValueError
+        If an operation can not run per tile, its parameters are invalid for the cube,
+        or `out` has the wrong shape.
+    """
+    cube = dc.cube
+    v, x, y = cube.shape
+    n_jobs = config.resolve_n_jobs(n_jobs)
+    if tile_size is None:
+        # every tile in flight holds its input and a few float64 intermediates
+        tile_bytes = _budget_bytes(DEFAULT_TILE_SIZE ** 2 * v * 8 * 4, 2 * n_jobs)
+        tile_size = max(16, min(DEFAULT_TILE_SIZE, int(np.sqrt(tile_bytes / (v * 8 * 4)))))
+    ops = _prepare(nodes, cube.shape, TILEABLE_OPS)
+    if out is not None and out.shape != cube.shape:
+        raise ValueError(f'`out` must have shape {cube.shape}, got {out.shape}.')
+
+    halo = sum(kernel['halo'](params) for kernel, params in ops if 'halo' in kernel)
+    regions = []
+    for i in range(0, x, tile_size):
+        for j in range(0, y, tile_size):
+            core = (slice(0, v), slice(i, min(i + tile_size, x)), slice(j, min(j + tile_size, y)))
+            ext = (slice(0, v), slice(max(0, i - halo), min(i + tile_size + halo, x)),
+                   slice(max(0, j - halo), min(j + tile_size + halo, y)))
+            regions.append((core, ext))
+
+    dc.set_cube(_run_blocks(cube, ops, regions, out=out, n_jobs=n_jobs))
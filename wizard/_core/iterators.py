@@ -0,0 +1,199 @@
+"""
+_core/iterators.py
+==================
+
+.. module:: iterators
+   :platform: Unix
+   :synopsis: Independent, thread-safe iterators over blocks of a DataCube.
+
+Module Overview
+---------------
+
+This module provides the iterators behind `DataCube.__iter__`, `DataCube.iter_bands`,
+`DataCube.iter_tiles` and `DataCube.iter_pixels`. Every call creates a new iterator
+with its own cursor, so nested loops and loops in several threads over the same
+DataCube do not interfere. A single iterator can also be shared by worker threads:
+the cursor is advanced under a lock, while the blocks are extracted outside of it.
+
+Classes
+-------
+
+.. autoclass:: CubeIterator
+   :members:
+
+Functions
+---------
+
+.. autofunction:: iter_layers
+.. autofunction:: iter_bands
+.. autofunction:: iter_tiles
+.. autofunction:: iter_pixels
+
+"""
+
+import threading
+
+import numpy as np
+
+
+class CubeIterator:
+    """
+    Thread-safe iterator over a fixed list of blocks.
+
+    Attributes
+    ----------
+    keys : list
+        Keys of all blocks, in iteration order.
+    """
+
+    def __init__(self, keys: list, get_block):
+        """
+        Initialize the iterator.
+
+        Parameters
+        ----------
+        keys : list
+            Keys of the blocks, in iteration order.
+        get_block : callable
+            Function returning the item for a key.
+        """
+        self.keys = keys
+        self._get_block = get_block
+        self._pos = 0
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        """Return the iterator itself."""
+        return self
+
+    def __next__(self):
+        """Return the next item; safe to call from several threads."""
+        with self._lock:
+            if self._pos >= len(self.keys):
+                raise StopIteration
+            key = self.keys[self._pos]
+            self._pos += 1
+        return self._get_block(key)
+
+    def __len__(self) -> int:
+        """Return the number of remaining items."""
+        return len(self.keys) - self._pos
+
+
+def _check_size(name: str, value: int) -> None:
+    """Validate a batch or tile size."""
+    if not isinstance(value, (int, np.integer)) or value < 1:
+        raise ValueError(f'`{name}` must be a positive integer, got {value}.')
+
+
+def iter_layers(cube: np.ndarray) -> CubeIterator:
+    """
+    Iterate over the single layers of a cube.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+
+    Returns
+    -------
+    CubeIterator
+        Iterator yielding views of shape (x, y).
+    """
+    return CubeIterator(list(range(cube.shape[0])), cube.__getitem__)
+
+
+def iter_bands(cube: np.ndarray, batch_size: int = 1) -> CubeIterator:
+    """
+    Iterate over groups of bands.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+    batch_size : int, optional
+        Number of bands per group. Default is 1.
+
+    Returns
+    -------
+    CubeIterator
+        Iterator yielding ``(bands, block)`` with the band `slice` and a view of shape
+        (n_bands, x, y).
+
+    Raises
+    ------
+    ValueError
+        If `batch_size` is not a positive integer.
+    """
+    _check_size('batch_size', batch_size)
+    v = cube.shape[0]
+    keys = [slice(i, min(i + batch_size, v)) for i in range(0, v, batch_size)]
+    return CubeIterator(keys, lambda bands: (bands, cube[bands]))
+
+
+def iter_tiles(cube: np.ndarray, tile_size: int = 256) -> CubeIterator:
+    """
+    Iterate over spatial tiles with all bands.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+    tile_size : int, optional
+        Edge length of the tiles; tiles at the border can be smaller. Default is 256.
+
+    Returns
+    -------
+    CubeIterator
+        Iterator yielding ``((rows, cols), block)`` with the `slice` of the tile along
+        x and y and a view of shape (v, n_rows, n_cols).
+
+    Raises
+    ------
+    ValueError
+        If `tile_size` is not a positive integer.
+    """
+    _check_size('tile_size', tile_size)
+    _, x, y = cube.shape
+    keys = [(slice(i, min(i + tile_size, x)), slice(j, min(j + tile_size, y)))
+            for i in range(0, x, tile_size) for j in range(0, y, tile_size)]
+    return CubeIterator(keys, lambda key: (key, cube[:, key[0], key[1]]))
+
+
+def iter_pixels(cube: np.ndarray, batch_size: int = 4096) -> CubeIterator:
+    """
+    Iterate over blocks of pixel spectra.
+
+    Pixels are numbered row by row, i.e. pixel ``i`` is ``cube[:, i // y, i % y]``.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+    batch_size : int, optional
+        Number of pixels per block. Default is 4096.
+
+    Returns
+    -------
+    CubeIterator
+        Iterator yielding ``(pixels, spectra)`` with the `slice` of the pixel numbers and
+        a C-contiguous array of shape (n_pixels, v).
+
+    Raises
+    ------
+    ValueError
+        If `batch_size` is not a positive integer.
+    """
+    _check_size('batch_size', batch_size)
+    v, x, y = cube.shape
+    n_pixels = x * y
+    keys = [slice(i, min(i + batch_size, n_pixels)) for i in range(0, n_pixels, batch_size)]
+
+    def get_block(pixels):
+        # read the rows covering the block, so the cube itself is never copied as a whole
+        r0, r1 = pixels.start // y, (pixels.stop - 1) // y + 1
+        rows = cube[:, r0:r1, :].reshape(v, -1)
+        offset = r0 * y
+        return pixels, np.ascontiguousarray(rows[:, pixels.start - offset:pixels.stop - offset].T)
+
+    return CubeIterator(keys, get_block)
@@ -0,0 +1,92 @@
+"""
+_core/layout.py
+===============
+
+.. module:: layout
+   :platform: Unix
+   :synopsis: Memory layouts of DataCube cubes.
+
+Module Overview
+---------------
+
+A cube always has the logical shape (v, x, y), but its memory can be laid out in two
+ways:
+
+- ``'bsq'`` (band sequential): every band is contiguous, the default of numpy arrays
+  of shape (v, x, y). Fast for per-band image operations.
+- ``'bip'`` (band interleaved by pixel): every spectrum is contiguous, i.e. the cube is
+  a (v, x, y) view of a C-contiguous (x, y, v) array. Fast for per-pixel spectral
+  operations; ``cube.reshape(v, -1).T`` is a contiguous (x*y, v) view instead of a copy.
+
+Operations in `datacube_ops` declare their preferred layout with
+`wizard._utils.decorators.prefers_layout`; the DataCube converts its cube once before
+such an operation and keeps the converted cube for the following ones.
+
+Functions
+---------
+
+.. autofunction:: get_layout
+.. autofunction:: to_layout
+
+"""
+
+import numpy as np
+
+BSQ = 'bsq'
+BIP = 'bip'
+LAYOUTS = (BSQ, BIP)
+
+
+def _check(layout: str) -> None:
+    """Validate a layout name."""
+    if layout not in LAYOUTS:
+        raise ValueError(f'Unknown layout `{layout}`, use one of {LAYOUTS}.')
+
+
+def get_layout(cube: np.ndarray) -> str:
+    """
+    Return the memory layout of a cube.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+
+    Returns
+    -------
+    str
+        ``'bsq'`` or ``'bip'`` if the cube is contiguous in one of them, None otherwise.
+    """
+    if cube.flags['C_CONTIGUOUS']:
+        return BSQ
+    if cube.transpose(1, 2, 0).flags['C_CONTIGUOUS']:
+        return BIP
+    return None
+
+
+def to_layout(cube: np.ndarray, layout: str) -> np.ndarray:
+    """
+    Return a cube with the given memory layout.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+    layout : str
+        ``'bsq'`` or ``'bip'``.
+
+    Returns
+    -------
+    np.ndarray
+        Cube of shape (v, x, y) with the layout; a view of `cube` if it already has
+        the layout, otherwise a converted copy.
+
+    Raises
+    ------
+    ValueError
+        If the layout is unknown.
+    """
+    _check(layout)
+    if layout == BSQ:
+        return np.ascontiguousarray(cube)
+    return np.ascontiguousarray(cube.transpose(1, 2, 0)).transpose(2, 0, 1)
@@ -0,0 +1,251 @@
+"""
+_core/shared.py
+===============
+
+.. module:: shared
+   :platform: Unix
+   :synopsis: Shared-memory handles for passing DataCubes to worker processes.
+
+Module Overview
+---------------
+
+A `SharedDataCube` is a small, picklable handle to a DataCube whose cube lives in a
+`multiprocessing.shared_memory` block or in a memory-mapped ``.npy`` file. Sending the
+handle to a worker process only transfers its name, shape and metadata; the worker
+attaches to the same memory without copying and gets a regular DataCube with all
+operations. A DataCube that was moved into shared memory with `DataCube.share` is sent
+as its handle automatically when it is pickled, e.g. as argument of a process pool task.
+
+Writes to the attached cube (``dc.cube[...] = ...``) are visible in all processes.
+Operations that replace the cube with a new array (most `datacube_ops`) only change
+the DataCube of the calling process.
+
+Examples
+--------
+Process bands of one cube on several workers without copying it:
+
+.. code-block:: python
+
+    def work(dc, band):
+        dc.cube[band] = smooth(dc.cube[band])
+
+    with dc.share() as handle:
+        with ProcessPoolExecutor() as pool:
+            list(pool.map(work, [dc] * len(dc), range(len(dc))))
+        result = dc.cube.copy()
+
+Classes
+-------
+
+.. autoclass:: SharedDataCube
+   :members:
+
+"""
+
+import os
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedDataCube:
+    """
+    Picklable handle to a DataCube stored in shared memory or a memory-mapped file.
+
+    Attributes
+    ----------
+    backend : str
+        ``'shm'`` for `multiprocessing.shared_memory` or ``'mmap'`` for a memory-mapped file.
+    name : str
+        Name of the shared memory block, or path of the ``.npy`` file.
+    shape : tuple
+        Shape of the cube.
+    dtype : str
+        Data type of the cube.
+    metadata : dict
+        Wavelengths, name, notation, registration state and transforms of the DataCube.
+    """
+
+    def __init__(self, backend: str, name: str, shape: tuple, dtype: str, metadata: dict):
+        """
+        Initialize a handle to existing shared data; use `create` to share a DataCube.
+
+        Parameters
+        ----------
+        backend : str
+            ``'shm'`` or ``'mmap'``.
+        name : str
+            Name of the shared memory block, or path of the ``.npy`` file.
+        shape : tuple
+            Shape of the cube.
+        dtype : str
+            Data type of the cube.
+        metadata : dict
+            Wavelengths, name, notation, registration state and transforms of the DataCube.
+        """
+        self.backend = backend
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = str(dtype)
+        self.metadata = metadata
+        self._shm = None
+        self._owner = False
+        self._dc = None  # weak reference to the DataCube moved into the memory by `DataCube.share`
+
+    @classmethod
+    def create(cls, dc, backend: str = 'shm', path: str = None):
+        """
+        Copy the cube of a DataCube into shared memory.
+
+        Parameters
+        ----------
+        dc : DataCube
+            The DataCube to share.
+        backend : str, optional
+            ``'shm'`` (default) for `multiprocessing.shared_memory`, or ``'mmap'`` for a
+            memory-mapped ``.npy`` file, which also works across machines sharing a file system.
+        path : str, optional
+            Path of the ``.npy`` file for the ``'mmap'`` backend.
+
+        Returns
+        -------
+        SharedDataCube
+            The handle, owning the shared memory.
+
+        Raises
+        ------
+        ValueError
+            If the backend is unknown, `path` is missing for ``'mmap'`` or the DataCube is empty.
+        """
+        if dc.cube is None:
+            raise ValueError('Can not share an empty DataCube.')
+
+        cube = dc.cube
+        metadata = {
+            'wavelengths': None if dc.wavelengths is None else np.asarray(dc.wavelengths).tolist(),
+            'name': dc.name,
+            'notation': dc.notation,
+            'registered': dc.registered,
+            'transforms': getattr(dc, 'transforms', None),
+        }
+
+        if backend == 'shm':
+            shm = shared_memory.SharedMemory(create=True, size=max(1, cube.nbytes))
+            handle = cls('shm', shm.name, cube.shape, cube.dtype, metadata)
+            handle._shm = shm
+        elif backend == 'mmap':
+            if path is None:
+                raise ValueError("The 'mmap' backend needs a `path`.")
+            array = np.lib.format.open_memmap(path, mode='w+', dtype=cube.dtype, shape=cube.shape)
+            array[...] = cube
+            array.flush()
+            del array
+            handle = cls('mmap', os.path.abspath(path), cube.shape, cube.dtype, metadata)
+        else:
+            raise ValueError(f"Unknown backend `{backend}`, use 'shm' or 'mmap'.")
+
+        handle._owner = True
+        array = handle.array()
+        if backend == 'shm':
+            array[...] = cube
+        return handle
+
+    def array(self) -> np.ndarray:
+        """
+        Return a zero-copy view of the shared cube.
+
+        Returns
+        -------
+        np.ndarray
+            Writable array backed by the shared memory.
+        """
+        if self.backend == 'mmap':
+            return np.load(self.name, mmap_mode='r+')
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def attach(self):
+        """
+        Create a DataCube on top of the shared cube without copying it.
+
+        Returns
+        -------
+        DataCube
+            DataCube with all operations, whose cube is backed by the shared memory.
+        """
+        from .datacube import DataCube  # prevent circular import errors
+
+        dc = DataCube(self.array(), wavelengths=self.metadata['wavelengths'], name=self.metadata['name'],
+                      notation=self.metadata['notation'], registered=self.metadata['registered'])
+        dc.transforms = self.metadata.get('transforms')
+        dc._shared = self
+        return dc
+
+    def close(self) -> None:
+        """Detach this process from the shared memory."""
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # arrays of this process still use the memory, it is released with them
+                pass
+            if not self._owner:
+                self._shm = None
+
+    def bind(self, dc) -> None:
+        """
+        Remember the DataCube whose cube was moved into the shared memory.
+
+        When the memory is freed, the cube of that DataCube is copied into a private
+        array, so it stays usable and is pickled by value again.
+
+        Parameters
+        ----------
+        dc : DataCube
+            The DataCube backed by this handle.
+        """
+        self._dc = weakref.ref(dc)
+
+    def _detach(self) -> None:
+        """Give the bound DataCube a private copy of the cube and drop its handle."""
+        dc = self._dc() if self._dc is not None else None
+        self._dc = None
+        if dc is not None and dc._shared is self:
+            dc._cube = np.array(dc._cube)
+            dc._shared = None
+
+    def unlink(self) -> None:
+        """Free the shared memory. Only the process that created the handle does this."""
+        if not self._owner:
+            return
+        self._detach()
+        if self.backend == 'shm' and self._shm is not None:
+            self._shm.unlink()
+        elif self.backend == 'mmap' and os.path.exists(self.name):
+            os.remove(self.name)
+        self._owner = False
+
+    def __enter__(self):
+        """Return the handle."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Close and, in the creating process, free the shared memory."""
+        if self._owner:
+            self._detach()
+        self.close()
+        self.unlink()
+
+    def __getstate__(self) -> dict:
+        """Pickle the handle by name only."""
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        state['_owner'] = False
+        state['_dc'] = None
+        return state
+
+    def __repr__(self) -> str:
+        """Return a short description of the handle."""
+        return f'SharedDataCube(backend={self.backend!r}, name={self.name!r}, shape={self.shape}, dtype={self.dtype!r})'
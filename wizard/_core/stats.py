@@ -0,0 +1,152 @@
+"""
+_core/stats.py
+==============
+
+.. module:: stats
+   :platform: Unix
+   :synopsis: Cached per-band statistics of a DataCube.
+
+Module Overview
+---------------
+
+This module provides `BandStats`, the per-band statistics behind `DataCube.stats`.
+Minimum, maximum, mean and standard deviation are computed together in one pass
+over the cube, block by block, the first time one of them is requested; percentiles and histograms
+are computed on request and cached per argument. The DataCube drops its `BandStats`
+whenever the cube is replaced (`set_cube`, assigning `cube`) or written through
+`__setitem__`, so repeated queries on an unchanged cube cost O(1).
+
+Classes
+-------
+
+.. autoclass:: BandStats
+   :members:
+
+"""
+
+import numpy as np
+
+# size of the float64 blocks the moments are computed on, small enough to stay in cache
+BLOCK_BYTES = 1 << 20
+
+
+class BandStats:
+    """
+    Lazily computed, cached statistics of every band of a cube.
+
+    All results are arrays with one entry per band, i.e. of length v for a cube of
+    shape (v, x, y).
+    """
+
+    def __init__(self, cube: np.ndarray):
+        """
+        Initialize the statistics of a cube; nothing is computed yet.
+
+        Parameters
+        ----------
+        cube : np.ndarray
+            Cube of shape (v, x, y).
+        """
+        self._cube = cube
+        self._moments = None
+        self._percentiles = {}
+        self._histograms = {}
+
+    def _compute_moments(self) -> dict:
+        """
+        Compute minimum, maximum, mean and standard deviation in one pass over the cube.
+
+        The cube is read in blocks of rows that fit into the CPU cache. Minimum and
+        maximum are reduced per block; mean and sum of squared deviations are computed
+        per block in float64 and merged with the pairwise update of Chan et al., which
+        stays accurate for bands with a large mean.
+        """
+        if self._moments is None:
+            cube = self._cube
+            v, x, y = cube.shape
+            rows = max(1, BLOCK_BYTES // max(1, v * y * 8))
+            minimum = maximum = None
+            count, mean, m2 = 0, np.zeros(v), np.zeros(v)
+            for start in range(0, x, rows):
+                block = cube[:, start:start + rows].reshape(v, -1)
+                block_min, block_max = block.min(axis=1), block.max(axis=1)
+                minimum = block_min if minimum is None else np.minimum(minimum, block_min)
+                maximum = block_max if maximum is None else np.maximum(maximum, block_max)
+
+                values = block.astype(np.float64)
+                n = values.shape[1]
+                block_mean = values.mean(axis=1)
+                values -= block_mean[:, None]
+                block_m2 = np.einsum('ij,ij->i', values, values)
+
+                delta = block_mean - mean
+                total = count + n
+                mean += delta * (n / total)
+                m2 += block_m2 + delta ** 2 * (count * n / total)
+                count = total
+            self._moments = {'min': minimum, 'max': maximum, 'mean': mean, 'std': np.sqrt(m2 / count)}
+        return self._moments
+
+    @property
+    def min(self) -> np.ndarray:
+        """Minimum of every band, in the dtype of the cube."""
+        return self._compute_moments()['min']
+
+    @property
+    def max(self) -> np.ndarray:
+        """Maximum of every band, in the dtype of the cube."""
+        return self._compute_moments()['max']
+
+    @property
+    def mean(self) -> np.ndarray:
+        """Mean of every band as float64."""
+        return self._compute_moments()['mean']
+
+    @property
+    def std(self) -> np.ndarray:
+        """Standard deviation of every band as float64."""
+        return self._compute_moments()['std']
+
+    def percentile(self, q) -> np.ndarray:
+        """
+        Return percentiles of every band.
+
+        Parameters
+        ----------
+        q : float or sequence of float
+            Percentile or percentiles in the range [0, 100].
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (v,) for a single percentile, or (len(q), v).
+        """
+        key = tuple(np.atleast_1d(q).tolist())
+        if key not in self._percentiles:
+            values = np.stack([np.percentile(band, key) for band in self._cube], axis=1)
+            self._percentiles[key] = values
+        values = self._percentiles[key]
+        return values[0] if np.ndim(q) == 0 else values
+
+    def histogram(self, bins: int = 256) -> tuple:
+        """
+        Return a histogram of every band over the range of that band.
+
+        Parameters
+        ----------
+        bins : int, optional
+            Number of bins. Default is 256.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            Counts of shape (v, bins) and bin edges of shape (v, bins + 1).
+        """
+        if bins not in self._histograms:
+            v = self._cube.shape[0]
+            counts = np.empty((v, bins), dtype=np.int64)
+            edges = np.empty((v, bins + 1), dtype=np.float64)
+            for i, band in enumerate(self._cube):
+                counts[i], edges[i] = np.histogram(band, bins=bins, range=(self.min[i], self.max[i]))
+            self._histograms[bins] = (counts, edges)
+        return self._histograms[bins]
@@ -0,0 +1,233 @@
+"""
+_core/wavelengths.py
+====================
+
+.. module:: wavelengths
+   :platform: Unix
+   :synopsis: Sorted wavelength index for mapping wavelengths to bands.
+
+Module Overview
+---------------
+
+This module provides `WavelengthIndex`, the lookup structure behind
+`DataCube.wavelength_index`. It keeps the wavelengths of a DataCube sorted together
+with their band numbers, so nearest, floor and ceil lookups cost O(log n) and can be
+done for many wavelengths at once. All lookups return band indices into the cube,
+also when the wavelengths of the cube are not in ascending order; ``-1`` marks
+wavelengths without a matching band.
+
+Examples
+--------
+Map wavelengths of a DataCube to bands:
+
+.. code-block:: python
+
+    index = dc.wavelength_index
+    band = index.nearest(532.4)
+    bands = index.nearest([450, 550, 650])
+    sub = dc.cube[index.to_slice(700, 900)]
+
+Classes
+-------
+
+.. autoclass:: WavelengthIndex
+   :members:
+
+"""
+
+import weakref
+
+import numpy as np
+
+# live indexes by id of their wavelength array, so `of` can reuse e.g. the index of a DataCube
+_INDEXES = weakref.WeakValueDictionary()
+
+
+class WavelengthIndex:
+    """
+    Sorted index of the wavelengths of a cube.
+
+    Attributes
+    ----------
+    wavelengths : np.ndarray
+        The wavelengths in band order, as passed in.
+    """
+
+    def __init__(self, wavelengths):
+        """
+        Build the index.
+
+        Wavelengths that are already in ascending order are used as they are,
+        without sorting.
+
+        Parameters
+        ----------
+        wavelengths : list | np.ndarray
+            Wavelength of every band, in band order.
+        """
+        self.wavelengths = np.asarray(wavelengths)
+        if np.all(self.wavelengths[1:] >= self.wavelengths[:-1]):
+            self._order = np.arange(len(self.wavelengths))
+            self._sorted = self.wavelengths
+        else:
+            self._order = np.argsort(self.wavelengths, kind='stable')
+            self._sorted = self.wavelengths[self._order]
+        _INDEXES[id(self.wavelengths)] = self
+
+    @classmethod
+    def of(cls, waves) -> 'WavelengthIndex':
+        """
+        Return an index for `waves`, reusing an existing one where possible.
+
+        Parameters
+        ----------
+        waves : list | np.ndarray | WavelengthIndex | DataCube
+            Wavelengths, an index or a DataCube. For a DataCube and for the
+            wavelength array of a live index, e.g. `dc.wavelengths`, the cached
+            index is returned instead of building a new one.
+
+        Returns
+        -------
+        WavelengthIndex
+            Index of the wavelengths.
+        """
+        if isinstance(waves, cls):
+            return waves
+        if hasattr(waves, 'wavelength_index'):
+            return waves.wavelength_index
+        index = _INDEXES.get(id(waves))
+        if index is not None and index.wavelengths is waves:
+            return index
+        return cls(waves)
+
+    def __len__(self) -> int:
+        """Return the number of bands."""
+        return len(self._sorted)
+
+    def _result(self, wavelength, pos, valid):
+        """Map positions in the sorted wavelengths to bands, -1 where not valid."""
+        bands = np.full(np.shape(wavelength), -1)
+        if len(self):
+            bands = np.where(valid, self._order[np.clip(pos, 0, len(self) - 1)], -1)
+        return int(bands) if np.ndim(wavelength) == 0 else bands
+
+    def _deviation(self, wavelength, pos, max_deviation):
+        """Check that the sorted wavelengths at `pos` exist and are close enough."""
+        valid = (pos >= 0) & (pos < len(self))
+        if max_deviation is not None and len(self):
+            found = self._sorted[np.clip(pos, 0, len(self) - 1)]
+            valid &= np.abs(found - wavelength) <= max_deviation
+        return valid
+
+    def nearest(self, wavelength, max_deviation: float = None):
+        """
+        Return the band with the wavelength closest to `wavelength`.
+
+        Parameters
+        ----------
+        wavelength : float | array_like
+            One or several wavelengths.
+        max_deviation : float, optional
+            Largest accepted distance; bands further away give -1. Default is no limit.
+
+        Returns
+        -------
+        int | np.ndarray
+            Band index per wavelength, -1 if there is none.
+        """
+        wavelength = np.asarray(wavelength)
+        pos = np.searchsorted(self._sorted, wavelength)
+        if len(self):
+            below = np.clip(pos - 1, 0, len(self) - 1)
+            above = np.clip(pos, 0, len(self) - 1)
+            closer_below = np.abs(wavelength - self._sorted[below]) <= np.abs(self._sorted[above] - wavelength)
+            pos = np.where(closer_below, below, above)
+        return self._result(wavelength, pos, self._deviation(wavelength, pos, max_deviation))
+
+    def floor(self, wavelength, max_deviation: float = None):
+        """
+        Return the band with the largest wavelength smaller than or equal to `wavelength`.
+
+        Parameters
+        ----------
+        wavelength : float | array_like
+            One or several wavelengths.
+        max_deviation : float, optional
+            Largest accepted distance; bands further away give -1. Default is no limit.
+
+        Returns
+        -------
+        int | np.ndarray
+            Band index per wavelength, -1 if there is none.
+        """
+        wavelength = np.asarray(wavelength)
+        pos = np.searchsorted(self._sorted, wavelength, side='right') - 1
+        return self._result(wavelength, pos, self._deviation(wavelength, pos, max_deviation))
+
+    def ceil(self, wavelength, max_deviation: float = None):
+        """
+        Return the band with the smallest wavelength greater than or equal to `wavelength`.
+
+        Parameters
+        ----------
+        wavelength : float | array_like
+            One or several wavelengths.
+        max_deviation : float, optional
+            Largest accepted distance; bands further away give -1. Default is no limit.
+
+        Returns
+        -------
+        int | np.ndarray
+            Band index per wavelength, -1 if there is none.
+        """
+        wavelength = np.asarray(wavelength)
+        pos = np.searchsorted(self._sorted, wavelength, side='left')
+        return self._result(wavelength, pos, self._deviation(wavelength, pos, max_deviation))
+
+    def bands_in_range(self, low: float, high: float) -> np.ndarray:
+        """
+        Return the bands with wavelengths in the inclusive range [`low`, `high`].
+
+        Parameters
+        ----------
+        low : float
+            Lower bound of the range.
+        high : float
+            Upper bound of the range.
+
+        Returns
+        -------
+        np.ndarray
+            Band indices in ascending order.
+        """
+        start = np.searchsorted(self._sorted, low, side='left')
+        stop = np.searchsorted(self._sorted, high, side='right')
+        return np.sort(self._order[start:stop])
+
+    def to_slice(self, low: float, high: float) -> slice:
+        """
+        Return the bands with wavelengths in [`low`, `high`] as slice of the cube.
+
+        Parameters
+        ----------
+        low : float
+            Lower bound of the range.
+        high : float
+            Upper bound of the range.
+
+        Returns
+        -------
+        slice
+            Slice along the v axis of the cube.
+
+        Raises
+        ------
+        ValueError
+            If the bands in the range are not contiguous in the cube.
+        """
+        bands = self.bands_in_range(low, high)
+        if bands.size == 0:
+            return slice(0, 0)
+        if bands[-1] - bands[0] + 1 != bands.size:
+            raise ValueError(f'The wavelengths in ({low}, {high}) are not contiguous in the cube.')
+        return slice(int(bands[0]), int(bands[-1]) + 1)
@@ -39,7 +39,7 @@ from matplotlib.widgets import Button, CheckButtons, RectangleSelector
 from matplotlib.gridspec import GridSpec
 import random
 
-from .._utils.helper import find_nex_smaller_wave, normalize_spec
+from .._utils.helper import normalize_spec
 
 # State dictionary to manage the global variables locally
 state = {
@@ -132,7 +132,7 @@ def plotter(dc):
         layer_index = state['layer_id']
         layer = dc.cube[layer_index]
         imshow.set_data(layer)
-        imshow.set_clim(vmin=layer.min(), vmax=layer.max())
+        imshow.set_clim(vmin=dc.stats.min[layer_index], vmax=dc.stats.max[layer_index])
         layer_id = dc.wavelengths[state["layer_id"]]
         notation = dc.notation or ""
         ax[0].set_title(f'Image @{notation}{layer_id}')
@@ -279,10 +279,10 @@ def plotter(dc):
         event : matplotlib.backend_bases.MouseEvent
             Mouse click event.
 
-        Raises
-        ------
-        IndexError
-            If no smaller wavelength is found for clicked X coordinate.
+        Notes
+        -----
+        Clicks on the spectrum jump to the layer with the closest wavelength, if one
+        lies within 10 units of the clicked position.
         """
         nonlocal roi_x_start, roi_x_end, roi_y_start, roi_y_end
         if event.inaxes == ax[0]:
@@ -291,10 +291,10 @@ def plotter(dc):
             roi_y_start, roi_y_end = roi_y, roi_y + 1
             update_plot()
         elif event.inaxes == ax[1]:
-            try:
-                state['layer_id'] = np.where(dc.wavelengths == find_nex_smaller_wave(dc.wavelengths, int(event.xdata), 10))[0][0]
-            except IndexError:
+            layer_id = dc.wavelength_index.nearest(event.xdata, max_deviation=10)
+            if layer_id < 0:
                 return
+            state['layer_id'] = layer_id
             update_plot()
 
     # Create main figure and layout with GridSpec
@@ -0,0 +1,192 @@
+"""
+_processing/calibration.py
+==========================
+
+.. module:: calibration
+   :platform: Unix
+   :synopsis: Dark and white reference calibration of raw cubes to reflectance.
+
+Module Overview
+---------------
+
+Raw intensities are converted to reflectance with ``(raw - dark) / (white - dark)``.
+The references are averaged once and turned into the reciprocal gain
+``1 / (white - dark)``, so the calibration of a block of the cube is one subtraction
+and one multiplication into a single buffer, followed by optional clipping. Pixels
+where white and dark are equal get a gain of 0 instead of a division by zero.
+
+References can be full cubes of shape (v, x, y), or frames that broadcast against the
+cube, e.g. (v, 1, y) for one line of a line scanner or (v, 1, 1) for one spectrum.
+Several recordings of a reference can be passed as a list or stacked along a leading
+axis; they are averaged.
+
+Functions
+---------
+
+.. autofunction:: average_reference
+.. autofunction:: reciprocal_gain
+.. autofunction:: prepare_references
+.. autofunction:: reference_block
+.. autofunction:: apply_calibration
+
+"""
+
+import numpy as np
+
+from .._utils import config
+
+
+def average_reference(reference, shape: tuple) -> np.ndarray:
+    """
+    Average the recordings of a reference and check it against the cube.
+
+    Parameters
+    ----------
+    reference : DataCube | np.ndarray | str | list
+        A reference cube or frame (also as nested lists, e.g. from a template), the
+        path of a file readable by `wizard.read`, a stack of recordings along a
+        leading axis, or a list of recordings.
+    shape : tuple
+        Shape (v, x, y) of the cube to calibrate.
+
+    Returns
+    -------
+    np.ndarray
+        The averaged reference in the compute dtype, with a shape that broadcasts
+        against `shape`.
+
+    Raises
+    ------
+    ValueError
+        If the reference does not broadcast against the cube.
+    """
+    dtype = config.compute_dtype()
+    if isinstance(reference, str):
+        from .._utils._loader import read  # prevent circular import errors
+        reference = read(reference)
+    recordings = isinstance(reference, (list, tuple)) and all(
+        hasattr(r, 'cube') or isinstance(r, (np.ndarray, str)) for r in reference)
+    if recordings:
+        mean = None
+        for recording in reference:
+            recording = average_reference(recording, shape)
+            mean = recording.copy() if mean is None else mean + recording
+        return mean / len(reference)
+    reference = np.asarray(getattr(reference, 'cube', reference))
+    if reference.ndim == 4:
+        reference = reference.mean(axis=0, dtype=dtype)
+    if reference.ndim != 3 or any(r not in (1, s) for r, s in zip(reference.shape, shape)):
+        raise ValueError(f'A reference of shape {reference.shape} does not fit a cube of shape {tuple(shape)}.')
+    return reference.astype(dtype, copy=False)
+
+
+def reciprocal_gain(dark: np.ndarray, white: np.ndarray, epsilon: float = 1e-12) -> np.ndarray:
+    """
+    Return ``1 / (white - dark)``, with 0 where the difference is not above `epsilon`.
+
+    Parameters
+    ----------
+    dark : np.ndarray
+        Averaged dark reference.
+    white : np.ndarray
+        Averaged white reference.
+    epsilon : float, optional
+        Smallest difference of white and dark that is inverted. Defaults to 1e-12.
+
+    Returns
+    -------
+    np.ndarray
+        The gain, broadcast to the common shape of the references.
+    """
+    span = np.subtract(white, dark)
+    gain = np.zeros_like(span)
+    np.divide(1, span, out=gain, where=np.abs(span) > epsilon)
+    return gain
+
+
+def prepare_references(shape: tuple, dark=None, white=None, epsilon: float = 1e-12) -> tuple:
+    """
+    Average the references and compute the gain for a cube.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape (v, x, y) of the cube to calibrate.
+    dark : DataCube | np.ndarray | list, optional
+        Dark reference, see `average_reference`. Defaults to zeros.
+    white : DataCube | np.ndarray | list, optional
+        White reference, see `average_reference`. Defaults to ``dark + 1``, i.e. a
+        gain of 1.
+    epsilon : float, optional
+        See `reciprocal_gain`. Defaults to 1e-12.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        The dark reference and the reciprocal gain, both broadcasting against the cube.
+
+    Raises
+    ------
+    ValueError
+        If neither `dark` nor `white` is given.
+    """
+    if dark is None and white is None:
+        raise ValueError('Calibration needs a dark or a white reference, neither was given.')
+    dtype = config.compute_dtype()
+    dark = np.zeros((1, 1, 1), dtype=dtype) if dark is None else average_reference(dark, shape)
+    if white is None:
+        return dark, np.ones((1, 1, 1), dtype=dtype)
+    return dark, reciprocal_gain(dark, average_reference(white, shape), epsilon)
+
+
+def reference_block(reference: np.ndarray, region: tuple) -> np.ndarray:
+    """
+    Return the part of a reference that belongs to a block of the cube.
+
+    Parameters
+    ----------
+    reference : np.ndarray
+        Reference that broadcasts against the cube.
+    region : tuple of slice
+        Slices of the block in the cube.
+
+    Returns
+    -------
+    np.ndarray
+        View of `reference` that broadcasts against the block.
+    """
+    return reference[tuple(s if n > 1 else slice(None) for s, n in zip(region, reference.shape))]
+
+
+def apply_calibration(block: np.ndarray, dark: np.ndarray, gain: np.ndarray, clip: tuple = (0, None),
+                      out: np.ndarray = None) -> np.ndarray:
+    """
+    Calibrate a block of a cube.
+
+    Parameters
+    ----------
+    block : np.ndarray
+        Raw values of shape (v, x, y).
+    dark : np.ndarray
+        Dark reference that broadcasts against `block`.
+    gain : np.ndarray
+        Reciprocal gain that broadcasts against `block`, see `reciprocal_gain`.
+    clip : tuple, optional
+        Lower and upper bound of the result, None for no bound. Defaults to (0, None).
+        Pass None to disable clipping.
+    out : np.ndarray, optional
+        Array of the shape of `block` to write into, may be `block` itself.
+        Defaults to a new array of the dtype of `gain`.
+
+    Returns
+    -------
+    np.ndarray
+        The calibrated block, `out` if given.
+    """
+    if out is None:
+        out = np.empty(block.shape, dtype=gain.dtype)
+    np.subtract(block, dark, out=out, dtype=out.dtype, casting='unsafe')
+    np.multiply(out, gain, out=out, casting='unsafe')
+    if clip is not None and (clip[0] is not None or clip[1] is not None):
+        np.clip(out, clip[0], clip[1], out=out)
+    return out
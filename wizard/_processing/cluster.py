@@ -28,7 +28,7 @@ The Isodata code was inspired by:
 
 import numpy as np
 from scipy.cluster.vq import vq
-from scipy.ndimage import uniform_filter, gaussian_filter
+from scipy.ndimage import gaussian_filter
 from typing import Tuple
 from typing import Optional
 from sklearn.cluster import KMeans, AgglomerativeClustering
@@ -37,6 +37,10 @@ from sklearn.decomposition import PCA
 from sklearn.feature_extraction.image import grid_to_graph
 from scipy.signal import convolve2d
 
+from .._core.layout import to_layout
+from .._utils.decorators import limit_native_threads
+from .filters import uniform_filter_cube
+
 
 def _quit_low_change_in_clusters(centers: np.ndarray, last_centers: np.ndarray, theta_o: float) -> bool:
     """
@@ -454,6 +458,7 @@ def _compute_pairwise_distances(centers: np.ndarray) -> list:
     return sorted(pair_dists, key=lambda x: x[0])
 
 
+@limit_native_threads
 def isodata(dc, k: int = 10, it: int = 10, p: int = 2, theta_m: int = 10,
             theta_s: float = 0.1, theta_c: int = 2, theta_o: float = 0.05,
             k_: Optional[int] = None) -> np.ndarray:
@@ -504,7 +509,7 @@ def isodata(dc, k: int = 10, it: int = 10, p: int = 2, theta_m: int = 10,
     --------
     >>> labels = isodata(dc, k=5, it=15)
     """
-    img = np.transpose(dc.cube, (1, 2, 0))  # Rearrange cube dimensions to (H, W, Channels)
+    img = np.transpose(to_layout(dc.cube, 'bip'), (1, 2, 0))  # (H, W, Channels), contiguous spectra
 
     if k_ is None:
         k_ = k
@@ -630,6 +635,7 @@ def _optimal_clusters(pixels, max_clusters=5, threshold=0.1) -> int:
     return best_k
 
 
+@limit_native_threads
 def smooth_kmeans(dc, n_clusters=5, threshold=.1, mrf_iterations=5, kernel_size=12, sigma=1.0):
     """
     Segment a hyperspectral DataCube using KMeans clustering with MRF-based spatial smoothing.
@@ -677,8 +683,8 @@ def smooth_kmeans(dc, n_clusters=5, threshold=.1, mrf_iterations=5, kernel_size=
 
     v, x, y = dc.shape
 
-    # Reshape cube for clustering
-    pixels = dc.cube.reshape(v, -1).T
+    # Reshape cube for clustering, a view of the 'bip' layout
+    pixels = to_layout(dc.cube, 'bip').reshape(v, -1).T
 
     # Determine optimal number of clusters
     optimal_k = _optimal_clusters(pixels, max_clusters=n_clusters, threshold=threshold)
@@ -701,6 +707,7 @@ def smooth_kmeans(dc, n_clusters=5, threshold=.1, mrf_iterations=5, kernel_size=
     return labels
 
 
+@limit_native_threads
 def pca(dc, n_components=25):
     """
     Perform principal component analysis to reduce the spectral dimensionality of a DataCube.
@@ -746,9 +753,9 @@ def pca(dc, n_components=25):
     """
     v, x, y = dc.cube.shape
 
-    cube = dc.cube
+    cube = to_layout(dc.cube, 'bip')
 
-    # Reshape to (n_pixels, v)
+    # Reshape to (n_pixels, v), a view of the 'bip' layout
     data = cube.reshape(v, -1).T  # (x*y, v)
 
     # PCA reduction
@@ -765,6 +772,7 @@ def pca(dc, n_components=25):
     return dc
 
 
+@limit_native_threads
 def spectral_spatial_kmeans(dc, n_clusters: int, spatial_radius: int) -> np.ndarray:
     """
     Spectral–spatial K-Means clustering for hyperspectral images.
@@ -804,9 +812,7 @@ def spectral_spatial_kmeans(dc, n_clusters: int, spatial_radius: int) -> np.ndar
 
     # Compute local-mean cube
     v, x, y = dc.cube.shape
-    local_cube = np.empty_like(dc.cube)
-    for band in range(v):
-        local_cube[band] = uniform_filter(dc.cube[band], size=2 * spatial_radius + 1, mode='reflect')
+    local_cube = uniform_filter_cube(dc.cube, size=2 * spatial_radius + 1, mode='reflect')
 
     # Stack spectral + spatial-mean features
     features = np.vstack([
@@ -821,6 +827,7 @@ def spectral_spatial_kmeans(dc, n_clusters: int, spatial_radius: int) -> np.ndar
     return flat_labels.reshape(x, y)
 
 
+@limit_native_threads
 def spatial_agglomerative_clustering(dc, n_clusters: int) -> np.ndarray:
     """
     Agglomerative clustering with a 4-connected grid graph enforcing spatial contiguity.
@@ -854,7 +861,7 @@ def spatial_agglomerative_clustering(dc, n_clusters: int) -> np.ndarray:
     connectivity = grid_to_graph(n_x=x, n_y=y)
 
     # Flatten spectral data
-    data = dc.cube.reshape(v, -1).T  # shape (x*y, v)
+    data = to_layout(dc.cube, 'bip').reshape(v, -1).T  # shape (x*y, v)
 
     # Agglomerative clustering with spatial connectivity
     agg = AgglomerativeClustering(n_clusters=n_clusters,
@@ -922,6 +929,7 @@ def smooth_cluster(img, sigma=1.0, n_iter=1):
     return result
 
 
+@limit_native_threads
 def kmeans(dc, n_clusters=5, n_init=10):
     """
     Perform KMeans clustering on a hyperspectral DataCube without spatial smoothing.
@@ -959,7 +967,7 @@ def kmeans(dc, n_clusters=5, n_init=10):
 
     # Reshape cube for clustering
     v, x, y = dc.cube.shape
-    pixels = dc.cube.reshape(v, -1).T
+    pixels = to_layout(dc.cube, 'bip').reshape(v, -1).T
 
     # Apply KMeans clustering
     kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=n_init)
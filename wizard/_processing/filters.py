@@ -0,0 +1,74 @@
+"""
+_processing/filters.py
+======================
+
+.. module:: filters
+   :platform: Unix
+   :synopsis: Spatial filters applied to all bands of a cube at once.
+
+Module Overview
+---------------
+
+This module filters the spatial dimensions of a whole cube with a single call of the
+separable `scipy.ndimage` filters, using a footprint of size 1 along the band axis, so
+the bands stay independent without a Python loop over them. The bands can be split
+into blocks that are filtered on several threads, and the result can be written into a
+preallocated array, including the input itself.
+
+Functions
+---------
+
+.. autofunction:: uniform_filter_cube
+
+"""
+
+from concurrent import futures
+
+import numpy as np
+from scipy.ndimage import uniform_filter
+
+from .._utils import config
+
+
+def uniform_filter_cube(cube: np.ndarray, size: int, mode: str = 'reflect', out: np.ndarray = None,
+                        n_jobs: int = None) -> np.ndarray:
+    """
+    Apply a spatial uniform (box) filter to every band of a cube.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+    size : int
+        Side length of the square window.
+    mode : str, optional
+        Border mode of `scipy.ndimage.uniform_filter`, defaults to ``'reflect'``.
+    out : np.ndarray, optional
+        Array of the shape of `cube` to write the result into, may be `cube` itself.
+        Defaults to a new array of the dtype of `cube`.
+    n_jobs : int, optional
+        Number of threads, each filtering a block of bands. Defaults to the
+        configured ``n_jobs``.
+
+    Returns
+    -------
+    np.ndarray
+        The filtered cube, `out` if given.
+    """
+    if out is None:
+        out = np.empty_like(cube)
+    n_bands = cube.shape[0]
+    n_jobs = min(config.resolve_n_jobs(n_jobs), max(n_bands, 1))
+    if n_jobs == 1:
+        uniform_filter(cube, size=(1, size, size), mode=mode, output=out)
+        return out
+
+    bounds = np.linspace(0, n_bands, n_jobs + 1).astype(int)
+
+    def filter_block(block):
+        start, stop = bounds[block], bounds[block + 1]
+        uniform_filter(cube[start:stop], size=(1, size, size), mode=mode, output=out[start:stop])
+
+    with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(filter_block, range(n_jobs)))
+    return out
@@ -0,0 +1,443 @@
+"""
+_processing/flatfield.py
+========================
+
+.. module:: flatfield
+   :platform: Unix
+   :synopsis: Fast estimation of flat fields (illumination) for vignetting correction.
+
+Module Overview
+---------------
+
+The illumination of a band is estimated as a Gaussian blur with a large sigma. Blurring
+a full-size band directly costs O(x·y·sigma), so for large sigmas the blur is computed
+on a downsampled band and the result is upsampled again, or computed in the frequency
+domain. The flat field is the illumination divided by its mean, so dividing a band by
+its flat field removes the vignetting and keeps the mean intensity.
+
+The blur methods are:
+
+* ``direct``: `scipy.ndimage.gaussian_filter` on the full band.
+* ``downsample``: area downsampling to about four pixels per sigma, direct blur,
+  bilinear upsampling. Accurate for the smooth illumination of vignetting.
+* ``fft``: multiplication with the Gaussian transfer function on a reflect-padded
+  band; exact up to the kernel truncation of ``direct``.
+* ``auto``: ``direct`` for small sigmas, ``downsample`` otherwise.
+
+For a fixed optical setup the flat field does not change between cubes. A
+`FlatFieldModel` estimates it once from reference cubes, is saved to disk with its
+format version and metadata, and corrects later cubes with one broadcast multiply by
+the precomputed gain (the reciprocal of the flat field). Models can be registered in an
+in-memory cache under the name of their instrument or their spatial shape.
+
+Classes
+-------
+
+.. autoclass:: FlatFieldModel
+   :members:
+
+Functions
+---------
+
+.. autofunction:: estimate_illumination
+.. autofunction:: estimate_flat_field
+.. autofunction:: register_model
+.. autofunction:: get_model
+.. autofunction:: clear_models
+
+"""
+
+import os
+import json
+from concurrent import futures
+
+import cv2
+import numpy as np
+from scipy import fft
+from scipy.ndimage import fourier_gaussian, gaussian_filter
+
+from .._utils import config
+
+METHODS = ('auto', 'direct', 'downsample', 'fft')
+
+# version of the file format written by `FlatFieldModel.save`
+FORMAT_VERSION = 1
+
+# registered models, keyed by instrument name or spatial shape
+_models = {}
+
+# sigma (in pixels) of the blur on the downsampled band
+_DOWNSAMPLED_SIGMA = 4
+
+# smallest side of a downsampled band
+_MIN_DOWNSAMPLED_SIZE = 16
+
+
+def _blur_downsampled(band: np.ndarray, sigma: float) -> np.ndarray:
+    """Blur a band on a downsampled copy and upsample the result."""
+    x, y = band.shape
+    factor = int(min(sigma / _DOWNSAMPLED_SIGMA, x / _MIN_DOWNSAMPLED_SIZE, y / _MIN_DOWNSAMPLED_SIZE))
+    if factor < 2:
+        return gaussian_filter(band, sigma=sigma)
+    small_x, small_y = x // factor, y // factor
+    small = cv2.resize(band, (small_y, small_x), interpolation=cv2.INTER_AREA)
+    small = gaussian_filter(small, sigma=(sigma * small_x / x, sigma * small_y / y))
+    return cv2.resize(small, (y, x), interpolation=cv2.INTER_LINEAR)
+
+
+def _blur_fft(band: np.ndarray, sigma: float) -> np.ndarray:
+    """Blur a band in the frequency domain, padded like `gaussian_filter` with ``reflect``."""
+    x, y = band.shape
+    pad_x, pad_y = min(int(4 * sigma + 0.5), x - 1), min(int(4 * sigma + 0.5), y - 1)
+    padded = np.pad(band, ((pad_x, pad_x), (pad_y, pad_y)), mode='symmetric')
+    shape = (fft.next_fast_len(padded.shape[0], real=True), padded.shape[1])
+    spectrum = fourier_gaussian(fft.rfft2(padded, s=shape), sigma=sigma, n=shape[1])
+    blurred = fft.irfft2(spectrum, s=shape)
+    return blurred[pad_x:pad_x + x, pad_y:pad_y + y].astype(band.dtype, copy=False)
+
+
+def _blur(band: np.ndarray, sigma: float, method: str) -> np.ndarray:
+    """Blur a band with the given method."""
+    if method == 'auto':
+        method = 'direct' if sigma < 2 * _DOWNSAMPLED_SIGMA else 'downsample'
+    if method == 'direct':
+        return gaussian_filter(band, sigma=sigma)
+    if method == 'downsample':
+        return _blur_downsampled(band, sigma)
+    return _blur_fft(band, sigma)
+
+
+def estimate_illumination(cube: np.ndarray, sigma: float = 50, method: str = 'auto', shared: bool = False,
+                          n_jobs: int = None) -> np.ndarray:
+    """
+    Estimate the illumination of every band as a Gaussian blur.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+    sigma : float, optional
+        Standard deviation of the Gaussian blur in pixels. Defaults to 50.
+    method : str, optional
+        ``'auto'``, ``'direct'``, ``'downsample'`` or ``'fft'``, see the module
+        overview. Defaults to ``'auto'``.
+    shared : bool, optional
+        Estimate one illumination from the mean of all bands instead of one per
+        band. Defaults to False.
+    n_jobs : int, optional
+        Number of threads blurring bands in parallel, defaults to the configured
+        ``n_jobs``.
+
+    Returns
+    -------
+    np.ndarray
+        Illumination of shape (v, x, y), or (1, x, y) if `shared`, in the compute
+        dtype.
+
+    Raises
+    ------
+    ValueError
+        If the method is unknown.
+    """
+    if method not in METHODS:
+        raise ValueError(f'Unknown method `{method}`, use one of {METHODS}.')
+    dtype = config.compute_dtype()
+    if shared:
+        cube = cube.mean(axis=0, dtype=dtype)[None]
+    illumination = np.empty(cube.shape, dtype=dtype)
+
+    def blur_band(i):
+        illumination[i] = _blur(cube[i].astype(dtype, copy=False), sigma, method)
+
+    n_jobs = config.resolve_n_jobs(n_jobs)
+    if n_jobs == 1 or cube.shape[0] == 1:
+        for i in range(cube.shape[0]):
+            blur_band(i)
+    else:
+        # the filters of scipy.ndimage, cv2 and scipy.fft release the GIL
+        with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(blur_band, range(cube.shape[0])))
+    return illumination
+
+
+def estimate_flat_field(cube: np.ndarray, sigma: float = 50, method: str = 'auto', shared: bool = False,
+                        epsilon: float = 1e-6, n_jobs: int = None) -> np.ndarray:
+    """
+    Estimate the flat field of every band, the illumination divided by its mean.
+
+    Parameters
+    ----------
+    cube : np.ndarray
+        Cube of shape (v, x, y).
+    sigma : float, optional
+        Standard deviation of the Gaussian blur in pixels. Defaults to 50.
+    method : str, optional
+        Blur method, see `estimate_illumination`. Defaults to ``'auto'``.
+    shared : bool, optional
+        Estimate one flat field for all bands. Defaults to False.
+    epsilon : float, optional
+        Lower bound of the illumination, prevents division by zero. A band whose
+        mean illumination is not above `epsilon` gets a flat field of ones.
+        Defaults to 1e-6.
+    n_jobs : int, optional
+        Number of threads, defaults to the configured ``n_jobs``.
+
+    Returns
+    -------
+    np.ndarray
+        Flat field of shape (v, x, y), or (1, x, y) if `shared`, in the compute
+        dtype.
+    """
+    flat = estimate_illumination(cube, sigma=sigma, method=method, shared=shared, n_jobs=n_jobs)
+    np.maximum(flat, epsilon, out=flat)
+    means = flat.mean(axis=(1, 2), dtype=np.float64)
+    flat[means <= epsilon] = 1
+    flat[means > epsilon] /= means[means > epsilon, None, None].astype(flat.dtype)
+    return flat
+
+
+class FlatFieldModel:
+    """
+    Flat field of an optical setup, reusable across cubes.
+
+    Attributes
+    ----------
+    flat : np.ndarray
+        Flat field of shape (v, x, y), or (1, x, y) for a model shared by all bands.
+    gain : np.ndarray
+        Reciprocal of `flat`; a cube is corrected by multiplying it with the gain.
+    instrument : str
+        Name of the instrument, or None.
+    wavelengths : np.ndarray
+        Wavelengths of the reference cubes, or None.
+    info : dict
+        Parameters of the estimation, e.g. ``sigma`` and ``method``.
+    """
+
+    def __init__(self, flat: np.ndarray, instrument: str = None, wavelengths=None, **info):
+        """
+        Build a model from a flat field.
+
+        Parameters
+        ----------
+        flat : np.ndarray
+            Flat field of shape (v, x, y) or (1, x, y), e.g. from `estimate_flat_field`.
+        instrument : str, optional
+            Name of the instrument the model belongs to.
+        wavelengths : array_like, optional
+            Wavelengths of the bands of `flat`.
+        **info
+            JSON-serializable parameters stored with the model.
+
+        Raises
+        ------
+        ValueError
+            If `flat` is not three-dimensional.
+        """
+        flat = np.asarray(flat)
+        if flat.ndim != 3:
+            raise ValueError(f'A flat field has the shape (v, x, y) or (1, x, y), got {flat.shape}.')
+        self.flat = flat
+        self.gain = np.reciprocal(flat)
+        self.instrument = instrument
+        self.wavelengths = None if wavelengths is None else np.asarray(wavelengths)
+        self.info = info
+
+    @property
+    def shared(self) -> bool:
+        """Return True if one flat field is used for all bands."""
+        return self.flat.shape[0] == 1
+
+    @property
+    def key(self):
+        """Return the cache key of the model: the instrument, or the spatial shape."""
+        return self.instrument if self.instrument is not None else self.flat.shape[1:]
+
+    @classmethod
+    def estimate(cls, references, sigma: float = 50, method: str = 'auto', shared: bool = False,
+                 epsilon: float = 1e-6, instrument: str = None, n_jobs: int = None) -> 'FlatFieldModel':
+        """
+        Estimate a model from one or several reference cubes.
+
+        The references (e.g. recordings of a homogeneous white target) are averaged,
+        then the flat field of the average is estimated with `estimate_flat_field`.
+
+        Parameters
+        ----------
+        references : DataCube | np.ndarray | list
+            One reference or a list of references of the same shape (v, x, y).
+        sigma : float, optional
+            Standard deviation of the Gaussian blur in pixels. Defaults to 50.
+        method : str, optional
+            Blur method, see `estimate_illumination`. Defaults to ``'auto'``.
+        shared : bool, optional
+            Estimate one flat field for all bands. Defaults to False.
+        epsilon : float, optional
+            Lower bound of the illumination. Defaults to 1e-6.
+        instrument : str, optional
+            Name of the instrument the model belongs to.
+        n_jobs : int, optional
+            Number of threads, defaults to the configured ``n_jobs``.
+
+        Returns
+        -------
+        FlatFieldModel
+            The estimated model.
+
+        Raises
+        ------
+        ValueError
+            If no references are given or their shapes differ.
+        """
+        if not isinstance(references, (list, tuple)):
+            references = [references]
+        if not references:
+            raise ValueError('At least one reference cube is required.')
+        wavelengths = getattr(references[0], 'wavelengths', None)
+        mean = None
+        for reference in references:
+            cube = getattr(reference, 'cube', reference)
+            if mean is None:
+                mean = np.zeros(cube.shape, dtype=config.compute_dtype())
+            elif cube.shape != mean.shape:
+                raise ValueError(f'All references need the shape {mean.shape}, got {cube.shape}.')
+            mean += cube
+        mean /= len(references)
+        flat = estimate_flat_field(mean, sigma=sigma, method=method, shared=shared, epsilon=epsilon, n_jobs=n_jobs)
+        return cls(flat, instrument=instrument, wavelengths=wavelengths, sigma=sigma, method=method,
+                   epsilon=epsilon, n_references=len(references))
+
+    def check(self, shape: tuple) -> None:
+        """
+        Check that the model can correct a cube.
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape (v, x, y) of the cube.
+
+        Raises
+        ------
+        ValueError
+            If the spatial shape or the number of bands does not match.
+        """
+        if tuple(shape[1:]) != self.flat.shape[1:] or (not self.shared and shape[0] != self.flat.shape[0]):
+            raise ValueError(f'The flat-field model of shape {self.flat.shape} does not fit a cube of shape {tuple(shape)}.')
+
+    def apply(self, cube: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Correct a cube with one broadcast multiply by the gain.
+
+        Parameters
+        ----------
+        cube : np.ndarray
+            Cube of shape (v, x, y).
+        out : np.ndarray, optional
+            Array of the shape of `cube` to write the result into, may be `cube`
+            itself. Defaults to a new array.
+
+        Returns
+        -------
+        np.ndarray
+            The corrected cube, with the dtype of `out`, or of `cube` if `out` is not
+            given. Integer results are rounded and clipped to the range of the dtype.
+        """
+        self.check(cube.shape)
+        if out is None:
+            out = np.empty_like(cube)
+        if np.issubdtype(out.dtype, np.integer):
+            info = np.iinfo(out.dtype)
+            corrected = np.multiply(cube, self.gain, dtype=self.gain.dtype)
+            np.clip(np.rint(corrected, out=corrected), info.min, info.max, out=corrected)
+            out[...] = corrected
+        else:
+            np.multiply(cube, self.gain, out=out, casting='same_kind')
+        return out
+
+    def save(self, path: str) -> None:
+        """
+        Write the model to a ``.npz`` file.
+
+        The file is written to a temporary file first and then renamed, so an existing
+        model is only replaced by a complete one.
+
+        Parameters
+        ----------
+        path : str
+            Target path, ``.npz`` is appended if missing.
+        """
+        if not path.endswith('.npz'):
+            path += '.npz'
+        meta = {'version': FORMAT_VERSION, 'instrument': self.instrument, 'info': self.info}
+        arrays = {'flat': self.flat, 'meta': np.array(json.dumps(meta, default=str))}
+        if self.wavelengths is not None:
+            arrays['wavelengths'] = self.wavelengths
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as model_file:
+            np.savez(model_file, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'FlatFieldModel':
+        """
+        Read a model written by `save`.
+
+        Parameters
+        ----------
+        path : str
+            Path of the ``.npz`` file.
+
+        Returns
+        -------
+        FlatFieldModel
+            The loaded model.
+
+        Raises
+        ------
+        ValueError
+            If the file was written by a newer, unknown format version.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['version'] > FORMAT_VERSION:
+                raise ValueError(f'`{path}` has the flat-field format version {meta["version"]}, '
+                                 f'this version of wizard reads up to {FORMAT_VERSION}.')
+            wavelengths = data['wavelengths'] if 'wavelengths' in data else None
+            return cls(data['flat'], instrument=meta['instrument'], wavelengths=wavelengths, **meta['info'])
+
+
+def register_model(model: FlatFieldModel, key=None) -> None:
+    """
+    Keep a model in the in-memory cache.
+
+    Parameters
+    ----------
+    model : FlatFieldModel
+        The model.
+    key : str | tuple, optional
+        Cache key, defaults to `FlatFieldModel.key`: the instrument, or the spatial
+        shape (x, y).
+    """
+    _models[model.key if key is None else key] = model
+
+
+def get_model(key) -> FlatFieldModel:
+    """
+    Return a model from the in-memory cache.
+
+    Parameters
+    ----------
+    key : str | tuple
+        Instrument name or spatial shape (x, y).
+
+    Returns
+    -------
+    FlatFieldModel
+        The registered model, or None.
+    """
+    return _models.get(tuple(key) if isinstance(key, (list, tuple)) else key)
+
+
+def clear_models() -> None:
+    """Remove all models from the in-memory cache."""
+    _models.clear()
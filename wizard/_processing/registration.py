@@ -0,0 +1,446 @@
+"""
+_processing/registration.py
+===========================
+
+.. module:: registration
+   :platform: Unix
+   :synopsis: Wave scheduling for the registration of the layers of a cube.
+
+Module Overview
+---------------
+
+Layers are registered against the set of layers that are already aligned. Matching one
+layer against that set does not depend on the other pending layers, so the pending
+layers are processed in waves: every layer of a wave is matched against the aligned set
+as it was at the start of the wave, on a thread pool, and the successful layers are
+committed in layer order before the next wave starts. Layers that fail are returned as
+waitlist and can be retried against the grown set.
+
+The result depends on the wave size only, not on the number of threads or their timing.
+The default wave size is the constant `WAVE_SIZE`, so the same cube is registered the
+same way on every machine. A wave size of 1 processes the layers strictly one after
+another.
+
+A pair of layers is registered with ORB features and a RANSAC homography, or, for
+cubes that only drift by translation, with FFT phase correlation, which falls back to
+the homography when the correlation response is low.
+
+The homographies of a registration are kept as a `TransformSet`, one per band. A rig
+that misaligns its bands the same way on every acquisition is registered once; the
+saved set is then applied to new cubes without matching any features.
+
+Classes
+-------
+
+.. autoclass:: TransformSet
+   :members:
+
+Functions
+---------
+
+.. autofunction:: register_pair
+.. autofunction:: align_in_waves
+
+"""
+
+import os
+import json
+from concurrent import futures
+
+import cv2
+import numpy as np
+
+from .._utils import config, helper
+
+METHODS = ('feature', 'phase')
+
+# version of the file format written by `TransformSet.save`
+FORMAT_VERSION = 1
+
+# default number of layers per wave; fixed, so results do not depend on the machine
+WAVE_SIZE = 8
+
+
+class TransformSet:
+    """
+    Per-band homographies that register the bands of a cube.
+
+    The homography of a band maps its pixel coordinates to those of the reference
+    band, i.e. the band is registered with ``cv2.warpPerspective(band, H, (y, x))``.
+
+    Attributes
+    ----------
+    homographies : np.ndarray
+        Array of shape (v, 3, 3).
+    shape : tuple
+        Spatial shape (x, y) of the cubes the transforms belong to.
+    instrument : str
+        Name of the instrument, or None.
+    wavelengths : np.ndarray
+        Wavelengths of the registered cube, or None.
+    info : dict
+        Parameters of the registration, e.g. ``method`` and ``reference``.
+    """
+
+    def __init__(self, homographies: np.ndarray, shape: tuple, instrument: str = None, wavelengths=None, **info):
+        """
+        Build a transform set from homographies.
+
+        Parameters
+        ----------
+        homographies : np.ndarray
+            Homographies of shape (v, 3, 3), one per band.
+        shape : tuple
+            Spatial shape (x, y) of the cubes.
+        instrument : str, optional
+            Name of the instrument the transforms belong to.
+        wavelengths : array_like, optional
+            Wavelengths of the bands.
+        **info
+            JSON-serializable parameters stored with the transforms.
+
+        Raises
+        ------
+        ValueError
+            If the homographies do not have the shape (v, 3, 3).
+        """
+        homographies = np.asarray(homographies, dtype=np.float64)
+        if homographies.ndim != 3 or homographies.shape[1:] != (3, 3):
+            raise ValueError(f'Homographies have the shape (v, 3, 3), got {homographies.shape}.')
+        self.homographies = homographies
+        self.shape = tuple(int(n) for n in shape)
+        self.instrument = instrument
+        self.wavelengths = None if wavelengths is None else np.asarray(wavelengths)
+        self.info = info
+
+    @classmethod
+    def identity(cls, n_bands: int, shape: tuple, **kwargs) -> 'TransformSet':
+        """
+        Return a transform set that leaves all bands unchanged.
+
+        Parameters
+        ----------
+        n_bands : int
+            Number of bands.
+        shape : tuple
+            Spatial shape (x, y) of the cubes.
+        **kwargs
+            Passed to `TransformSet`.
+
+        Returns
+        -------
+        TransformSet
+            The identity transforms.
+        """
+        return cls(np.repeat(np.eye(3)[None], n_bands, axis=0), shape, **kwargs)
+
+    def compose(self, first: 'TransformSet') -> 'TransformSet':
+        """
+        Return the transforms that apply `first` and then these transforms.
+
+        Parameters
+        ----------
+        first : TransformSet
+            Transforms applied first, e.g. of an earlier registration of the cube.
+            None, or transforms of another cube shape (e.g. from before a resize),
+            return these transforms.
+
+        Returns
+        -------
+        TransformSet
+            The composed transforms, with the attributes of this set.
+        """
+        if first is None or first.homographies.shape != self.homographies.shape or first.shape != self.shape:
+            return self
+        return TransformSet(self.homographies @ first.homographies, self.shape, instrument=self.instrument,
+                            wavelengths=self.wavelengths, **self.info)
+
+    def view(self, bands: slice, x: slice, y: slice) -> 'TransformSet':
+        """
+        Return the transforms of a sub-cube, see `DataCube.view`.
+
+        Parameters
+        ----------
+        bands : slice
+            Selected bands.
+        x : slice
+            Window along x.
+        y : slice
+            Window along y.
+
+        Returns
+        -------
+        TransformSet
+            The transforms of the selected bands, in the coordinates of the window, or
+            None if the window skips pixels and no homography maps it exactly.
+        """
+        x_range, y_range = range(*x.indices(self.shape[0])), range(*y.indices(self.shape[1]))
+        if x_range.step != 1 or y_range.step != 1:
+            return None
+        # move the window origin to (0, 0): H_view = T(-origin) @ H @ T(origin)
+        shift, unshift = np.eye(3), np.eye(3)
+        shift[:2, 2] = y_range.start, x_range.start
+        unshift[:2, 2] = -y_range.start, -x_range.start
+        homographies = unshift @ self.homographies[bands] @ shift
+        wavelengths = None if self.wavelengths is None else self.wavelengths[bands]
+        return TransformSet(homographies, (len(x_range), len(y_range)), instrument=self.instrument,
+                            wavelengths=wavelengths, **self.info)
+
+    def check(self, shape: tuple) -> None:
+        """
+        Check that the transforms can register a cube.
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape (v, x, y) of the cube.
+
+        Raises
+        ------
+        ValueError
+            If the number of bands or the spatial shape does not match.
+        """
+        if shape[0] != len(self.homographies) or tuple(shape[1:]) != self.shape:
+            raise ValueError(f'Transforms of {len(self.homographies)} bands of shape {self.shape} do not fit '
+                             f'a cube of shape {tuple(shape)}.')
+
+    def apply(self, cube: np.ndarray, out: np.ndarray = None, n_jobs: int = None) -> np.ndarray:
+        """
+        Warp all bands of a cube in one pass.
+
+        Bands with an identity transform are copied. Runs of neighbouring bands that
+        share a homography are warped together: as one multi-channel image if the cube
+        is band-interleaved, band by band otherwise. The runs are warped on threads.
+
+        Parameters
+        ----------
+        cube : np.ndarray
+            Cube of shape (v, x, y).
+        out : np.ndarray, optional
+            Array of the shape of `cube` to write the result into, may be `cube`
+            itself. Defaults to a new array.
+        n_jobs : int, optional
+            Number of threads, defaults to the configured ``n_jobs``.
+
+        Returns
+        -------
+        np.ndarray
+            The registered cube, `out` if given. Integer cubes that OpenCV cannot warp
+            are warped in the compute dtype, then rounded and clipped.
+        """
+        self.check(cube.shape)
+        if out is None:
+            out = np.empty_like(cube)
+        dtype = out.dtype
+        size = (self.shape[1], self.shape[0])
+        interleaved = cube.transpose(1, 2, 0).flags['C_CONTIGUOUS']
+        identity = np.all(self.homographies == np.eye(3), axis=(1, 2))
+
+        runs = []
+        start = 0
+        for band in range(1, len(cube) + 1):
+            if band == len(cube) or band - start == helper.CV2_MAX_CHANNELS or \
+                    not np.array_equal(self.homographies[band], self.homographies[start]):
+                if not identity[start]:
+                    runs.append((start, band))
+                elif out is not cube:
+                    out[start:band] = cube[start:band]
+                start = band
+
+        def to_dtype(warped):
+            if np.issubdtype(dtype, np.integer) and warped.dtype != dtype:
+                info = np.iinfo(dtype)
+                warped = np.clip(np.rint(warped), info.min, info.max)
+            return warped
+
+        def warp_run(run):
+            start, stop = run
+            h = self.homographies[start]
+            bands = cube[start:stop]
+            if bands.dtype not in helper.CV2_RESIZE_DTYPES:
+                bands = bands.astype(config.compute_dtype())
+            if interleaved and stop - start > 1:
+                warped = cv2.warpPerspective(np.ascontiguousarray(bands.transpose(1, 2, 0)), h, size,
+                                             flags=cv2.INTER_LINEAR)
+                out[start:stop] = to_dtype(warped.reshape(warped.shape[:2] + (-1,))).transpose(2, 0, 1)
+            else:
+                for band, image in enumerate(bands, start):
+                    out[band] = to_dtype(cv2.warpPerspective(image, h, size, flags=cv2.INTER_LINEAR))
+
+        n_jobs = min(config.resolve_n_jobs(n_jobs), max(len(runs), 1))
+        if n_jobs == 1:
+            for run in runs:
+                warp_run(run)
+        else:
+            with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(warp_run, runs))
+        return out
+
+    def save(self, path: str) -> None:
+        """
+        Write the transforms to a ``.npz`` file.
+
+        The file is written to a temporary file first and then renamed, so existing
+        transforms are only replaced by complete ones.
+
+        Parameters
+        ----------
+        path : str
+            Target path, ``.npz`` is appended if missing.
+        """
+        if not path.endswith('.npz'):
+            path += '.npz'
+        meta = {'version': FORMAT_VERSION, 'shape': list(self.shape), 'instrument': self.instrument,
+                'info': self.info}
+        arrays = {'homographies': self.homographies, 'meta': np.array(json.dumps(meta, default=str))}
+        if self.wavelengths is not None:
+            arrays['wavelengths'] = self.wavelengths
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as transforms_file:
+            np.savez(transforms_file, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'TransformSet':
+        """
+        Read transforms written by `save`.
+
+        Parameters
+        ----------
+        path : str
+            Path of the ``.npz`` file.
+
+        Returns
+        -------
+        TransformSet
+            The loaded transforms.
+
+        Raises
+        ------
+        ValueError
+            If the file was written by a newer, unknown format version.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['version'] > FORMAT_VERSION:
+                raise ValueError(f'`{path}` has the transform format version {meta["version"]}, '
+                                 f'this version of wizard reads up to {FORMAT_VERSION}.')
+            wavelengths = data['wavelengths'] if 'wavelengths' in data else None
+            return cls(data['homographies'], meta['shape'], instrument=meta['instrument'],
+                       wavelengths=wavelengths, **meta['info'])
+
+
+def register_pair(o_img: np.ndarray, a_img: np.ndarray, method: str = 'feature', max_features: int = 5000,
+                  match_percent: float = 0.1, cache: helper.FeatureCache = None, keys: tuple = (None, None)) -> tuple:
+    """
+    Align one image to another.
+
+    Parameters
+    ----------
+    o_img : np.ndarray
+        The reference image.
+    a_img : np.ndarray
+        The image to align.
+    method : str, optional
+        ``'feature'`` for `wizard._utils.helper.feature_registration`, ``'phase'`` for
+        `wizard._utils.helper.phase_registration`, falling back to the features if the
+        images are not related by a translation. Defaults to ``'feature'``.
+    max_features : int, optional
+        Maximum number of ORB features, defaults to 5000.
+    match_percent : float, optional
+        Percentage of matches used for the homography, defaults to 0.1.
+    cache : wizard._utils.helper.FeatureCache, optional
+        Cache to take the features of the images from.
+    keys : tuple, optional
+        Cache keys of `o_img` and `a_img`.
+
+    Returns
+    -------
+    aligned_img : np.ndarray
+        The aligned `a_img`.
+    H : np.ndarray
+        The 3x3 homography mapping points from `a_img` to `o_img`.
+
+    Raises
+    ------
+    ValueError
+        If the method is unknown.
+    wizard._utils.helper.RegistrationError
+        If the images cannot be registered.
+    """
+    if method not in METHODS:
+        raise ValueError(f'Unknown method `{method}`, use one of {METHODS}.')
+    if method == 'phase':
+        try:
+            return helper.phase_registration(o_img, a_img)
+        except helper.RegistrationError:
+            pass  # not a translation, use the homography
+    o_features = a_features = None
+    if cache is not None:
+        o_features, a_features = cache.features(keys[0], o_img), cache.features(keys[1], a_img)
+    return helper.feature_registration(o_img, a_img, max_features, match_percent,
+                                       o_features=o_features, a_features=a_features)
+
+
+def align_in_waves(pending, aligned: set, align, commit, wave_size: int = WAVE_SIZE, n_jobs: int = None,
+                   prepare=None) -> list:
+    """
+    Align layers in waves against a growing set of aligned layers.
+
+    Parameters
+    ----------
+    pending : iterable of int
+        Layers to align, in the order they are scheduled.
+    aligned : set of int
+        Layers that are already aligned. Committed layers are added to it.
+    align : callable
+        ``align(layer, references)`` returns the aligned layer, or None if it failed.
+        `references` is a copy of the aligned set at the start of the wave. It is called
+        on worker threads and must not write to shared state.
+    commit : callable
+        ``commit(layer, result)`` stores an aligned layer. Called on the calling thread,
+        in layer order within a wave.
+    wave_size : int, optional
+        Number of layers per wave, decides which layers are aligned against which.
+        Defaults to `WAVE_SIZE`, None also uses it.
+    n_jobs : int, optional
+        Number of threads aligning the layers of a wave, defaults to the configured
+        ``n_jobs``. Does not change the result.
+    prepare : callable, optional
+        ``prepare(layers)`` is called with the layers committed in a wave before the
+        next wave starts, e.g. to featurize them in parallel.
+
+    Returns
+    -------
+    list of int
+        The layers that could not be aligned, in scheduling order.
+    """
+    pending = list(pending)
+    n_jobs = config.resolve_n_jobs(n_jobs)
+    wave_size = max(1, int(wave_size or WAVE_SIZE))
+    n_jobs = min(n_jobs, wave_size)
+    failed = []
+
+    executor = futures.ThreadPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+    try:
+        for start in range(0, len(pending), wave_size):
+            wave = pending[start:start + wave_size]
+            references = aligned.copy()
+            if executor is None:
+                results = [align(layer, references) for layer in wave]
+            else:
+                results = list(executor.map(lambda layer: align(layer, references), wave))
+            committed = []
+            for layer, result in zip(wave, results):
+                if result is None:
+                    failed.append(layer)
+                    continue
+                commit(layer, result)
+                aligned.add(layer)
+                committed.append(layer)
+            if prepare is not None and committed:
+                prepare(committed)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return failed
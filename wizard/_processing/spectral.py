@@ -20,6 +20,8 @@ from scipy.signal import savgol_filter, butter, filtfilt
 from scipy import sparse
 from scipy.sparse.linalg import spsolve
 
+from wizard._core.wavelengths import WavelengthIndex
+
 
 def smooth_savgol(spectrum, window_length: int = 11, polyorder: int = 2):
     """
@@ -117,8 +119,9 @@ def get_ratio_two_specs(spectrum: np.array, waves: np.array, wave_1: int, wave_2
 
     :param spectrum: Main spectrum from which the wavelengths will be selected.
     :type spectrum: numpy.ndarray
-    :param waves: Array of wavelengths for the given spectrum.
-    :type waves: numpy.ndarray
+    :param waves: Array of wavelengths for the given spectrum, its `WavelengthIndex` or
+        the DataCube; the cached index of a cube is reused for `dc.wavelengths`.
+    :type waves: numpy.ndarray | WavelengthIndex | DataCube
     :param wave_1: First selected wavelength.
     :type wave_1: int
     :param wave_2: Second selected wavelength.
@@ -126,9 +129,9 @@ def get_ratio_two_specs(spectrum: np.array, waves: np.array, wave_1: int, wave_2
     :return: Ratio of the two selected wavelengths.
     :rtype: numpy.ndarray
     """
-    idx_1 = np.searchsorted(waves, wave_1)
-    idx_2 = np.searchsorted(waves, wave_2)
-    return spectrum[idx_1] / spectrum[idx_2] if idx_1 < len(waves) and idx_2 < len(waves) else -1
+    index = WavelengthIndex.of(waves)
+    idx_1, idx_2 = index.ceil([wave_1, wave_2])
+    return spectrum[idx_1] / spectrum[idx_2] if idx_1 >= 0 and idx_2 >= 0 else -1
 
 
 def get_sub_tow_specs(spectrum: np.array, waves: np.array, wave_1: int, wave_2: int) -> np.array:
@@ -137,8 +140,9 @@ def get_sub_tow_specs(spectrum: np.array, waves: np.array, wave_1: int, wave_2:
 
     :param spectrum: Main spectrum from which the wavelengths will be selected.
     :type spectrum: numpy.ndarray
-    :param waves: Array of wavelengths for the given spectrum.
-    :type waves: numpy.ndarray
+    :param waves: Array of wavelengths for the given spectrum, its `WavelengthIndex` or
+        the DataCube; the cached index of a cube is reused for `dc.wavelengths`.
+    :type waves: numpy.ndarray | WavelengthIndex | DataCube
     :param wave_1: First selected wavelength.
     :type wave_1: int
     :param wave_2: Second selected wavelength.
@@ -146,9 +150,9 @@ def get_sub_tow_specs(spectrum: np.array, waves: np.array, wave_1: int, wave_2:
     :return: Difference of the two selected wavelengths.
     :rtype: numpy.ndarray
     """
-    idx_1 = np.searchsorted(waves, wave_1)
-    idx_2 = np.searchsorted(waves, wave_2)
-    return spectrum[idx_1] - spectrum[idx_2] if idx_1 < len(waves) and idx_2 < len(waves) else -1
+    index = WavelengthIndex.of(waves)
+    idx_1, idx_2 = index.ceil([wave_1, wave_2])
+    return spectrum[idx_1] - spectrum[idx_2] if idx_1 >= 0 and idx_2 >= 0 else -1
 
 
 def signal_to_noise(spectrum: np.array) -> float:
@@ -9,12 +9,14 @@ _utils/_loader/__init__.py
 Module Overview
 ---------------
 
-This module initializes loader and writer functions for various file types. It allows dynamic registration of loaders based on file extensions.
+This module initializes loader and writer functions for various file types. It allows dynamic registration of loaders and writers based on file extensions.
 
 Functions
 ---------
 .. autofunction:: register_loader
+.. autofunction:: register_writer
 .. autofunction:: read
+.. autofunction:: write
 .. autofunction:: load_all_loaders
 
 """
@@ -26,8 +28,11 @@ import os
 # Dictionary to register loaders based on file extensions
 LOADER_REGISTRY = {}
 
+# Dictionary to register writers based on file extensions
+WRITER_REGISTRY = {}
+
 # Populate __all__ to control the public API
-__all__ = ['read']
+__all__ = ['read', 'write']
 
 
 def register_loader(extension, function_name):
@@ -42,6 +47,18 @@ def register_loader(extension, function_name):
     LOADER_REGISTRY[extension] = function_name
 
 
+def register_writer(extension, function_name):
+    """
+    Register a new writer for a specific file extension.
+
+    :param extension: File extension (e.g., '.csv').
+    :type extension: str
+    :param function_name: Writer function to be registered (e.g., _write_csv).
+    :type function_name: callable
+    """
+    WRITER_REGISTRY[extension] = function_name
+
+
 def read(path: str, datatype: str = 'auto', **kwargs):
     """
     Read data from files of various types and return a DataCube object.
@@ -74,11 +91,35 @@ def read(path: str, datatype: str = 'auto', **kwargs):
         raise NotImplementedError(f'No loader for {suffix} files; please use the custom loader class of the DataCube.')
 
 
+def write(dc, path: str, datatype: str = 'auto', **kwargs) -> None:
+    """
+    Write a DataCube to a file, choosing the writer by file extension.
+
+    :param dc: DataCube to be written.
+    :type dc: DataCube
+    :param path: Path of the output file.
+    :type path: str
+    :param datatype: Data type of the file (e.g., '.nrrd', '.hdr'). If 'auto', the file extension is inferred from the path.
+    :type datatype: str
+    :param kwargs: Additional keyword arguments passed to the writer function.
+    :raises NotImplementedError: If no writer is registered for the specified file type.
+    """
+    suffix = pathlib.Path(path).suffix if datatype == 'auto' else datatype
+
+    writer_function = WRITER_REGISTRY.get(suffix)
+
+    if writer_function:
+        writer_function(dc, path, **kwargs)
+    else:
+        raise NotImplementedError(f'No writer for {suffix} files.')
+
+
 def load_all_loaders():
     """
     Automatically discover and import loaders from the wizard._utils._loader package.
 
-    This function imports modules corresponding to known file types and registers their associated loading functions.
+    This function imports modules corresponding to known file types and registers their associated loading
+    and writing functions.
     """
     loader_modules = [
         "csv",
@@ -99,6 +140,9 @@ def load_all_loaders():
                 extension = '.' + attr_name.split('_')[-1]  # e.g., 'read_csv' -> '.csv'
                 loader_function = getattr(module, attr_name)
                 register_loader(extension, loader_function)
+            elif attr_name.startswith('_write_'):
+                extension = '.' + attr_name.split('_')[-1]
+                register_writer(extension, getattr(module, attr_name))
 
 
 # Load all loaders dynamically
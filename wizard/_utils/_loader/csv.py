@@ -22,6 +22,7 @@ import pandas as pd
 import numpy as np
 
 from ..._core import DataCube
+from .. import config
 
 
 def _read_csv(filepath: str) -> DataCube:
@@ -47,7 +48,7 @@ def _read_csv(filepath: str) -> DataCube:
     max_x = x.max() + 1
     max_y = y.max() + 1
 
-    cube = np.zeros((len(wavelengths), max_x, max_y))
+    cube = np.zeros((len(wavelengths), max_x, max_y), dtype=config.compute_dtype())
     for i in range(len(x)):
         cube[:, x[i], y[i]] = spectral_data[i]
 
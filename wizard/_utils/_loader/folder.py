@@ -26,6 +26,7 @@ import os
 import numpy as np
 from matplotlib import pyplot as plt
 from concurrent.futures import ThreadPoolExecutor
+from .. import config
 from ..decorators import check_path
 from ..._core import DataCube
 
@@ -134,7 +135,7 @@ def image_to_dc(path: str | list, **kwargs) -> DataCube:
             _img = load_image(file)
             return _img
 
-        with ThreadPoolExecutor() as executor:
+        with ThreadPoolExecutor(max_workers=config.resolve_n_jobs()) as executor:
             results = list(executor.map(process_image, enumerate(path)))
 
         data = np.dstack(results)
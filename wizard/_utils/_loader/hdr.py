@@ -24,7 +24,7 @@ from spectral.io import envi
 from ..._core import DataCube
 
 
-def _read_hdr(path: str, image_path: str = None) -> DataCube:
+def _read_hdr(path: str, image_path: str = None, mmap: bool = False) -> DataCube:
     """
     Read an ENVI file and convert it into a DataCube.
 
@@ -38,6 +38,11 @@ def _read_hdr(path: str, image_path: str = None) -> DataCube:
         Path to the ENVI header (.hdr) file.
     image_path : str, optional
         Path to the binary image file, if different or located elsewhere.
+    mmap : bool, optional
+        If True, the cube is a read-only memory map of the binary file instead of an
+        in-memory copy, so only the parts that are accessed are read from disk. Templates
+        of spatially local steps then run tile by tile (see `DataCube.execute_template`).
+        Default is False.
 
     Returns
     -------
@@ -54,9 +59,13 @@ def _read_hdr(path: str, image_path: str = None) -> DataCube:
     >>> import wizard
     >>> dc = wizard.read("/path/to/image.hdr")
     >>> dc = wizard.read(path='/path/to/image.hdr', image_path='/path/to/image.img')
+    >>> dc = wizard.read('/path/to/image.hdr', mmap=True)
     """
     img = envi.open(path, image_path) if image_path else envi.open(path)
-    cube = img.load().transpose((2, 0, 1))
+    if mmap:
+        cube = img.open_memmap(interleave='bip').transpose((2, 0, 1))
+    else:
+        cube = np.array(img.load().transpose((2, 0, 1)))
 
     wavelengths = img.metadata.get('wavelength')
     if wavelengths is not None:
@@ -64,7 +73,7 @@ def _read_hdr(path: str, image_path: str = None) -> DataCube:
     else:
         wavelengths = list(range(cube.shape[0]))
 
-    dc = DataCube(np.array(cube), wavelengths=wavelengths)
+    dc = DataCube(cube, wavelengths=wavelengths)
 
     notation = img.metadata.get('wavelength units')
 
@@ -79,7 +88,8 @@ def _write_hdr(dc: DataCube, file_path: str) -> None:
     Write a DataCube to an ENVI file.
 
     The function exports the DataCube into ENVI format with a header and binary file.
-    Wavelengths are stored in the header metadata.
+    Wavelengths are stored in the header metadata. The data is written band by band,
+    so a memory-mapped cube is never loaded into memory as a whole.
 
     Parameters
     ----------
@@ -97,8 +107,8 @@ def _write_hdr(dc: DataCube, file_path: str) -> None:
     >>> import wizard
     >>> wizard._utils._loader.hdr._write_hdr("/path/to/output")
     """
-    shape = dc.shape
-    image = dc.cube.transpose((1, 2, 0))
+    cube = dc.cube
+    shape = cube.shape
 
     metadata = {
         'interleave': 'bsq',
@@ -109,5 +119,12 @@ def _write_hdr(dc: DataCube, file_path: str) -> None:
         'wavelength units': 'none' if dc.notation is None else dc.notation
     }
 
-    envi.save_image(file_path if file_path.endswith('.hdr') else file_path + '.hdr',
-                    image, metadata=metadata, force=True)
+    # write band by band through a memory map, so memory-mapped cubes are streamed to disk
+    img = envi.create_image(file_path if file_path.endswith('.hdr') else file_path + '.hdr',
+                            metadata=metadata, shape=(shape[1], shape[2], shape[0]),
+                            dtype=cube.dtype, interleave='bsq', force=True)
+    out = img.open_memmap(interleave='bsq', writable=True)
+    for i in range(shape[0]):
+        out[i] = cube[i]
+    out.flush()
+    del out
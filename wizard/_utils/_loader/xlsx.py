@@ -25,6 +25,7 @@ import pandas as pd
 
 import wizard
 from ..._core import DataCube
+from .. import config
 
 
 def _read_xlsx(filepath: str) -> DataCube:
@@ -61,7 +62,7 @@ def _read_xlsx(filepath: str) -> DataCube:
     max_y = y.max() + 1
 
     # Reshape spectral data into (wavelengths, x, y)
-    cube = np.zeros((len(wavelengths), max_x, max_y))
+    cube = np.zeros((len(wavelengths), max_x, max_y), dtype=config.compute_dtype())
 
     for i in range(len(x)):
         cube[:, x[i], y[i]] = spectral_data[i]
@@ -0,0 +1,171 @@
+"""
+_utils/checkpoint.py
+====================
+
+.. module:: checkpoint
+   :platform: Unix
+   :synopsis: Step checkpoints for resumable template execution.
+
+Module Overview
+---------------
+
+This module stores the state of a DataCube after each step of a template, so an
+interrupted or failed run can resume from the last finished step.
+
+A checkpoint is keyed by a hash of the input DataCube and of the template steps up
+to and including the checkpointed step. Editing a later step of a template therefore
+keeps the checkpoints of all earlier steps valid, while changing the input or an
+earlier step invalidates them. Each checkpoint consists of a ``.npy`` file with the
+cube and a ``.json`` file with the remaining attributes, plus a ``.transforms.npz``
+file with the registration transforms of a registered DataCube. All are written to a
+temporary file first and then renamed, and the ``.json`` file is written last, so a
+checkpoint is only picked up when it was written completely.
+
+Functions
+---------
+
+.. autofunction:: fingerprint
+.. autofunction:: step_keys
+.. autofunction:: save_checkpoint
+.. autofunction:: load_checkpoint
+
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+def fingerprint(dc) -> str:
+    """
+    Hash the data and metadata of a DataCube.
+
+    :param dc: The DataCube to hash.
+    :type dc: DataCube
+    :return: Hex digest of the cube bytes, shape, dtype and wavelengths.
+    :rtype: str
+    """
+    h = hashlib.blake2b(digest_size=16)
+    cube = np.ascontiguousarray(dc.cube)
+    h.update(f'{cube.shape}|{cube.dtype}'.encode())
+    h.update(memoryview(cube).cast('B'))
+    if dc.wavelengths is not None:
+        h.update(np.ascontiguousarray(dc.wavelengths).tobytes())
+    return h.hexdigest()
+
+
+def step_keys(dc, steps: list) -> list:
+    """
+    Compute one checkpoint key per template step.
+
+    The key of step `i` hashes the fingerprint of `dc` and the steps ``0..i``.
+
+    :param dc: The DataCube the template starts with.
+    :type dc: DataCube
+    :param steps: Template steps as loaded from the YAML file.
+    :type steps: list[dict]
+    :return: Keys in step order.
+    :rtype: list[str]
+    """
+    h = hashlib.blake2b(fingerprint(dc).encode(), digest_size=16)
+    keys = []
+    for step in steps:
+        h.update(json.dumps(step, sort_keys=True, default=str).encode())
+        keys.append(h.copy().hexdigest())
+    return keys
+
+
+def _paths(directory: str, key: str) -> tuple:
+    """Return the cube and metadata path of a checkpoint."""
+    return os.path.join(directory, f'{key}.npy'), os.path.join(directory, f'{key}.json')
+
+
+def _transforms_path(directory: str, key: str) -> str:
+    """Return the path of the registration transforms of a checkpoint."""
+    return os.path.join(directory, f'{key}.transforms.npz')
+
+
+def save_checkpoint(dc, directory: str, key: str, **info) -> None:
+    """
+    Write the state of a DataCube as checkpoint.
+
+    :param dc: The DataCube to store.
+    :type dc: DataCube
+    :param directory: Checkpoint directory, created if missing.
+    :type directory: str
+    :param key: Checkpoint key, see `step_keys`.
+    :type key: str
+    :param info: Additional JSON-serializable information stored with the checkpoint.
+    """
+    os.makedirs(directory, exist_ok=True)
+    cube_path, meta_path = _paths(directory, key)
+
+    tmp_path = cube_path + '.tmp'
+    with open(tmp_path, 'wb') as cube_file:
+        np.save(cube_file, dc.cube)
+    os.replace(tmp_path, cube_path)
+
+    transforms = getattr(dc, 'transforms', None)
+    if transforms is not None:
+        transforms.save(_transforms_path(directory, key))
+
+    meta = {
+        'shape': list(dc.cube.shape),
+        'dtype': str(dc.cube.dtype),
+        'wavelengths': None if dc.wavelengths is None else np.asarray(dc.wavelengths).tolist(),
+        'name': dc.name,
+        'notation': dc.notation,
+        'registered': dc.registered,
+        'transforms': transforms is not None,
+        **info,
+    }
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as meta_file:
+        json.dump(meta, meta_file, default=str)
+    os.replace(tmp_path, meta_path)
+
+
+def load_checkpoint(dc, directory: str, key: str) -> bool:
+    """
+    Restore the state of a DataCube from a checkpoint.
+
+    :param dc: The DataCube to restore into.
+    :type dc: DataCube
+    :param directory: Checkpoint directory.
+    :type directory: str
+    :param key: Checkpoint key, see `step_keys`.
+    :type key: str
+    :return: True if a complete checkpoint was found and restored, False otherwise.
+    :rtype: bool
+    """
+    cube_path, meta_path = _paths(directory, key)
+    if not (os.path.isfile(meta_path) and os.path.isfile(cube_path)):
+        return False
+
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        cube = np.load(cube_path)
+    except (OSError, ValueError):
+        return False
+
+    if list(cube.shape) != meta['shape'] or str(cube.dtype) != meta['dtype']:
+        return False
+
+    transforms = None
+    if meta.get('transforms'):
+        from .._processing.registration import TransformSet  # prevent circular import errors
+        try:
+            transforms = TransformSet.load(_transforms_path(directory, key))
+        except (OSError, ValueError, KeyError):
+            return False
+
+    dc.set_cube(cube)
+    dc.wavelengths = None if meta['wavelengths'] is None else np.array(meta['wavelengths'])
+    dc.name = meta['name']
+    dc.notation = meta['notation']
+    dc.registered = meta['registered']
+    dc.transforms = transforms
+    return True
@@ -0,0 +1,338 @@
+"""
+_utils/cli.py
+=============
+
+.. module:: cli
+   :platform: Unix
+   :synopsis: Command-line entry point for headless template processing.
+
+Module Overview
+---------------
+
+This module provides the `wizard` console script. It loads a recorded template,
+expands the input globs, processes every input with `DataCube.execute_template`
+and writes the results in the requested output format. Inputs can be processed
+on several worker processes, and a memory budget limits how many inputs are held
+in memory at the same time. A timing summary is printed at the end.
+
+Examples
+--------
+Run a template on all ENVI files in a folder with four worker processes:
+
+.. code-block:: bash
+
+    wizard template.yml "data/*.hdr" --output-dir out --format nrrd --jobs 4 --memory-budget 16G
+
+Functions
+---------
+
+.. autofunction:: main
+.. autofunction:: expand_inputs
+.. autofunction:: estimate_footprint
+.. autofunction:: output_paths
+.. autofunction:: process_file
+.. autofunction:: run_batch
+
+"""
+
+import os
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import yaml
+from rich.console import Console
+from rich.table import Table
+
+from . import config
+from .config import parse_memory
+from ._loader import read, write, WRITER_REGISTRY
+
+# Rough factor between the size of an input on disk and its in-memory footprint
+# while a template runs (loaded cube, one intermediate copy and the output).
+MEMORY_OVERHEAD = 3
+
+
+def expand_inputs(patterns: list) -> list:
+    """
+    Expand input globs into a sorted list of unique paths.
+
+    Patterns that match nothing but name an existing file or folder are kept as they are.
+
+    :param patterns: Glob patterns or paths.
+    :type patterns: list[str]
+    :return: Sorted list of matching paths.
+    :rtype: list[str]
+    :raises FileNotFoundError: If no input matches.
+    """
+    paths = []
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True)
+        if not matches and os.path.exists(pattern):
+            matches = [pattern]
+        paths.extend(matches)
+
+    paths = sorted(set(paths))
+    if not paths:
+        raise FileNotFoundError(f'No input matches {patterns}.')
+    return paths
+
+
+def estimate_footprint(path: str) -> int:
+    """
+    Estimate the peak memory needed to process one input.
+
+    The estimate is the size of the input on disk times `MEMORY_OVERHEAD`. For folders the
+    sizes of all contained files are summed.
+
+    :param path: Path to a file or folder.
+    :type path: str
+    :return: Estimated footprint in bytes.
+    :rtype: int
+    """
+    if os.path.isdir(path):
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+                   if os.path.isfile(os.path.join(path, f)))
+    else:
+        size = os.path.getsize(path)
+    return size * MEMORY_OVERHEAD
+
+
+def output_paths(inputs: list, output_dir: str, fmt: str) -> list:
+    """
+    Build the output path of every input in the requested format.
+
+    The outputs mirror the paths of the inputs relative to their common folder, e.g.
+    ``a/scan.fsm`` and ``b/scan.fsm`` are written to ``<output_dir>/a/scan.<fmt>`` and
+    ``<output_dir>/b/scan.<fmt>``.
+
+    :param inputs: Paths of the inputs.
+    :type inputs: list[str]
+    :param output_dir: Directory for the output files.
+    :type output_dir: str
+    :param fmt: Output format, a registered writer extension without the dot.
+    :type fmt: str
+    :return: One output path per input, in input order.
+    :rtype: list[str]
+    :raises ValueError: If two inputs map to the same output, e.g. ``scan.fsm`` and ``scan.hdr``.
+    """
+    inputs = [os.path.abspath(os.path.normpath(path)) for path in inputs]
+    if not inputs:
+        return []
+    root = os.path.commonpath([os.path.dirname(path) for path in inputs])
+    outputs = [os.path.join(output_dir, f'{os.path.splitext(os.path.relpath(path, root))[0]}.{fmt}')
+               for path in inputs]
+
+    seen = {}
+    for path, output in zip(inputs, outputs):
+        if output in seen:
+            raise ValueError(f'`{seen[output]}` and `{path}` would both be written to `{output}`.')
+        seen[output] = path
+    return outputs
+
+
+def process_file(path: str, template: str, output: str, checkpoint_dir: str = None,
+                 settings: dict = None) -> dict:
+    """
+    Read one input, execute the template on it and write the result.
+
+    Errors are caught and reported in the returned record, so a single broken
+    input does not abort a batch.
+
+    :param path: Path of the input file or folder.
+    :type path: str
+    :param template: Path of the YAML template.
+    :type template: str
+    :param output: Path of the output file; its extension selects the writer, see `output_paths`.
+    :type output: str
+    :param checkpoint_dir: Directory for step checkpoints, see `DataCube.execute_template`.
+    :type checkpoint_dir: str
+    :param settings: Execution configuration applied while the input is processed, see `config.set_config`.
+    :type settings: dict
+    :return: Record with the input and output path, the status and the read, process, write and total times in seconds.
+    :rtype: dict
+    """
+    record = {'input': path, 'output': output,
+              'status': 'ok', 'error': None, 'read': 0., 'process': 0., 'write': 0., 'total': 0.}
+    start = time.perf_counter()
+    try:
+        with config.config_context(**(settings or {})):
+            _process(path, template, record, checkpoint_dir)
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = f'{type(e).__name__}: {e}'
+    record['total'] = time.perf_counter() - start
+    return record
+
+
+def _process(path: str, template: str, record: dict, checkpoint_dir: str) -> None:
+    """Read, process and write one input and store the timings in `record`."""
+    t = time.perf_counter()
+    dc = read(path)
+    record['read'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    dc.execute_template(template, checkpoint_dir=checkpoint_dir)
+    record['process'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    os.makedirs(os.path.dirname(record['output']) or '.', exist_ok=True)
+    write(dc, record['output'])
+    record['write'] = time.perf_counter() - t
+
+
+def run_batch(inputs: list, template: str, output_dir: str, fmt: str, jobs: int = 1, memory_budget: int = None,
+              checkpoint_dir: str = None) -> list:
+    """
+    Process a list of inputs, optionally on several worker processes.
+
+    Worker processes get the execution configuration of this process (see `config.worker_config`),
+    with unset worker and thread counts split between them to avoid oversubscribing the machine.
+
+    With a memory budget, a new input is only started while the estimated footprints of all
+    running inputs (see `estimate_footprint`) fit into the budget. An input that exceeds the
+    budget on its own is run alone.
+
+    Workers are started with the ``spawn`` method, which behaves the same on all platforms and
+    avoids forking a process that already runs native thread pools.
+
+    :param inputs: Paths of the inputs.
+    :type inputs: list[str]
+    :param template: Path of the YAML template.
+    :type template: str
+    :param output_dir: Directory for the output files.
+    :type output_dir: str
+    :param fmt: Output format, a registered writer extension without the dot.
+    :type fmt: str
+    :param jobs: Number of worker processes. ``1`` processes all inputs in this process.
+    :type jobs: int
+    :param memory_budget: Memory budget in bytes, or None for the configured budget.
+    :type memory_budget: int
+    :param checkpoint_dir: Directory for step checkpoints, shared by all inputs.
+    :type checkpoint_dir: str
+    :return: One record per input (see `process_file`), in input order.
+    :rtype: list[dict]
+    :raises ValueError: If `jobs` is below 1 or two inputs map to the same output, see `output_paths`.
+    """
+    if jobs < 1:
+        raise ValueError(f'jobs must be at least 1, got {jobs}.')
+    outputs = dict(zip(inputs, output_paths(inputs, output_dir, fmt)))
+
+    if jobs == 1:
+        return [process_file(path, template, outputs[path], checkpoint_dir) for path in inputs]
+
+    if memory_budget is None:
+        memory_budget = config.get_config()['memory_budget']
+    settings = config.worker_config(jobs)
+    footprints = {path: estimate_footprint(path) for path in inputs}
+    pending = list(inputs)
+    running = {}
+    used = 0
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+        while pending or running:
+            while pending and len(running) < jobs:
+                need = footprints[pending[0]]
+                if running and memory_budget is not None and used + need > memory_budget:
+                    break
+                path = pending.pop(0)
+                future = pool.submit(process_file, path, template, outputs[path], checkpoint_dir, settings)
+                running[future] = (path, need)
+                used += need
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, need = running.pop(future)
+                used -= need
+                results[path] = future.result()
+
+    return [results[path] for path in inputs]
+
+
+def _print_summary(results: list, wall: float, console: Console = None) -> None:
+    """Print a timing table for all processed inputs."""
+    console = console or Console()
+    table = Table(title='hsi-wizard batch summary')
+    for column in ('Input', 'Status', 'Read (s)', 'Process (s)', 'Write (s)', 'Total (s)'):
+        table.add_column(column, justify='left' if column in ('Input', 'Status') else 'right')
+
+    for r in results:
+        table.add_row(os.path.basename(os.path.normpath(r['input'])), r['status'],
+                      f"{r['read']:.3f}", f"{r['process']:.3f}", f"{r['write']:.3f}", f"{r['total']:.3f}")
+    console.print(table)
+
+    for r in results:
+        if r['error']:
+            console.print(f"[red]{r['input']}[/red]: {r['error']}")
+
+    n_ok = sum(r['status'] == 'ok' for r in results)
+    console.print(f'{n_ok}/{len(results)} inputs processed in {wall:.3f} s wall time.')
+
+
+def _load_template(path: str) -> list:
+    """Load a template and check that it is a list of method entries."""
+    with open(path, 'rb') as template_file:
+        template_data = yaml.safe_load(template_file)
+
+    if not isinstance(template_data, list) or not all(isinstance(step, dict) and 'method' in step for step in template_data):
+        raise ValueError(f'`{path}` is not a valid template.')
+    return template_data
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Build the argument parser of the `wizard` command.
+
+    :return: The configured parser.
+    :rtype: argparse.ArgumentParser
+    """
+    formats = sorted(ext.lstrip('.') for ext in WRITER_REGISTRY)
+    parser = argparse.ArgumentParser(
+        prog='wizard',
+        description='Run a recorded hsi-wizard template on one or more inputs.')
+    parser.add_argument('template', help='YAML template created with `DataCube.save_template`.')
+    parser.add_argument('inputs', nargs='+', help='Input files, folders or glob patterns (quote globs).')
+    parser.add_argument('-o', '--output-dir', default='.', help='Directory for the processed files (default: current directory).')
+    parser.add_argument('-f', '--format', default='nrrd', choices=formats, help='Output format (default: nrrd).')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes (default: 1).')
+    parser.add_argument('-m', '--memory-budget', type=parse_memory, default=None,
+                        help='Memory budget for concurrently processed inputs, e.g. 512M or 8G '
+                             '(default: WIZARD_MEMORY_BUDGET).')
+    parser.add_argument('-c', '--checkpoint-dir', default=None,
+                        help='Directory for step checkpoints; reruns resume from the last finished step.')
+    return parser
+
+
+def main(argv: list = None) -> int:
+    """
+    Entry point of the `wizard` console script.
+
+    :param argv: Command-line arguments, defaults to `sys.argv[1:]`.
+    :type argv: list[str]
+    :return: Exit code, ``0`` if all inputs were processed, ``1`` otherwise.
+    :rtype: int
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        parser.error(f'--jobs must be at least 1, got {args.jobs}.')
+
+    try:
+        _load_template(args.template)
+        inputs = expand_inputs(args.inputs)
+        output_paths(inputs, args.output_dir, args.format)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        parser.error(str(e))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    results = run_batch(inputs, args.template, args.output_dir, args.format,
+                        jobs=args.jobs, memory_budget=args.memory_budget, checkpoint_dir=args.checkpoint_dir)
+    _print_summary(results, time.perf_counter() - start)
+
+    return 0 if all(r['status'] == 'ok' for r in results) else 1
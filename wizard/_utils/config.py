@@ -0,0 +1,303 @@
+"""
+_utils/config.py
+================
+
+.. module:: config
+   :platform: Unix
+   :synopsis: Global parallelism and resource configuration.
+
+Module Overview
+---------------
+
+This module holds the execution configuration used by all parallel code paths of
+hsi-wizard: the per-pixel operations in `datacube_ops`, tiled template execution,
+the clustering functions and the loaders. The configuration has the following keys:
+
+- ``n_jobs``: number of workers, ``-1`` for all available cores.
+- ``backend``: ``'threads'`` or ``'processes'``, used where work can run in either.
+- ``blas_threads``: thread cap for native BLAS and OpenMP pools (numpy, scipy,
+  scikit-learn), applied with `threadpoolctl`. ``None`` leaves them unmanaged.
+- ``cv2_threads``: thread cap for OpenCV. ``None`` leaves it unmanaged.
+- ``memory_budget``: memory budget in bytes for block sizes and concurrently
+  processed inputs. ``None`` means no limit.
+- ``compute_dtype``: floating point type, ``'float32'`` (default) or ``'float64'``,
+  of cubes created by loaders and of intermediate and floating point results of
+  operations. Set it to ``'float64'`` where the extra precision is needed.
+
+Defaults are read from the environment variables ``WIZARD_N_JOBS``,
+``WIZARD_BACKEND``, ``WIZARD_BLAS_THREADS``, ``WIZARD_CV2_THREADS``,
+``WIZARD_MEMORY_BUDGET`` (e.g. ``16G``) and ``WIZARD_COMPUTE_DTYPE`` when the
+package is imported.
+
+Examples
+--------
+Limit a pipeline on a shared node to eight cores:
+
+.. code-block:: python
+
+    import wizard
+    with wizard.config_context(n_jobs=8, blas_threads=1, cv2_threads=1):
+        dc.remove_spikes()
+
+Functions
+---------
+
+.. autofunction:: get_config
+.. autofunction:: set_config
+.. autofunction:: config_context
+.. autofunction:: parse_memory
+.. autofunction:: resolve_n_jobs
+.. autofunction:: joblib_kwargs
+.. autofunction:: native_thread_limit
+.. autofunction:: worker_config
+.. autofunction:: compute_dtype
+
+"""
+
+import os
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+BACKENDS = ('threads', 'processes')
+COMPUTE_DTYPES = ('float32', 'float64')
+
+_MEMORY_UNITS = {
+    '': 1,
+    'B': 1,
+    'K': 1024,
+    'KB': 1024,
+    'M': 1024 ** 2,
+    'MB': 1024 ** 2,
+    'G': 1024 ** 3,
+    'GB': 1024 ** 3,
+    'T': 1024 ** 4,
+    'TB': 1024 ** 4,
+}
+
+_config = {
+    'n_jobs': -1,
+    'backend': 'threads',
+    'blas_threads': None,
+    'cv2_threads': None,
+    'memory_budget': None,
+    'compute_dtype': 'float32',
+}
+
+# thread limits currently applied by `set_config`
+_blas_limiter = None
+_cv2_default = None
+
+
+def parse_memory(value: str) -> int:
+    """
+    Parse a human readable memory size into bytes.
+
+    :param value: Memory size such as ``'512M'``, ``'8G'``, ``'1.5GB'`` or a plain byte count.
+    :type value: str
+    :return: The size in bytes.
+    :rtype: int
+    :raises ValueError: If the value can not be parsed.
+    """
+    text = str(value).strip().upper()
+    number = text.rstrip('KMGTB')
+    unit = text[len(number):]
+
+    if unit not in _MEMORY_UNITS or not number:
+        raise ValueError(f'Invalid memory size `{value}`.')
+
+    try:
+        size = float(number) * _MEMORY_UNITS[unit]
+    except ValueError:
+        raise ValueError(f'Invalid memory size `{value}`.')
+
+    if size <= 0:
+        raise ValueError(f'Memory size must be positive, got `{value}`.')
+    return int(size)
+
+
+def _validate(key: str, value):
+    """Check a configuration value and return it in canonical form."""
+    if key not in _config:
+        raise KeyError(f'Unknown configuration key `{key}`, use one of {list(_config)}.')
+    if value is None:
+        if key in ('n_jobs', 'backend', 'compute_dtype'):
+            raise ValueError(f'`{key}` can not be None.')
+        return None
+    if key == 'backend':
+        if value not in BACKENDS:
+            raise ValueError(f'`backend` must be one of {BACKENDS}, got `{value}`.')
+        return value
+    if key == 'memory_budget':
+        return parse_memory(value)
+    if key == 'compute_dtype':
+        try:
+            value = np.dtype(value).name
+        except TypeError:
+            pass
+        if value not in COMPUTE_DTYPES:
+            raise ValueError(f'`compute_dtype` must be one of {COMPUTE_DTYPES}, got `{value}`.')
+        return value
+    value = int(value)
+    if key == 'n_jobs' and (value == 0 or value < -1):
+        raise ValueError(f'`n_jobs` must be positive or -1, got {value}.')
+    if key != 'n_jobs' and value < 1:
+        raise ValueError(f'`{key}` must be positive, got {value}.')
+    return value
+
+
+def _apply_thread_limits() -> None:
+    """Apply the BLAS/OpenMP and OpenCV thread caps of the current configuration."""
+    global _blas_limiter, _cv2_default
+    if _blas_limiter is not None:
+        _blas_limiter.restore_original_limits()
+        _blas_limiter = None
+    if _config['blas_threads'] is not None:
+        _blas_limiter = threadpool_limits(limits=_config['blas_threads'])
+
+    if _config['cv2_threads'] is not None:
+        if _cv2_default is None:
+            _cv2_default = cv2.getNumThreads()
+        cv2.setNumThreads(_config['cv2_threads'])
+    elif _cv2_default is not None:
+        cv2.setNumThreads(_cv2_default)
+        _cv2_default = None
+
+
+def get_config() -> dict:
+    """
+    Return a copy of the current configuration.
+
+    :return: The configuration, see the module overview for the keys.
+    :rtype: dict
+    """
+    return dict(_config)
+
+
+def set_config(**kwargs) -> None:
+    """
+    Change the global configuration.
+
+    Thread caps are applied immediately to the native thread pools of this process.
+
+    :param kwargs: Configuration keys and their new values, see the module overview.
+    :raises KeyError: If a key is unknown.
+    :raises ValueError: If a value is invalid.
+    """
+    values = {key: _validate(key, value) for key, value in kwargs.items()}
+    _config.update(values)
+    if 'blas_threads' in values or 'cv2_threads' in values:
+        _apply_thread_limits()
+
+
+@contextmanager
+def config_context(**kwargs):
+    """
+    Context manager that changes the configuration within its body.
+
+    :param kwargs: Configuration keys and their values, see `set_config`.
+    :return: The configuration active within the body.
+    :rtype: dict
+    """
+    previous = get_config()
+    set_config(**kwargs)
+    try:
+        yield get_config()
+    finally:
+        set_config(**previous)
+
+
+def resolve_n_jobs(n_jobs: int = None) -> int:
+    """
+    Return the number of workers to use.
+
+    :param n_jobs: Requested number of workers, ``-1`` for all available cores, or None
+        for the configured value.
+    :type n_jobs: int
+    :return: A positive number of workers.
+    :rtype: int
+    """
+    n_jobs = _config['n_jobs'] if n_jobs is None else n_jobs
+    if n_jobs == -1:
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return os.cpu_count() or 1
+    return max(1, int(n_jobs))
+
+
+def joblib_kwargs(n_jobs: int = None, backend: str = None) -> dict:
+    """
+    Return keyword arguments for `joblib.Parallel` that follow the configuration.
+
+    :param n_jobs: Requested number of workers, None for the configured value.
+    :type n_jobs: int
+    :param backend: ``'threads'`` or ``'processes'``, None for the configured value.
+    :type backend: str
+    :return: ``n_jobs`` and ``prefer`` for `joblib.Parallel`.
+    :rtype: dict
+    """
+    return {'n_jobs': resolve_n_jobs(n_jobs), 'prefer': backend or _config['backend']}
+
+
+def native_thread_limit() -> int:
+    """
+    Return the thread cap for native BLAS and OpenMP pools.
+
+    :return: ``blas_threads`` if set, otherwise ``n_jobs`` if it is not ``-1``, otherwise None.
+    :rtype: int
+    """
+    if _config['blas_threads'] is not None:
+        return _config['blas_threads']
+    return None if _config['n_jobs'] == -1 else _config['n_jobs']
+
+
+def worker_config(n_workers: int) -> dict:
+    """
+    Return the configuration for one of `n_workers` worker processes.
+
+    Unset worker and thread counts are split between the workers, so the processes
+    together do not use more cores than this process would on its own.
+
+    :param n_workers: Number of worker processes.
+    :type n_workers: int
+    :return: Configuration for `set_config` in the worker.
+    :rtype: dict
+    """
+    config = get_config()
+    share = max(1, resolve_n_jobs() // max(1, n_workers))
+    if config['n_jobs'] == -1:
+        config['n_jobs'] = share
+    if config['blas_threads'] is None:
+        config['blas_threads'] = share
+    if config['cv2_threads'] is None:
+        config['cv2_threads'] = share
+    if config['memory_budget'] is not None:
+        config['memory_budget'] = max(1, config['memory_budget'] // max(1, n_workers))
+    return config
+
+
+def compute_dtype() -> np.dtype:
+    """
+    Return the floating point type for cubes and intermediate results.
+
+    :return: ``np.float32`` or ``np.float64``, see ``compute_dtype`` in the module overview.
+    :rtype: numpy.dtype
+    """
+    return np.dtype(_config['compute_dtype'])
+
+
+def _from_env() -> None:
+    """Read the configuration from ``WIZARD_*`` environment variables."""
+    values = {}
+    for key in _config:
+        value = os.environ.get(f'WIZARD_{key.upper()}')
+        if value:
+            values[key] = value
+    if values:
+        set_config(**values)
+
+
+_from_env()
@@ -21,6 +21,8 @@ Functions
 .. autofunction:: track_execution_time
 .. autofunction:: add_to_workflow
 .. autofunction:: check_limits
+.. autofunction:: limit_native_threads
+.. autofunction:: prefers_layout
 
 """
 
@@ -28,6 +30,7 @@ import os
 import time
 from functools import wraps
 import numpy as np
+from threadpoolctl import threadpool_limits
 
 import wizard
 import warnings
@@ -151,3 +154,43 @@ def check_limits(func) -> np.array:
             image = np.clip(image, 0, 1).astype(dtype)
         return image
     return wrapper
+
+
+def limit_native_threads(func):
+    """
+    Run a function with the native thread pools capped by the execution configuration.
+
+    BLAS and OpenMP pools (numpy, scipy, scikit-learn) are limited to
+    `config.native_thread_limit` threads while the function runs.
+
+    :param func: The function to be decorated.
+    :return: The wrapped function.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        from . import config
+
+        limit = config.native_thread_limit()
+        if limit is None:
+            return func(*args, **kwargs)
+        with threadpool_limits(limits=limit):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def prefers_layout(layout: str):
+    """
+    Declare the memory layout a DataCube operation runs fastest on.
+
+    The cube of the DataCube is converted to `layout` (``'bsq'`` or ``'bip'``, see
+    `wizard._core.layout`) before the operation runs when it is called as a DataCube
+    method. The function itself is not changed.
+
+    :param layout: ``'bsq'`` for per-band image operations, ``'bip'`` for per-pixel spectral operations.
+    :type layout: str
+    :return: The decorator.
+    """
+    def decorator(func):
+        func.__layout__ = layout
+        return func
+    return decorator
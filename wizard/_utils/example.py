@@ -1,5 +1,7 @@
 import numpy as np
 
+from . import config
+
 
 def _draw_circle(mask, center, radius):
     """
@@ -144,7 +146,8 @@ def generate_pattern_stack(v, height, width, n_circles=10, n_triangles=8, n_rect
     Returns
     -------
     ndarray
-        A (v, height, width) NumPy array representing the synthetic image stack.
+        A (v, height, width) NumPy array representing the synthetic image stack, of the
+        configured compute dtype (see `wizard.set_config`).
 
     Raises
     ------
@@ -210,7 +213,7 @@ def generate_pattern_stack(v, height, width, n_circles=10, n_triangles=8, n_rect
         base_layer = np.maximum(base_layer, m * I)
 
     # build stack with independent noise per layer (no gradient)
-    stack = np.zeros((v, height, width), float)
+    stack = np.zeros((v, height, width), dtype=config.compute_dtype())
     for i in range(v):
         noise = np.random.normal(0, noise_std, size=base_layer.shape)
         stack[i] = np.clip(base_layer + noise, 0, 1)
@@ -16,14 +16,24 @@ Functions
 
 .. autofunction:: find_nex_greater_wave
 .. autofunction:: find_nex_smaller_wave
+.. autofunction:: resize_image
+.. autofunction:: detect_features
+.. autofunction:: feature_registration
+.. autofunction:: translate_image
+.. autofunction:: phase_registration
+.. autoclass:: FeatureCache
+   :members:
 
 """
 
 import cv2
 import warnings
 import numpy as np
+from concurrent import futures
 from skimage.feature import canny
 
+from . import config
+
 
 class RegistrationError(Exception):
     """Custom exception for registration errors."""
@@ -41,8 +51,8 @@ def find_nex_greater_wave(waves, wave_1: int, maximum_deviation: int = 5) -> int
 
     Parameters
     ----------
-    waves : list[int]
-        A list of integer wave values to search within.
+    waves : list[int] | WavelengthIndex | DataCube
+        A list of integer wave values to search within, its `WavelengthIndex` or a DataCube.
     wave_1 : int
         The reference wave value to find the next greater wave after.
     maximum_deviation : int, optional
@@ -59,7 +69,9 @@ def find_nex_greater_wave(waves, wave_1: int, maximum_deviation: int = 5) -> int
 
     Notes
     -----
-    The function stops searching once it finds the first match within the allowed range.
+    The lookup is a binary search on the sorted waves. The cached index of a DataCube
+    is reused when `waves` is the cube, its `wavelength_index` or `dc.wavelengths`;
+    waves that are already sorted are not sorted again.
 
     Examples
     --------
@@ -69,16 +81,11 @@ def find_nex_greater_wave(waves, wave_1: int, maximum_deviation: int = 5) -> int
     >>> find_nex_greater_wave([400, 405, 410, 415], 416)
     -1
     """
-    wave_next = -1
-
-    for n in range(maximum_deviation):
-        wave_n = wave_1 + n
-
-        if wave_n in waves:
-            wave_next = wave_n
-            break
+    from wizard._core.wavelengths import WavelengthIndex  # prevent circular import errors
 
-    return wave_next
+    index = WavelengthIndex.of(waves)
+    band = index.ceil(wave_1, max_deviation=maximum_deviation - 1)
+    return -1 if band < 0 else index.wavelengths[band].item()
 
 
 def find_nex_smaller_wave(waves, wave_1: int, maximum_deviation: int = 5) -> int:
@@ -91,8 +98,8 @@ def find_nex_smaller_wave(waves, wave_1: int, maximum_deviation: int = 5) -> int
 
     Parameters
     ----------
-    waves : list[int]
-        A list of integer wave values to search within.
+    waves : list[int] | WavelengthIndex | DataCube
+        A list of integer wave values to search within, its `WavelengthIndex` or a DataCube.
     wave_1 : int
         The reference wave value to find the next smaller wave before.
     maximum_deviation : int, optional
@@ -109,7 +116,9 @@ def find_nex_smaller_wave(waves, wave_1: int, maximum_deviation: int = 5) -> int
 
     Notes
     -----
-    The function stops searching once it finds the first match within the allowed range.
+    The lookup is a binary search on the sorted waves. The cached index of a DataCube
+    is reused when `waves` is the cube, its `wavelength_index` or `dc.wavelengths`;
+    waves that are already sorted are not sorted again.
 
     Examples
     --------
@@ -119,16 +128,11 @@ def find_nex_smaller_wave(waves, wave_1: int, maximum_deviation: int = 5) -> int
     >>> find_nex_smaller_wave([390, 395, 400, 405], 389)
     -1
     """
-    wave_next = -1
-
-    for n in range(maximum_deviation):
-        wave_n = wave_1 - n
+    from wizard._core.wavelengths import WavelengthIndex  # prevent circular import errors
 
-        if wave_n in waves:
-            wave_next = wave_n
-            break
-
-    return wave_next
+    index = WavelengthIndex.of(waves)
+    band = index.floor(wave_1, max_deviation=maximum_deviation - 1)
+    return -1 if band < 0 else index.wavelengths[band].item()
 
 
 def normalize_spec(spec):
@@ -260,7 +264,49 @@ def feature_regestration(o_img: np.ndarray, a_img: np.ndarray, max_features: int
     return aligned_img, h
 
 
-def feature_registration(o_img: np.ndarray, a_img: np.ndarray, max_features: int = 5000, match_percent: float = 0.1) -> tuple[np.ndarray, np.ndarray]:
+def _to_uint8(im: np.ndarray) -> np.ndarray:
+    """Convert image to uint8, normalizing if necessary."""
+    if im.dtype != np.uint8:
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=RuntimeWarning, message="invalid value encountered in true_divide")
+            warnings.filterwarnings("ignore", category=RuntimeWarning, message="invalid value encountered in divide")
+            min_val, max_val = im.min(), im.max()
+            if min_val == max_val:
+                im_norm = np.zeros_like(im, dtype=np.float32)
+            else:
+                im_norm = (im.astype(np.float32) - min_val) / (max_val - min_val)
+            im_norm = np.nan_to_num(im_norm, nan=0.0, posinf=1.0, neginf=0.0)
+        im = (im_norm * 255).astype(np.uint8)
+    return im
+
+
+def detect_features(img: np.ndarray, max_features: int = 5000, orb=None) -> tuple:
+    """
+    Detect ORB keypoints and descriptors of an image.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        The image, normalized to uint8 if it has another dtype.
+    max_features : int, optional
+        Maximum number of ORB features to detect, defaults to 5000.
+    orb : cv2.ORB, optional
+        Detector to use instead of creating one with `max_features`.
+
+    Returns
+    -------
+    keypoints : tuple of cv2.KeyPoint
+        The detected keypoints.
+    descriptors : numpy.ndarray
+        Their descriptors, None if no keypoints were found.
+    """
+    if orb is None:
+        orb = cv2.ORB_create(max_features)
+    return orb.detectAndCompute(_to_uint8(img), None)
+
+
+def feature_registration(o_img: np.ndarray, a_img: np.ndarray, max_features: int = 5000, match_percent: float = 0.1,
+                         o_features: tuple = None, a_features: tuple = None) -> tuple[np.ndarray, np.ndarray]:
     """
     Perform ORB-based feature registration.
 
@@ -277,6 +323,11 @@ def feature_registration(o_img: np.ndarray, a_img: np.ndarray, max_features: int
         Maximum number of ORB features to detect, defaults to 5000.
     match_percent : float, optional
         Percentage of best matches to use for homography, defaults to 0.1.
+    o_features : tuple, optional
+        Keypoints and descriptors of `o_img` from `detect_features`, e.g. from a
+        `FeatureCache`. Detected if not given.
+    a_features : tuple, optional
+        Keypoints and descriptors of `a_img`. Detected if not given.
 
     Returns
     -------
@@ -291,25 +342,12 @@ def feature_registration(o_img: np.ndarray, a_img: np.ndarray, max_features: int
         If no descriptors are found, not enough good matches are found,
         or homography estimation fails.
     """
-    def to_uint8(im: np.ndarray) -> np.ndarray:
-        """Convert image to uint8, normalizing if necessary."""
-        if im.dtype != np.uint8:
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", category=RuntimeWarning, message="invalid value encountered in true_divide")
-                warnings.filterwarnings("ignore", category=RuntimeWarning, message="invalid value encountered in divide")
-                min_val, max_val = im.min(), im.max()
-                if min_val == max_val:
-                    im_norm = np.zeros_like(im, dtype=np.float32)
-                else:
-                    im_norm = (im.astype(np.float32) - min_val) / (max_val - min_val)
-                im_norm = np.nan_to_num(im_norm, nan=0.0, posinf=1.0, neginf=0.0)
-            im = (im_norm * 255).astype(np.uint8)
-        return im
-
-    o8, a8 = to_uint8(o_img), to_uint8(a_img)
-    orb = cv2.ORB_create(max_features)
-    kp1, des1 = orb.detectAndCompute(a8, None)
-    kp2, des2 = orb.detectAndCompute(o8, None)
+    if o_features is None or a_features is None:
+        orb = cv2.ORB_create(max_features)
+        kp1, des1 = a_features if a_features is not None else detect_features(a_img, orb=orb)
+        kp2, des2 = o_features if o_features is not None else detect_features(o_img, orb=orb)
+    else:
+        (kp1, des1), (kp2, des2) = a_features, o_features
 
     if des1 is None or des2 is None:
         raise RegistrationError("No descriptors found")
@@ -336,6 +374,213 @@ def feature_registration(o_img: np.ndarray, a_img: np.ndarray, max_features: int
     return aligned, H
 
 
+def translate_image(img: np.ndarray, dx: float, dy: float) -> np.ndarray:
+    """
+    Shift an image by a sub-pixel translation with bilinear resampling.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        The image.
+    dx : float
+        Shift along the columns, in pixels.
+    dy : float
+        Shift along the rows, in pixels.
+
+    Returns
+    -------
+    numpy.ndarray
+        The shifted image of the same shape and dtype, zero where no input maps.
+    """
+    h, w = img.shape
+    m = np.float64([[1, 0, dx], [0, 1, dy]])
+    return cv2.warpAffine(img, m, (w, h), flags=cv2.INTER_LINEAR)
+
+
+def phase_registration(o_img: np.ndarray, a_img: np.ndarray, levels: int = 1,
+                       min_response: float = 0.3) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Register a translated image with FFT phase correlation.
+
+    The shift is estimated on the coarsest level of a Gaussian pyramid and refined on
+    every finer level, with `cv2.phaseCorrelate` and a Hanning window, to sub-pixel
+    precision. `a_img` is then shifted onto `o_img`.
+
+    Parameters
+    ----------
+    o_img : numpy.ndarray
+        The target (reference) image.
+    a_img : numpy.ndarray
+        The source image to be aligned.
+    levels : int, optional
+        Number of pyramid levels below the full resolution, defaults to 1.
+    min_response : float, optional
+        Smallest peak response of the correlation on the full resolution that is
+        accepted, between 0 and 1. Defaults to 0.3.
+
+    Returns
+    -------
+    aligned_img : numpy.ndarray
+        The `a_img` shifted to align with `o_img`.
+    H : numpy.ndarray
+        The 3x3 translation homography mapping points from `a_img` to `o_img`.
+
+    Raises
+    ------
+    RegistrationError
+        If the images differ in shape or the response is below `min_response`,
+        i.e. the images are not related by a translation.
+    """
+    if o_img.shape != a_img.shape:
+        raise RegistrationError(f"Shapes differ: {o_img.shape} and {a_img.shape}")
+    pyramid = [(o_img.astype(np.float64), a_img.astype(np.float64))]
+    for _ in range(levels):
+        o_level, a_level = pyramid[-1]
+        if min(o_level.shape) < 32:
+            break
+        pyramid.append((cv2.pyrDown(o_level), cv2.pyrDown(a_level)))
+
+    shift = np.zeros(2)
+    response = 0.
+    for level in range(len(pyramid) - 1, -1, -1):
+        o_level, a_level = pyramid[level]
+        scale = 2 ** level
+        if shift.any():
+            a_level = translate_image(a_level, -shift[0] / scale, -shift[1] / scale)
+        window = cv2.createHanningWindow(o_level.shape[::-1], cv2.CV_64F)
+        (dx, dy), response = cv2.phaseCorrelate(o_level, a_level, window)
+        shift += np.array([dx, dy]) * scale
+
+    if not np.isfinite(response) or response < min_response:
+        raise RegistrationError(f"Phase correlation response too low ({response:.3f} < {min_response})")
+    H = np.array([[1., 0., -shift[0]], [0., 1., -shift[1]], [0., 0., 1.]])
+    return translate_image(a_img, -shift[0], -shift[1]), H
+
+
+class FeatureCache:
+    """
+    Cache of ORB features and edge maps of the layers of one registration run.
+
+    Entries are keyed by layer index. A layer is featurized on first use and reused for
+    every further pair it is matched in; `invalidate` drops its entries after the layer
+    was overwritten, e.g. by its aligned version. `prefetch` featurizes several layers
+    on threads. Reading the cache from several threads is safe; a key that is missing
+    may then be computed twice, with the same result.
+
+    Attributes
+    ----------
+    max_features : int
+        Maximum number of ORB features per layer.
+    """
+
+    def __init__(self, max_features: int = 5000):
+        """
+        Create an empty cache.
+
+        Parameters
+        ----------
+        max_features : int, optional
+            Maximum number of ORB features per layer, defaults to 5000.
+        """
+        self.max_features = max_features
+        self._features = {}
+        self._edges = {}
+
+    def features(self, key, img: np.ndarray) -> tuple:
+        """
+        Return the keypoints and descriptors of a layer.
+
+        Parameters
+        ----------
+        key : hashable
+            Layer key, e.g. its index.
+        img : numpy.ndarray
+            The layer, only read if its features are not cached.
+
+        Returns
+        -------
+        tuple
+            Keypoints and descriptors as returned by `detect_features`.
+        """
+        if key not in self._features:
+            self._features[key] = detect_features(img, self.max_features)
+        return self._features[key]
+
+    def prefetch(self, keys, images, n_jobs: int = None) -> None:
+        """
+        Featurize the layers that are not cached yet on a thread pool.
+
+        Parameters
+        ----------
+        keys : iterable
+            Layer keys.
+        images : sequence of numpy.ndarray
+            Images indexed by key, e.g. the cube.
+        n_jobs : int, optional
+            Number of threads, defaults to the configured ``n_jobs``.
+        """
+        keys = [key for key in keys if key not in self._features]
+        n_jobs = min(config.resolve_n_jobs(n_jobs), max(len(keys), 1))
+        if n_jobs == 1:
+            for key in keys:
+                self.features(key, images[key])
+            return
+        with futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = executor.map(lambda key: detect_features(images[key], self.max_features), keys)
+            self._features.update(zip(keys, results))
+
+    def edges(self, key, img: np.ndarray) -> np.ndarray:
+        """
+        Return the Canny edge map of a layer, see `auto_canny` and `normalize_polarity`.
+
+        Parameters
+        ----------
+        key : hashable
+            Layer key, e.g. its index.
+        img : numpy.ndarray
+            The layer, only read if its edge map is not cached.
+
+        Returns
+        -------
+        numpy.ndarray
+            The edge map as float image.
+        """
+        if key not in self._edges:
+            self._edges[key] = auto_canny(normalize_polarity(img)).astype(float)
+        return self._edges[key]
+
+    def edge_features(self, key, img: np.ndarray) -> tuple:
+        """
+        Return the keypoints and descriptors of the edge map of a layer.
+
+        Parameters
+        ----------
+        key : hashable
+            Layer key, e.g. its index.
+        img : numpy.ndarray
+            The layer, only read if nothing is cached for it.
+
+        Returns
+        -------
+        tuple
+            Keypoints and descriptors of the edge map.
+        """
+        return self.features(('edges', key), self.edges(key, img))
+
+    def invalidate(self, key) -> None:
+        """
+        Drop all cached data of a layer.
+
+        Parameters
+        ----------
+        key : hashable
+            Layer key.
+        """
+        self._features.pop(key, None)
+        self._features.pop(('edges', key), None)
+        self._edges.pop(key, None)
+
+
 def _process_slice(spec_out_flat: np.ndarray, spikes_flat: np.ndarray, idx: int, window: int) -> tuple:
     """
     Process a single slice to remove spikes.
@@ -458,3 +703,52 @@ def normalize_polarity(img: np.ndarray) -> np.ndarray:
     if np.mean(img_f) > 0.5:
         img_f = 1.0 - img_f
     return img_f
+
+
+# OpenCV handles at most this many channels per image in all supported versions
+CV2_MAX_CHANNELS = 128
+
+# dtypes `cv2.resize` interpolates natively with every method
+CV2_RESIZE_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+
+def _cv2_resize(img: np.ndarray, size: tuple, interpolation: int) -> np.ndarray:
+    """Resize an image, in chunks of 4 channels where OpenCV rejects more."""
+    try:
+        out = cv2.resize(img, size, interpolation=interpolation)
+    except cv2.error:
+        # some methods, e.g. INTER_AREA with non-integer factors, only support 4 channels
+        if img.ndim < 3 or img.shape[2] <= 4:
+            raise
+        out = np.concatenate([cv2.resize(img[:, :, i:i + 4], size, interpolation=interpolation).reshape(size[1], size[0], -1)
+                              for i in range(0, img.shape[2], 4)], axis=2)
+    return out.reshape((size[1], size[0]) + img.shape[2:])
+
+
+def resize_image(img: np.ndarray, size: tuple, interpolation: int, pyramid: bool = False) -> np.ndarray:
+    """
+    Resize a single- or multi-channel image with `cv2.resize`.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        Image of shape (x, y) or (x, y, c) with at most `CV2_MAX_CHANNELS` channels
+        and a dtype in `CV2_RESIZE_DTYPES`. All channels are resized in one call.
+    size : tuple
+        Target size as (width, height), i.e. (y, x) as for `cv2.resize`.
+    interpolation : int
+        OpenCV interpolation flag, e.g. ``cv2.INTER_LINEAR``.
+    pyramid : bool, optional
+        For reductions by more than a factor of 2, halve the image with
+        ``cv2.INTER_AREA`` until the remaining factor is at most 2 before the final
+        resize, defaults to False.
+
+    Returns
+    -------
+    numpy.ndarray
+        Resized image of shape (height, width[, c]) and the dtype of `img`.
+    """
+    if pyramid:
+        while img.shape[0] // 2 >= size[1] and img.shape[1] // 2 >= size[0]:
+            img = _cv2_resize(img, (img.shape[1] // 2, img.shape[0] // 2), cv2.INTER_AREA)
+    return _cv2_resize(img, size, interpolation)
@@ -0,0 +1,247 @@
+"""
+_utils/profiler.py
+==================
+
+.. module:: profiler
+   :platform: Unix
+   :synopsis: Per-operation profiling of DataCube methods.
+
+Module Overview
+---------------
+
+This module collects metrics for every call of a dynamic DataCube method while
+profiling is enabled. The hook lives in `TrackExecutionMeta.record_method`, so all
+operations from `datacube_ops` are covered without further changes. Each call is
+stored as a record with its wall time, CPU time, peak allocated bytes and the
+shape of the cube before and after the call. Records are kept in an in-process
+registry that can be queried, summarized per method and exported as JSON.
+
+Peak memory is measured with `tracemalloc`, which is started together with the
+profiler. Tracing slows down Python-heavy operations, so profiling should be
+switched off when it is not needed.
+
+Examples
+--------
+Profile a pipeline and print which step dominates:
+
+.. code-block:: python
+
+    import wizard
+    with wizard.profiler.profiling():
+        dc.remove_spikes()
+        dc.baseline_als()
+    wizard.profiler.print_summary()
+
+Functions
+---------
+
+.. autofunction:: start_profiling
+.. autofunction:: stop_profiling
+.. autofunction:: profiling
+.. autofunction:: is_profiling
+.. autofunction:: profile_call
+.. autofunction:: get_records
+.. autofunction:: clear_records
+.. autofunction:: summary
+.. autofunction:: to_json
+.. autofunction:: print_summary
+
+"""
+
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from rich.console import Console
+from rich.table import Table
+
+_enabled = False
+_started_tracemalloc = False
+_records = []
+# traced memory peaks of the enclosing profiled calls, innermost last
+_peak_stack = []
+
+
+def start_profiling(clear: bool = True) -> None:
+    """
+    Enable profiling of dynamic DataCube methods.
+
+    :param clear: If True, records of earlier runs are removed.
+    :type clear: bool
+    """
+    global _enabled, _started_tracemalloc
+    if clear:
+        clear_records()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _enabled = True
+
+
+def stop_profiling() -> None:
+    """Disable profiling. Collected records are kept."""
+    global _enabled, _started_tracemalloc
+    _enabled = False
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+
+@contextmanager
+def profiling(clear: bool = True):
+    """
+    Context manager that profiles all DataCube methods called in its body.
+
+    :param clear: If True, records of earlier runs are removed.
+    :type clear: bool
+    :return: The list of records, filled while the body runs.
+    :rtype: list[dict]
+    """
+    start_profiling(clear=clear)
+    try:
+        yield _records
+    finally:
+        stop_profiling()
+
+
+def is_profiling() -> bool:
+    """
+    Check whether profiling is enabled.
+
+    :return: True if calls are profiled.
+    :rtype: bool
+    """
+    return _enabled
+
+
+def _cube_shape(dc):
+    """Return the shape of a DataCube without materializing pending operations."""
+    cube = getattr(dc, '_cube', None)
+    return tuple(cube.shape) if cube is not None else None
+
+
+def profile_call(name: str, func, dc, *args, **kwargs):
+    """
+    Call `func(dc, *args, **kwargs)` and store its metrics in the registry.
+
+    The record holds the method `name`, the `start` timestamp, the `wall` and `cpu` time
+    in seconds, the `peak_bytes` allocated on top of the memory in use when the call
+    started, the `input_shape` and `output_shape` of the cube and an `error` message
+    if the call raised. Nested profiled calls are recorded separately and count towards
+    the peak of the enclosing call.
+
+    :param name: Name stored in the record.
+    :type name: str
+    :param func: The function to call.
+    :type func: callable
+    :param dc: The DataCube the function works on.
+    :type dc: DataCube
+    :return: The return value of `func`.
+    """
+    record = {'method': name, 'start': time.time(), 'wall': 0., 'cpu': 0., 'peak_bytes': 0,
+              'input_shape': _cube_shape(dc), 'output_shape': None, 'error': None}
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if _peak_stack:
+            _peak_stack[-1] = max(_peak_stack[-1], peak)
+        tracemalloc.reset_peak()
+        _peak_stack.append(current)
+        base = current
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        return func(dc, *args, **kwargs)
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        record['wall'] = time.perf_counter() - wall
+        record['cpu'] = time.process_time() - cpu
+        if tracing and tracemalloc.is_tracing():
+            peak = max(_peak_stack.pop(), tracemalloc.get_traced_memory()[1])
+            record['peak_bytes'] = max(0, peak - base)
+            if _peak_stack:
+                _peak_stack[-1] = max(_peak_stack[-1], peak)
+        elif tracing:
+            _peak_stack.pop()
+        record['output_shape'] = _cube_shape(dc)
+        _records.append(record)
+
+
+def get_records(method: str = None) -> list:
+    """
+    Return the collected records.
+
+    :param method: If given, only records of this method are returned.
+    :type method: str
+    :return: Records in call order.
+    :rtype: list[dict]
+    """
+    if method is None:
+        return list(_records)
+    return [r for r in _records if r['method'] == method]
+
+
+def clear_records() -> None:
+    """Remove all collected records."""
+    _records.clear()
+
+
+def summary() -> dict:
+    """
+    Aggregate the records per method.
+
+    :return: Mapping of method name to the number of `calls`, the summed `wall` and `cpu`
+        time, the largest `peak_bytes` and the `share` of the total wall time. Methods are
+        ordered by descending wall time.
+    :rtype: dict
+    """
+    stats = {}
+    for r in _records:
+        s = stats.setdefault(r['method'], {'calls': 0, 'wall': 0., 'cpu': 0., 'peak_bytes': 0})
+        s['calls'] += 1
+        s['wall'] += r['wall']
+        s['cpu'] += r['cpu']
+        s['peak_bytes'] = max(s['peak_bytes'], r['peak_bytes'])
+
+    total = sum(s['wall'] for s in stats.values())
+    for s in stats.values():
+        s['share'] = s['wall'] / total if total else 0.
+    return dict(sorted(stats.items(), key=lambda item: item[1]['wall'], reverse=True))
+
+
+def to_json(path: str = None) -> str:
+    """
+    Export the records and the per-method summary as JSON.
+
+    :param path: If given, the JSON is also written to this file.
+    :type path: str
+    :return: The JSON document.
+    :rtype: str
+    """
+    text = json.dumps({'records': _records, 'summary': summary()}, indent=2)
+    if path is not None:
+        with open(path, 'w') as json_file:
+            json_file.write(text)
+    return text
+
+
+def print_summary(console: Console = None) -> None:
+    """
+    Print the per-method summary as a table.
+
+    :param console: Console to print to, defaults to a new `rich` console.
+    :type console: rich.console.Console
+    """
+    console = console or Console()
+    table = Table(title='hsi-wizard profile')
+    for column in ('Method', 'Calls', 'Wall (s)', 'CPU (s)', 'Peak (MB)', 'Share'):
+        table.add_column(column, justify='left' if column == 'Method' else 'right')
+
+    for method, s in summary().items():
+        table.add_row(method, str(s['calls']), f"{s['wall']:.3f}", f"{s['cpu']:.3f}",
+                      f"{s['peak_bytes'] / 1024 ** 2:.1f}", f"{s['share']:.1%}")
+    console.print(table)
@@ -11,6 +11,12 @@ Module Overview
 
 This module contains functions to track changes made to DataCube instances.
 
+Only pipeline operations (methods marked with `__is_dynamic__ = True`) are
+wrapped; all other methods, including indexing and iteration, run without any
+tracking overhead. Recorded calls are logged to the ``wizard._utils.tracker``
+logger at ``DEBUG`` level, with the method name, args and kwargs attached to
+the log record as ``method``, ``call_args`` and ``call_kwargs``.
+
 Classes
 -------
 
@@ -20,6 +26,13 @@ Classes
    :show-inheritance:
 """
 
+import logging
+from functools import wraps
+
+from wizard._utils import profiler
+
+logger = logging.getLogger(__name__)
+
 excluded = ['stop_recording', 'save_template', '_clean_data', '_map_args_to_kwargs', 'execute_template']
 
 
@@ -59,7 +72,7 @@ class TrackExecutionMeta(type):
         """
         Creates a new class, wrapping its methods for tracking if applicable.
 
-        Wraps all callable attributes except those explicitly excluded or not marked dynamic.
+        Only callables marked dynamic are wrapped; all other attributes are left untouched.
 
         Parameters
         ----------
@@ -78,7 +91,7 @@ class TrackExecutionMeta(type):
             A new class with method execution tracking wrappers.
         """
         for key, value in dct.items():
-            if callable(value) and key != 'execute_template':
+            if callable(value) and key not in excluded:
                 dct[key] = cls.record_method(value)
         return super().__new__(cls, name, bases, dct)
 
@@ -87,8 +100,8 @@ class TrackExecutionMeta(type):
         """
         Wraps a method to record its execution if tracking is enabled.
 
-        Only records calls to methods explicitly marked as dynamic
-        using the `__is_dynamic__ = True` attribute.
+        Only methods explicitly marked as dynamic using the `__is_dynamic__ = True`
+        attribute are wrapped; other callables are returned unchanged.
 
         Parameters
         ----------
@@ -98,18 +111,35 @@ class TrackExecutionMeta(type):
         Returns
         -------
         callable
-            The wrapped method that conditionally records executions.
+            The wrapped method that conditionally records executions, or `func`
+            itself if it is not dynamic.
 
         Notes
         -----
         This does not alter the method's original behavior, only adds tracking.
+        If the instance is lazy (it has a pending operation graph), dynamic
+        methods are appended to the graph instead of being executed and the
+        instance is returned. While profiling is enabled (see
+        `wizard._utils.profiler`), executed dynamic methods are profiled.
         """
+        if not getattr(func, '__is_dynamic__', False):
+            return func
+
+        name = func.__name__
+
+        @wraps(func)
         def wrapper(*args, **kwargs):
             if TrackExecutionMeta.recording:
-                if getattr(func, '__is_dynamic__', False):
-                    print(f"Tracking dynamic method: {func.__name__}")
-                    TrackExecutionMeta.recorded_methods.append(
-                        (func.__name__, args, kwargs))
+                logger.debug('Tracking dynamic method: %s', name,
+                             extra={'method': name, 'call_args': args[1:], 'call_kwargs': kwargs})
+                TrackExecutionMeta.recorded_methods.append((name, args, kwargs))
+            if args:
+                graph = getattr(args[0], '_graph', None)
+                if graph is not None:
+                    graph.add(func, args[1:], kwargs)
+                    return args[0]
+                if profiler.is_profiling():
+                    return profiler.profile_call(name, func, *args, **kwargs)
             return func(*args, **kwargs)
         return wrapper
 